@@ -0,0 +1,113 @@
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from server import Server
+
+# aggregate download throughput over loopback with 1, 10 and 100 clients at the same time
+# serial: the old Server.start, one connection after the other
+# workers: Server(workers=N), every connection served by a thread of the pool
+# with --slow-rate the first client reads at that rate, like a client on a slow link
+# the serial server makes every other client wait for it, the pool does not
+
+HOST = "127.0.0.1"
+RECV_SIZE = 1024 * 1024
+
+def run_server(server):
+    try:
+        server.start()
+    except OSError:
+        # the listening socket was closed, the benchmark is over
+        pass
+
+def download(port, filename, results, index, rate=None):
+    conn = socket.create_connection((HOST, port))
+    start = time.perf_counter()
+    conn.sendall(f"download {filename}".encode())
+
+    # count the bytes, the header included, the content is not checked here
+    buffer = bytearray(RECV_SIZE)
+    received = 0
+    while True:
+        n = conn.recv_into(buffer, RECV_SIZE if rate is None else 64 * 1024)
+        if not n:
+            break
+        received += n
+
+        # a slow client reads no faster than rate bytes per second
+        if rate is not None:
+            time.sleep(max(0.0, start + received / rate - time.perf_counter()))
+    conn.close()
+    results[index] = (received, time.perf_counter() - start)
+
+def benchmark(docroot, filename, clients, workers, slow_rate=None):
+    server = Server(HOST, 0, docroot, workers)
+    server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # listen before the clients start, the server thread may not have called start() yet
+    server.socket.listen()
+    port = server.socket.getsockname()[1]
+    thread = threading.Thread(target=run_server, args=(server,), daemon=True)
+    thread.start()
+
+    results = [None] * clients
+    threads = [threading.Thread(target=download, args=(port, filename, results, i, slow_rate if i == 0 else None)) for i in range(clients)]
+    start = time.perf_counter()
+    for i, client in enumerate(threads):
+        client.start()
+
+        # the slow client connects first
+        if i == 0 and slow_rate is not None:
+            time.sleep(0.1)
+    for client in threads:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    server.socket.close()
+    received = sum(size for size, _ in results)
+
+    # the latency of the other clients, the slow one takes as long as it takes
+    others = results[1:] if slow_rate is not None and clients > 1 else results
+    latencies = sorted(seconds for _, seconds in others)
+    return received / elapsed, latencies[len(latencies) // 2], latencies[-1]
+
+def main():
+    parser = argparse.ArgumentParser(description="Download throughput of the file server with many clients")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--size", type=int, default=32, help="file size in MB")
+    parser.add_argument("--workers", type=int, default=32, help="worker threads of the concurrent server")
+    parser.add_argument("--slow-rate", type=float, help="MB/s of a slow first client")
+    args = parser.parse_args()
+
+    docroot = tempfile.mkdtemp()
+    filename = "bench.bin"
+    with open(os.path.join(docroot, filename), "wb") as f:
+        f.write(os.urandom(args.size * 1024 * 1024))
+
+    # the server prints every connection, which would measure the terminal
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        rows = []
+        for clients in args.clients:
+            for name, workers in (("serial", None), ("workers", args.workers)):
+                slow_rate = args.slow_rate * 1024 * 1024 if args.slow_rate else None
+                rows.append((clients, name) + benchmark(docroot, filename, clients, workers, slow_rate))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(docroot)
+
+    print(f"{args.size} MB file, {args.workers} workers" + (f", first client at {args.slow_rate} MB/s" if args.slow_rate else ""))
+    print(f"{'clients':>8} {'server':<8} {'MB/s':>10} {'p50 s':>8} {'max s':>8}")
+    for clients, name, throughput, median, slowest in rows:
+        print(f"{clients:>8} {name:<8} {throughput / 1024 / 1024:>10.0f} {median:>8.2f} {slowest:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from client import Client
+from server import Server
+
+# receive throughput of one download over loopback, written to a file
+# recv: the old path, recv(1024) returns a new bytes object every call
+# recv_into: Client.receive_header and receive_file, one reused buffer, slices of it written to the file
+
+HOST = "127.0.0.1"
+
+def run_server(docroot, port_queue):
+    sys.stdout = open(os.devnull, "w")
+    server = Server(HOST, 0, docroot, workers=4)
+
+    # listen before the port is handed out, a client connecting before start() would be refused
+    server.socket.listen()
+    port_queue.put(server.socket.getsockname()[1])
+    server.start()
+
+def download_recv(port, filename, path, size):
+    client = Client(HOST, port)
+    client.socket.connect((HOST, port))
+    client.socket.send(f"download {filename}".encode())
+
+    # the header is split on bytes here too, only the receive loop is the old one
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += client.recv(size)
+    header, body = data.split(b"\r\n\r\n", 1)
+    file_size = int(client.parse_fields(header.decode())["file-size"])
+    with open(path, "wb") as f:
+        f.write(body)
+        total = len(body)
+        while total < file_size:
+            read = client.recv(size)
+            if not read:
+                break
+            f.write(read)
+            total += len(read)
+    client.disconnect()
+    return total
+
+def download_recv_into(port, filename, path, size):
+    client = Client(HOST, port)
+    client.socket.connect((HOST, port))
+    client.socket.send(f"download {filename}".encode())
+
+    buffer = bytearray(size)
+    header, body = client.receive_header(buffer)
+    file_size = int(client.parse_fields(header.decode())["file-size"])
+    with open(path, "wb") as f:
+        total = client.receive_file(f, file_size, body, buffer)
+    client.disconnect()
+    return total
+
+def measure(download, port, filename, path, size, repeat):
+    # the best of a few runs, the first one also warms the page cache of the server
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        total = download(port, filename, path, size)
+        best = min(best, time.perf_counter() - start)
+    return total / best
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive throughput of the file client by buffer size")
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    parser.add_argument("--buffers", type=int, nargs="+", default=[1024, 16384, 65536, 262144, 1048576])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    docroot = tempfile.mkdtemp()
+    filename = "bench.bin"
+    with open(os.path.join(docroot, filename), "wb") as f:
+        f.write(os.urandom(args.size * 1024 * 1024))
+    path = os.path.join(docroot, "copy.bin")
+
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_server, args=(docroot, port_queue), daemon=True)
+    process.start()
+    port = port_queue.get(timeout=10)
+
+    # the client prints every connection
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        rows = []
+        for size in args.buffers:
+            for name, download in (("recv", download_recv), ("recv_into", download_recv_into)):
+                rows.append((size, name, measure(download, port, filename, path, size, args.repeat)))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        process.terminate()
+        process.join()
+        shutil.rmtree(docroot)
+
+    print(f"{args.size} MB file, best of {args.repeat}")
+    print(f"{'buffer':>9} {'path':<10} {'MB/s':>8}")
+    for size, name, throughput in rows:
+        print(f"{size:>9} {name:<10} {throughput / 1024 / 1024:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
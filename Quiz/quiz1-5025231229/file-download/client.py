@@ -1,11 +1,34 @@
 import unittest 
 from unittest.mock import patch, MagicMock
+import io
 import os
+import re
 import socket
 import sys
+import threading
+import time
 from io import StringIO
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# a parallel download starts with INITIAL_CONNECTIONS connections, one byte range each
+# every ADAPT_INTERVAL seconds it splits the biggest range left for one more connection, up to MAX_CONNECTIONS
+# as long as the last connection added at least GROWTH of one connection's throughput to the total
+# a range smaller than 2 * MIN_SEGMENT is not split
+INITIAL_CONNECTIONS = 2
+MAX_CONNECTIONS = 16
+ADAPT_INTERVAL = 0.5
+GROWTH = 0.5
+MIN_SEGMENT = 1024 * 1024
+
+# every connection of a parallel download receives into its own buffer of this size
+SEGMENT_BUFFER = 256 * 1024
+
+# a download receives into one buffer of this size, reused for every recv, the header must fit in it
+RECV_BUFFER = 256 * 1024
+
+# positional writes let every connection write its range without a shared file position
+HAS_PWRITE = hasattr(os, 'pwrite')
+
 
 class Client:
     def __init__(self, host, port):
@@ -34,6 +57,40 @@ class Client:
         # 6. Receive data from the server and return it
         return self.socket.recv(size)
 
+    def receive_header(self, buffer):
+        # receive into buffer until the end of the header, the bytes are split before anything is decoded
+        # return the header bytes and a view of the body bytes received with it
+        # the body is None when the connection closed without a header, e.g. after an error message
+        view = memoryview(buffer)
+        filled = 0
+        while True:
+            # only the new bytes and the 3 before them can hold the delimiter
+            n = self.socket.recv_into(view[filled:])
+            if not n:
+                return bytes(view[:filled]), None
+            end = buffer.find(b"\r\n\r\n", max(0, filled - 3), filled + n)
+            filled += n
+            if end >= 0:
+                return bytes(view[:end]), view[end + 4:filled]
+            if filled == len(buffer):
+                raise ValueError(f'Header bigger than {len(buffer)} bytes')
+
+    def receive_file(self, f, size, body, buffer):
+        # write the body received with the header, then receive into buffer and write slices of it
+        # nothing is allocated or copied per recv, return the number of bytes written
+        written = min(len(body), size)
+        f.write(body[:written])
+
+        view = memoryview(buffer)
+        while written < size:
+            n = self.socket.recv_into(view)
+            if not n:
+                break
+            n = min(n, size - written)
+            f.write(view[:n])
+            written += n
+        return written
+
     def disconnect(self):
         # 7. Close the socket connection
         self.socket.close()
@@ -48,15 +105,233 @@ class Client:
 
         # get content from the split results
         content = split_results[1]
-        
-        # get filename from the header (use split string)
-        filename = header.split(',')[0].split(': ')[1]
 
-        # get filesize from the header (use split string)
-        filesize = int(header.split(',')[1].split(': ')[1])
+        fields = self.parse_fields(header)
+
+        # get filename from the header
+        filename = fields['file-name']
+
+        # get filesize from the header, the size of the range for a range
+        filesize = int(fields['file-size'])
         
         return filename, filesize, content 
 
+    def parse_fields(self, header):
+        # "name: value" fields, separated by a comma or a line break
+        fields = {}
+        for field in re.split(r",\r\n|,|\r\n", header):
+            if ': ' in field:
+                name, value = field.split(': ', 1)
+                fields[name] = value
+        return fields
+
+    def parse_range(self, header_content):
+        # start, end (excluded) and file size of a "file-range: start-end/size" field, None without one
+        fields = self.parse_fields(header_content.split("\r\n\r\n", 1)[0])
+        if 'file-range' not in fields:
+            return None
+        span, total = fields['file-range'].split('/')
+        start, end = span.split('-')
+        return int(start), int(end), int(total)
+
+def resume_offset(message):
+    # the size of a partial local file of a download command, 0 if there is none
+    # a command that names its own range is sent as it is
+    parts = message.strip().split(" ", 1)
+    if len(parts) != 2 or parts[0] != "download" or parts[1].rpartition(" ")[2].startswith("range="):
+        return 0
+    path = os.path.join(BASE_DIR, parts[1])
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+class Segment:
+    __slots__ = ('position', 'end')
+
+    def __init__(self, position, end):
+        # the next byte to receive, and the end of the range (excluded), which a split moves down
+        self.position = position
+        self.end = end
+
+class SegmentedDownload:
+    def __init__(self, host, port, filename, path=None, connections=INITIAL_CONNECTIONS, max_connections=MAX_CONNECTIONS, min_segment=MIN_SEGMENT):
+        self.host = host
+        self.port = port
+        self.filename = filename
+        self.path = path if path is not None else os.path.join(BASE_DIR, filename)
+        self.connections = connections
+        self.max_connections = max_connections
+        self.min_segment = min_segment
+
+        # the segments and the bytes received, shared by the connections
+        self.lock = threading.Lock()
+        self.segments = []
+        self.received = 0
+        self.errors = []
+
+        self.fd = None
+        self.threads = []
+
+        # connections still receiving, and an event set whenever one of them ends
+        self.running = 0
+        self.ended = threading.Event()
+
+    def request(self, start, count, buffer):
+        # connect, ask for a range and return the client and the body bytes received with the header, in buffer
+        client = Client(self.host, self.port)
+        client.connect()
+        client.socket.sendall(f"download {self.filename} range={start}-{count}".encode())
+
+        header, body = client.receive_header(buffer)
+        if body is None:
+            client.disconnect()
+            raise ConnectionError(header.decode(errors='replace') or 'Connection closed before the header')
+        file_range = client.parse_range(header.decode())
+        if file_range is None or file_range[0] != start:
+            client.disconnect()
+            raise ConnectionError(f'Unexpected header: {header.decode(errors="replace")}')
+        return client, body, file_range[2]
+
+    def run(self):
+        # an empty range tells the file size
+        client, _, filesize = self.request(0, 0, bytearray(4096))
+        client.disconnect()
+
+        # reserve the whole file, every connection writes its range in place
+        # into path + '.part', a file of the full size with holes is never left under the real name
+        part = self.path + '.part'
+        self.fd = os.open(part, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            os.ftruncate(self.fd, filesize)
+            if hasattr(os, 'posix_fallocate') and filesize:
+                try:
+                    os.posix_fallocate(self.fd, 0, filesize)
+                except OSError:
+                    pass
+
+            # equal ranges for the first connections
+            count = max(1, min(self.connections, filesize // self.min_segment))
+            bounds = [filesize * i // count for i in range(count + 1)]
+            for start, end in zip(bounds, bounds[1:]):
+                self.start_segment(Segment(start, end))
+
+            start_time = time.perf_counter()
+            self.adapt()
+            elapsed = time.perf_counter() - start_time
+        finally:
+            os.close(self.fd)
+
+        missing = sum(segment.end - segment.position for segment in self.segments)
+        if missing:
+            os.remove(part)
+            raise ConnectionError(f'{missing} bytes of {self.filename} are missing: {self.errors}')
+        os.replace(part, self.path)
+        return {'bytes': filesize, 'seconds': elapsed, 'connections': len(self.segments)}
+
+    def adapt(self):
+        # add connections while they add throughput, based on the throughput of one connection
+        last_received = 0
+        last_time = time.perf_counter()
+        last_rate = None
+        growing = True
+        while self.running:
+            # wake up every ADAPT_INTERVAL, or when a connection ends, so the end of the last one ends the download
+            self.ended.wait(ADAPT_INTERVAL)
+            self.ended.clear()
+
+            # a rate over less than ADAPT_INTERVAL is too noisy, measure on until then
+            now = time.perf_counter()
+            if now - last_time < ADAPT_INTERVAL:
+                continue
+            rate = (self.received - last_received) / (now - last_time)
+            last_received, last_time = self.received, now
+            active = self.running
+            if not growing or not active or len(self.threads) >= self.max_connections:
+                continue
+
+            # the last connection added less than GROWTH of one connection, more would not help
+            if last_rate is not None and rate < last_rate + GROWTH * last_rate / max(1, active - 1):
+                growing = False
+                continue
+
+            segment = self.split()
+            if segment is not None:
+                last_rate = rate
+                self.start_segment(segment)
+
+    def split(self):
+        # take the second half of the biggest range left, None if every range is too small
+        with self.lock:
+            biggest = max(self.segments, key=lambda segment: segment.end - segment.position)
+            left = biggest.end - biggest.position
+            if left < 2 * self.min_segment:
+                return None
+            middle = biggest.position + left // 2
+            segment = Segment(middle, biggest.end)
+            biggest.end = middle
+            return segment
+
+    def start_segment(self, segment):
+        self.segments.append(segment)
+        thread = threading.Thread(target=self.fetch, args=(segment,), daemon=True)
+        self.threads.append(thread)
+        with self.lock:
+            self.running += 1
+        thread.start()
+
+    def fetch(self, segment):
+        try:
+            self.fetch_range(segment)
+        finally:
+            with self.lock:
+                self.running -= 1
+            self.ended.set()
+
+    def fetch_range(self, segment):
+        # receive one range, again from where it stopped if the connection breaks
+        buffer = bytearray(SEGMENT_BUFFER)
+        view = memoryview(buffer)
+        for _ in range(3):
+            try:
+                client, data, _ = self.request(segment.position, segment.end - segment.position, buffer)
+            except OSError as e:
+                self.errors.append(str(e))
+                continue
+
+            try:
+                while True:
+                    # reserve the bytes before writing them, a split never hands them to another connection
+                    with self.lock:
+                        position = segment.position
+                        count = min(len(data), segment.end - position)
+                        segment.position += count
+                        self.received += count
+                    if count:
+                        self.write(data[:count], position)
+                    if segment.position >= segment.end:
+                        return
+
+                    n = client.socket.recv_into(buffer)
+                    if not n:
+                        break
+                    data = view[:n]
+            except OSError as e:
+                self.errors.append(str(e))
+            finally:
+                client.disconnect()
+
+    def write(self, data, position):
+        if HAS_PWRITE:
+            while data:
+                written = os.pwrite(self.fd, data, position)
+                data = data[written:]
+                position += written
+            return
+
+        # without pwrite the file position is shared, one write at a time
+        with self.lock:
+            os.lseek(self.fd, position, os.SEEK_SET)
+            while data:
+                data = data[os.write(self.fd, data):]
+
 def start_client():
     # 1. Create a Client object
     client = Client("localhost", 65432)
@@ -67,14 +342,21 @@ def start_client():
     # 3. Send a message to the server and receive a response
     message = input("Enter a message: ")
 
-    # use send_message method from Client class
-    status = client.send_message(message)
-    print(status)
+    # a partial file from a broken download is resumed from its size
+    offset = resume_offset(message)
+    if offset:
+        print(f"Resuming from byte {offset}")
+        message = f"{message.strip()} range={offset}-"
+
+    # the answer is received as bytes, the body may be binary
+    client.socket.send(message.encode())
+    buffer = bytearray(RECV_BUFFER)
+    header, body = client.receive_header(buffer)
 
     # 4. Check if the response isn't a header
     # 4.1 If it is, print the response and exit
-    if "\r\n" not in status:
-        print(status)
+    if body is None:
+        print(header.decode(errors='replace'))
         
         # close socket or disconnect
         client.disconnect()
@@ -82,44 +364,31 @@ def start_client():
         sys.exit(1)
 
     # 5. Parse the header
-    # use parse_header method from Client class
-    file_name, file_size, content = client.parse_header(status)
+    header = header.decode()
+    fields = client.parse_fields(header)
+    file_name = fields['file-name']
+    file_size = int(fields['file-size'])
 
     # define file path: join base directory and file name
     file_path = os.path.join(BASE_DIR, file_name)
 
-    # 6. Receive the file from the server and save it
-    total_data = 0
+    # a range is written at its place in the file, what was after it is stale
+    file_range = client.parse_range(header)
+    start = file_range[0] if file_range else 0
+    if file_range and file_range[0] == file_range[1] == file_range[2]:
+        print(f"{file_name} is already complete")
 
-    # use len() function to get content length
-    content_length = len(content.encode())
-        
-    with open(file_path, 'wb') as f:
-        # check content length
-        # write to file if content length > 0
-        if content_length > 0:
-            total_data = content_length
-
-            # write to file
-            f.write(content.encode())
-
-        while True:
-            # check if total data equal to file size
-            if total_data == file_size:
-                break
-
-            # continue receiving data
-            read = client.recv(1024)
+    # 6. Receive the file from the server and save it
+    with open(file_path, 'r+b' if start else 'wb') as f:
+        f.truncate(start)
+        f.seek(start)
+        received = client.receive_file(f, file_size, body, buffer)
 
-            # if total data equal to file size, break
-            if total_data + len(read) >= file_size:
-                print(f"{file_name} has been received successfully!")
-                f.write(read)
-                break
-            
-            # write to the file the bytes we just received
-            f.write(read)
-            total_data += len(read)
+    if received == file_size:
+        print(f"{file_name} has been received successfully!")
+    else:
+        # the connection broke, the partial file is resumed by the next download
+        print(f"{file_name} is incomplete, download it again to resume")
 
     # 7. Close the connection
     # use diconnect method from Client class 
@@ -135,6 +404,15 @@ class NullWriter(StringIO):
     def write(self, txt):
         pass
 
+def recv_into(chunks):
+    # side effect of a mocked recv_into: copy the next chunk into the buffer, then b'' forever
+    chunks = list(chunks)
+    def side_effect(buffer, *args):
+        chunk = chunks.pop(0) if chunks else b''
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+    return side_effect
+
 def assert_equal(parameter1, parameter2):
     if parameter1 == parameter2:
         print(f'test attribute passed: {parameter1} is equal to {parameter2}')
@@ -187,6 +465,106 @@ class TestClient(unittest.TestCase):
         print(f"close called with: {mock_socket_instance.close.call_args}")
         print()
 
+    def test_parse_range(self):
+        print('Testing parse range ...')
+        client = Client('localhost', 65432)
+        header_content = "file-name: example.txt,\r\nfile-size: 24\r\nfile-range: 1000-1024/1024\r\n\r\ntest content"
+        self.assertEqual(client.parse_header(header_content), ('example.txt', 24, 'test content'))
+        self.assertEqual(client.parse_range(header_content), (1000, 1024, 1024))
+        self.assertEqual(client.parse_range("file-name: example.txt,\r\nfile-size: 1024\r\n\r\n"), None)
+        print()
+
+        client.disconnect()
+
+    @patch('socket.socket')
+    def test_receive_binary(self, mock_socket_class):
+        print('Testing binary receive ...')
+        mock_socket_instance = mock_socket_class.return_value
+        content = bytes(range(256)) * 4
+
+        # the header and the start of the body in one recv, the body is not valid UTF-8
+        data = b"file-name: data.bin,\r\nfile-size: 1024\r\n\r\n" + content + b"extra"
+        mock_socket_instance.recv_into.side_effect = recv_into([data[:10], data[10:100], data[100:600], data[600:]])
+        client = Client('localhost', 65432)
+        buffer = bytearray(512)
+        header, body = client.receive_header(buffer)
+        self.assertEqual(header, b"file-name: data.bin,\r\nfile-size: 1024")
+
+        f = io.BytesIO()
+        self.assertEqual(client.receive_file(f, 1024, body, buffer), 1024)
+        self.assertEqual(f.getvalue(), content)
+        print(f"received: {len(f.getvalue())} bytes")
+
+        # an error message is not a header
+        mock_socket_instance.recv_into.side_effect = recv_into([b"File x doesn't exist", b""])
+        self.assertEqual(client.receive_header(bytearray(512)), (b"File x doesn't exist", None))
+        print()
+
+    @patch('builtins.input', return_value='download partial.bin')
+    @patch('socket.socket')
+    def test_resume(self, mock_socket_class, mock_input):
+        print('Testing resume ...')
+        path = os.path.join(BASE_DIR, 'partial.bin')
+        with open(path, 'wb') as f:
+            f.write(b'0123456')
+        try:
+            # the server sends the rest of the file after the 7 bytes on disk
+            mock_socket_instance = mock_socket_class.return_value
+            mock_socket_instance.recv_into.side_effect = recv_into([b"file-name: partial.bin,\r\nfile-size: 3\r\nfile-range: 7-10/10\r\n\r\n78", b"9"])
+            with patch('sys.stdout', new_callable=StringIO):
+                start_client()
+            mock_socket_instance.send.assert_called_with(b'download partial.bin range=7-')
+
+            # a command with its own range is not resumed
+            self.assertEqual(resume_offset('download partial.bin range=2-3'), 0)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'0123456789')
+            print(f"send called with: {mock_socket_instance.send.call_args}")
+        finally:
+            os.remove(path)
+        print()
+
+    def test_segmented_download(self):
+        print('Testing segmented download ...')
+        from server import Server
+
+        # a real server on loopback, serving one file from a directory
+        docroot = os.path.join(BASE_DIR, 'segments-docroot')
+        os.makedirs(docroot, exist_ok=True)
+        content = os.urandom(300000)
+        with open(os.path.join(docroot, 'big.bin'), 'wb') as f:
+            f.write(content)
+        path = os.path.join(docroot, 'copy.bin')
+        server = Server('127.0.0.1', 0, docroot, workers=8)
+        server.socket.listen()
+        thread = threading.Thread(target=server.start, daemon=True)
+        try:
+            with patch('sys.stdout', new_callable=StringIO):
+                thread.start()
+
+                # small segments, so the ranges are split while the download runs
+                download = SegmentedDownload('127.0.0.1', server.socket.getsockname()[1], 'big.bin', path, connections=3, min_segment=16384)
+                result = download.run()
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual(result['bytes'], len(content))
+            self.assertGreaterEqual(result['connections'], 3)
+            self.assertFalse(os.path.exists(path + '.part'))
+            print(f"connections: {result['connections']}")
+
+            # a failed download leaves nothing behind, not a full-size file that looks complete
+            os.remove(path)
+            download = SegmentedDownload('127.0.0.1', server.socket.getsockname()[1], 'big.bin', path, connections=3, min_segment=16384)
+            with patch('sys.stdout', new_callable=StringIO), patch.object(download, 'fetch_range'), self.assertRaises(ConnectionError):
+                download.run()
+            self.assertEqual(os.listdir(docroot), ['big.bin'])
+        finally:
+            server.socket.close()
+            for name in os.listdir(docroot):
+                os.remove(os.path.join(docroot, name))
+            os.rmdir(docroot)
+        print()
+
     def test_parse_header(self):
         print('Testing parse header ...')
         client = Client('localhost', 65432)
@@ -237,3 +615,6 @@ if __name__ == '__main__':
 
     # Uncomment this if you want to run the client program, not running the unit test
     #start_client()
+
+    # or download a big file over many connections at once
+    #print(SegmentedDownload("localhost", 65432, "big.bin").run())
@@ -1,5 +1,10 @@
+import os
+import shutil
 import socket
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, MagicMock
 from io import StringIO
 
@@ -10,12 +15,50 @@ files = {
     "xlsx.zip": "Content of xlsx.zip"
 }
 
+# seconds a worker waits for a silent client before it gives up on it
+CLIENT_TIMEOUT = 30
+
+def parse_range(filename):
+    # "download <filename> [range=<offset>-[<length>]]", the last token is the byte range to send
+    # a file name may end in numbers, so only a token starting with "range=" is a range
+    # return the filename, the offset (None for the whole file) and the length (None for the rest of the file)
+    name, _, token = filename.rpartition(" ")
+    if name and token.startswith("range="):
+        offset, dash, length = token[len("range="):].partition("-")
+        if dash and offset.isdecimal() and (length.isdecimal() or not length):
+            return name, int(offset), int(length) if length else None
+    return filename, None, None
+
+def make_header(filename, filesize, offset=None, count=None):
+    # the whole file keeps the header of the problem definition
+    if offset is None:
+        return f"file-name: {filename},\r\nfile-size: {filesize}\r\n\r\n"
+
+    # a range: file-size is the number of bytes sent, file-range is where they are, end excluded, and the whole size
+    return f"file-name: {filename},\r\nfile-size: {count}\r\nfile-range: {offset}-{offset + count}/{filesize}\r\n\r\n"
+
+def range_count(filesize, offset, length):
+    # number of bytes to send from offset, None if the offset is past the end of the file
+    if offset is None:
+        return filesize
+    if offset > filesize:
+        return None
+    if length is None:
+        return filesize - offset
+    return min(length, filesize - offset)
+
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, docroot=None, workers=None):
         # Define host and port
         self.host = host
         self.port = port
 
+        # serve the files of this directory from disk, or the files dictionary when it is None
+        self.docroot = docroot
+
+        # serve up to this many clients at the same time, or one after the other when it is None
+        self.workers = workers
+
         # create socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -26,50 +69,145 @@ class Server:
         # Listen for incoming connections
         self.socket.listen()
 
+        if self.workers is not None:
+            self.start_workers()
+            return
+
         while True:
             # Accept incoming connections
             conn, addr = self.socket.accept()
             print(f"Connected by {addr}")
 
-            # Receive command and filename from client
-            data = conn.recv(1024).decode()
+            # a client may close early, e.g. a segment of a parallel download, which only ends its connection
+            self.serve(conn)
+
+    def start_workers(self):
+        # every connection is served by a thread of the pool, so a slow client only holds its own thread
+        # sendall and sendfile release the GIL while they wait for the socket
+        # a connection is accepted only when a worker is free, the others wait in the listen backlog
+        free = threading.Semaphore(self.workers)
+        with ThreadPoolExecutor(self.workers) as pool:
+            while True:
+                free.acquire()
+                try:
+                    conn, addr = self.socket.accept()
+                except BaseException:
+                    free.release()
+                    raise
+                print(f"Connected by {addr}")
+
+                future = pool.submit(self.serve, conn)
+                future.add_done_callback(lambda _: free.release())
+
+    def serve(self, conn):
+        # handle one connection, an error only closes this connection
+        # a request that is not UTF-8 raises UnicodeDecodeError, a ValueError like the other bad requests
+        conn.settimeout(CLIENT_TIMEOUT)
+        try:
+            self.handle(conn)
+        except (OSError, ValueError) as e:
+            print(f"Connection failed: {e}")
+        finally:
+            # closing twice does nothing, handle closes it on its own paths
+            conn.close()
 
-            # get command and filename
-            parts = data.strip().split(" ", 1)
-            if len(parts) != 2:
-                conn.sendall("Unknown command".encode())
-                conn.close()
-                continue
+    def handle(self, conn):
+        # Receive command and filename from client
+        data = conn.recv(1024).decode()
 
-            command, filename = parts
-            print(command, filename)
+        # get command and filename
+        parts = data.strip().split(" ", 1)
+        if len(parts) != 2:
+            conn.sendall("Unknown command".encode())
+            conn.close()
+            return
 
-            if command != "download":
-                # send "Unknown command"
-                conn.sendall("Unknown command".encode())
-                conn.close()
-                continue
+        command, filename = parts
+        print(command, filename)
 
-            if filename not in files:
-                # send "File {filename} doesn't exist"
-                conn.sendall(f"File {filename} doesn't exist".encode())
-                conn.close()
-                continue
+        if command != "download":
+            # send "Unknown command"
+            conn.sendall("Unknown command".encode())
+            conn.close()
+            return
 
-            # Send the header to the client
-            file_content = files[filename]
+        # an optional byte range, e.g. to resume a broken download
+        filename, offset, length = parse_range(filename)
 
-            # get filesize using len() function
-            filesize = len(file_content)
+        if self.docroot is not None:
+            self.send_file(conn, filename, offset, length)
+            conn.close()
+            return
 
-            # make header based on the given problem definition
-            header = f"file-name: {filename},\r\nfile-size: {filesize}\r\n\r\n"
+        if filename not in files:
+            # send "File {filename} doesn't exist"
+            conn.sendall(f"File {filename} doesn't exist".encode())
+            conn.close()
+            return
 
-            # Send BOTH the header AND file content to the client
-            conn.sendall(header.encode() + file_content.encode())
+        # Send the header to the client
+        file_content = files[filename].encode()
 
-            # close socket
+        # get filesize using len() function
+        filesize = len(file_content)
+
+        count = range_count(filesize, offset, length)
+        if count is None:
+            conn.sendall(f"Range {offset}- of {filename} is not available".encode())
             conn.close()
+            return
+
+        # make header based on the given problem definition
+        header = make_header(filename, filesize, offset, count)
+
+        # Send BOTH the header AND file content to the client
+        start = offset or 0
+        conn.sendall(header.encode() + file_content[start:start + count])
+
+        # close socket
+        conn.close()
+
+    def open_file(self, filename):
+        # open a file of the docroot, None if it does not exist
+        # the path must stay inside the docroot, "../" and absolute names are refused
+        # a name the OS cannot have (an embedded null byte) raises ValueError, it does not exist either
+        root = os.path.realpath(self.docroot)
+        try:
+            path = os.path.realpath(os.path.join(root, filename))
+            if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+                return None
+        except ValueError:
+            return None
+        try:
+            return open(path, "rb")
+        except OSError:
+            return None
+
+    def send_file(self, conn, filename, offset=None, length=None):
+        f = self.open_file(filename)
+        if f is None:
+            # send "File {filename} doesn't exist"
+            conn.sendall(f"File {filename} doesn't exist".encode())
+            return
+
+        with f:
+            # get filesize from the open file, so it matches what is sent
+            filesize = os.fstat(f.fileno()).st_size
+
+            count = range_count(filesize, offset, length)
+            if count is None:
+                conn.sendall(f"Range {offset}- of {filename} is not available".encode())
+                return
+
+            # make header based on the given problem definition
+            header = make_header(filename, filesize, offset, count)
+            conn.sendall(header.encode())
+
+            # the kernel sends the file from the page cache (os.sendfile), the body is never read into Python
+            # so memory stays the same whatever the file size
+            # a count of 0 would mean the rest of the file to sendfile, an empty range sends nothing
+            if count:
+                conn.sendfile(f, offset or 0, count)
 
 
 # A 'null' stream that discards anything written to it
@@ -226,6 +364,92 @@ class TestServer(unittest.TestCase):
 
         conn.close()
 
+    @patch('socket.socket')
+    def test_docroot_file(self, mock_socket):
+        docroot = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(docroot, "big.bin"), "wb") as f:
+                f.write(b"\x00\xff" * 50000)
+
+            server = Server("localhost", 65432, docroot)
+            mock_conn = MagicMock()
+            mock_conn.recv.return_value = b"download big.bin"
+            server.handle(mock_conn)
+
+            # the header, then the open file handed to sendfile
+            mock_conn.sendall.assert_called_once_with(b"file-name: big.bin,\r\nfile-size: 100000\r\n\r\n")
+            sent, offset, count = mock_conn.sendfile.call_args[0]
+            self.assertEqual((sent.name, offset, count), (os.path.join(os.path.realpath(docroot), "big.bin"), 0, 100000))
+            mock_conn.close.assert_called()
+
+            # the rest of the file from an offset
+            mock_conn = MagicMock()
+            mock_conn.recv.return_value = b"download big.bin range=99000-"
+            server.handle(mock_conn)
+            mock_conn.sendall.assert_called_once_with(b"file-name: big.bin,\r\nfile-size: 1000\r\nfile-range: 99000-100000/100000\r\n\r\n")
+            self.assertEqual(mock_conn.sendfile.call_args[0][1:], (99000, 1000))
+
+            # a name outside the docroot does not exist
+            mock_conn = MagicMock()
+            mock_conn.recv.return_value = b"download ../big.bin"
+            server.handle(mock_conn)
+            mock_conn.sendall.assert_called_once_with(b"File ../big.bin doesn't exist")
+            mock_conn.sendfile.assert_not_called()
+
+            # so is a name with a null byte
+            mock_conn = MagicMock()
+            mock_conn.recv.return_value = b"download big\x00.bin"
+            server.handle(mock_conn)
+            mock_conn.sendall.assert_called_once_with(b"File big\x00.bin doesn't exist")
+            print("test_docroot_file passed: File sent with sendfile.")
+        finally:
+            shutil.rmtree(docroot)
+
+    @patch('socket.socket')
+    def test_range(self, mock_socket):
+        self.assertEqual(parse_range("729.txt"), ("729.txt", None, None))
+        self.assertEqual(parse_range("729.txt range=5-"), ("729.txt", 5, None))
+        self.assertEqual(parse_range("my file.txt range=5-3"), ("my file.txt", 5, 3))
+
+        # numbers at the end are part of the name
+        self.assertEqual(parse_range("report 2024"), ("report 2024", None, None))
+        self.assertEqual(parse_range("track 01 02"), ("track 01 02", None, None))
+        self.assertEqual(parse_range("729.txt range=5"), ("729.txt range=5", None, None))
+
+        server = Server("localhost", 65432)
+        mock_conn = MagicMock()
+        mock_conn.recv.return_value = b"download 729.txt range=11-4"
+        server.handle(mock_conn)
+        mock_conn.sendall.assert_called_once_with(b"file-name: 729.txt,\r\nfile-size: 4\r\nfile-range: 11-15/18\r\n\r\n729.")
+
+        # an offset past the end of the file is refused, the end itself is an empty range
+        mock_conn = MagicMock()
+        mock_conn.recv.return_value = b"download 729.txt range=19-"
+        server.handle(mock_conn)
+        mock_conn.sendall.assert_called_once_with(b"Range 19- of 729.txt is not available")
+        self.assertEqual(range_count(18, 18, None), 0)
+        print("test_range passed: Ranges parsed and sent.")
+
+    @patch('socket.socket')
+    def test_workers(self, mock_socket):
+        server = Server("localhost", 65432, workers=2)
+        mock_conns = [MagicMock() for _ in range(3)]
+        for mock_conn in mock_conns:
+            mock_conn.recv.return_value = b"download 729.txt"
+
+        # a broken connection or a request that is not UTF-8 does not stop the others, both are closed
+        mock_conns[1].sendall.side_effect = ConnectionResetError
+        mock_conns[0].recv.return_value = b"download \xff.txt"
+        server.socket.accept.side_effect = [(mock_conn, ("127.0.0.1", 5000 + i)) for i, mock_conn in enumerate(mock_conns)] + [KeyboardInterrupt]
+        with self.assertRaises(KeyboardInterrupt):
+            server.start()
+
+        for mock_conn in mock_conns:
+            mock_conn.settimeout.assert_called_with(CLIENT_TIMEOUT)
+            mock_conn.close.assert_called()
+        mock_conns[2].sendall.assert_called_with(f"file-name: 729.txt,\r\nfile-size: {len(files['729.txt'])}\r\n\r\n{files['729.txt']}".encode())
+        print("test_workers passed: Every connection served by the pool.")
+
     @patch('socket.socket')
     def test_attribute(self, mock_socket):
         server = Server("localhost", 65432)
@@ -268,6 +492,10 @@ if __name__ == "__main__":
     # server = Server("localhost", 65432)
     # server.start()
 
+    # or serve the files of a directory, many clients at the same time
+    # server = Server("localhost", 65432, docroot=os.path.join(os.path.dirname(__file__), "files"), workers=32)
+    # server.start()
+
     # run unit test
     # uncomment this before submitting to domjudge
     runner = unittest.TextTestRunner(stream=NullWriter())
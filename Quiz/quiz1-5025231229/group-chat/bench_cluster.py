@@ -0,0 +1,91 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from benchmark import HOST
+from loadgen import LoadGenerator, process_cpu_seconds
+from server import ChatServer
+
+# connected users of a cluster of chat servers, one process per server, all on this host
+# every server has the same number of users and the cluster gets the same message rate whatever its size
+# a server fans a message out to its own users only and relays it on a few links, so its work stays the same
+# flat CPU per server while the users grow with the servers is linear scaling
+
+def run_node(port_queue, peers):
+    sys.stdout = open(os.devnull, 'w')
+    logging.disable(logging.WARNING)
+
+    # the rate limits would measure the limits, not the cluster
+    server = ChatServer(HOST, 0, 'selectors', message_rate=None, byte_rate=None, cluster_port=0, cluster_peers=peers)
+    port_queue.put((server.port, server.cluster_port))
+
+    # main_loop wakes up every timer tick, for the idle pings and the link retries
+    server.main_loop()
+
+def start_cluster(nodes):
+    # a binary tree of links: server i links to server (i - 1) // 2, a message crosses at most 2 log2(nodes) links
+    port_queue = multiprocessing.Queue()
+    processes = []
+    addresses = []
+    for i in range(nodes):
+        peers = [(HOST, addresses[(i - 1) // 2][1])] if i else []
+        process = multiprocessing.Process(target=run_node, args=(port_queue, peers), daemon=True)
+        process.start()
+        processes.append(process)
+        addresses.append(port_queue.get(timeout=10))
+    return processes, [port for port, _ in addresses]
+
+def benchmark(nodes, users, rate, duration):
+    processes, ports = start_cluster(nodes)
+    generator = LoadGenerator(HOST, ports, users * nodes, rate, duration)
+    try:
+        # give the links time to connect before the users
+        time.sleep(0.5)
+        generator.connect()
+        cpu_before = [process_cpu_seconds(process.pid) for process in processes]
+        cpu_start = time.perf_counter()
+        results = generator.run()
+        cpu_after = [process_cpu_seconds(process.pid) for process in processes]
+        cpu_elapsed = time.perf_counter() - cpu_start
+    finally:
+        generator.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    if None not in cpu_before and None not in cpu_after:
+        results['server_cpu_percent'] = [(after - before) / cpu_elapsed * 100 for before, after in zip(cpu_before, cpu_after)]
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Users and CPU of a local cluster of chat servers')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--users', type=int, default=100, help='connected users per server')
+    parser.add_argument('--rate', type=float, default=50, help='messages per second over the whole cluster')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of sending')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    print(f'{args.users} users per server, {args.rate:.0f} messages/s, {args.duration:.0f}s')
+    print(f"{'servers':>8} {'users':>7} {'deliv/s':>10} {'delivered':>10} {'p50':>9} {'p99':>9} {'cpu/server':>11} {'cpu max':>8}")
+    report = []
+    for nodes in args.nodes:
+        results = benchmark(nodes, args.users, args.rate, args.duration)
+        cpu = results.get('server_cpu_percent', [0.0])
+        latency = results['latency_ms']
+        delivered = results['delivered'] / max(1, results['expected_deliveries']) * 100
+        print(f"{nodes:>8} {nodes * args.users:>7} {results['deliveries_per_sec']:>10.0f} {delivered:>9.1f}% "
+              f"{latency['p50']:>7.2f}ms {latency['p99']:>7.2f}ms {sum(cpu) / len(cpu):>10.1f}% {max(cpu):>7.1f}%")
+        report.append({'servers': nodes, 'users': nodes * args.users, 'results': results})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
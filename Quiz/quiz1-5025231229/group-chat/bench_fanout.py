@@ -0,0 +1,57 @@
+import argparse
+import time
+import tracemalloc
+
+from protocol import FRAME_MESSAGE, HEADER, encode_frame
+
+# compare how the chat server builds one broadcast frame
+# old: decode nickname and payload, format a str, encode it again, add the header
+# new: header + cached b'user: ' prefix + received payload, sent with sendmsg
+# the fan-out itself is the same in both paths: one reference to the frame per recipient queue
+
+def old_frame(user, message):
+    return encode_frame(f"{user.decode()}: {message.decode()}".encode())
+
+def new_frame(prefix, message):
+    return (HEADER.pack(len(prefix) + len(message), FRAME_MESSAGE), prefix, message)
+
+def measure_time(build, key, message, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        build(key, message)
+    return (time.perf_counter() - start) / iterations * 1e9
+
+def measure_memory(build, key, message, iterations):
+    # peak of traced memory while one frame is built, above what was traced before
+    # temporary objects that are freed right away still count, because they are alive at the peak
+    tracemalloc.start()
+    total = 0
+    for _ in range(iterations):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        build(key, message)
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - current
+    tracemalloc.stop()
+    return total / iterations
+
+def main():
+    parser = argparse.ArgumentParser(description='Allocations of the chat broadcast frame, old and new')
+    parser.add_argument('--size', type=int, default=200, help='message size in bytes')
+    parser.add_argument('--iterations', type=int, default=100000)
+    args = parser.parse_args()
+
+    user = b'nickname'
+    prefix = user + b': '
+    message = b'x' * args.size
+
+    print(f'{args.size} byte messages')
+    print(f"{'path':<6} {'ns/msg':>10} {'bytes allocated/msg':>20}")
+    for name, build, key in (('old', old_frame, user), ('new', new_frame, prefix)):
+        nanoseconds = measure_time(build, key, message, args.iterations)
+        allocated = measure_memory(build, key, message, args.iterations // 10)
+        print(f'{name:<6} {nanoseconds:>10.0f} {allocated:>20.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import logging
+import time
+
+from server import ChatServer, OutboundQueue
+
+# time /msg delivery with many connected users
+# index: ChatServer.private, which finds the user in the nickname index
+# scan: the same lookup done the old way, a linear scan of clients for the nickname
+
+class StubSocket:
+    # stands in for a client socket, every send is accepted in full
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+
+def add_users(server, count):
+    # the state handshake() keeps for a client, without a real connection
+    for i in range(count):
+        client_socket = StubSocket()
+        user = f'user{i}'.encode()
+        server.clients[client_socket] = user
+        server.nicknames[user] = client_socket
+        server.queues[client_socket] = OutboundQueue()
+
+def scan(server, nickname):
+    for client_socket, user in server.clients.items():
+        if user == nickname:
+            return client_socket
+    return None
+
+def measure(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description='Private message lookup with many connected users')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    print(f"{'users':>8} {'index ns/msg':>13} {'scan ns/lookup':>15}")
+    for count in args.users:
+        server = ChatServer('127.0.0.1', 0)
+        add_users(server, count)
+        sender = next(iter(server.clients))
+
+        # the last user is the worst case for the scan
+        target = f'user{count - 1}'.encode()
+        indexed = measure(lambda: server.private(sender, target, b'hi\n'), args.iterations)
+        scanned = measure(lambda: scan(server, target), max(10, args.iterations // 100))
+        print(f'{count:>8} {indexed:>13.0f} {scanned:>15.0f}')
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import time
+
+from protocol import FRAME_PING, FRAME_PONG, FrameDecoder, encode_frame
+from server import AsyncChatServer, ChatServer
+
+HOST = '127.0.0.1'
+
+def run_server(backend, port_queue):
+    # the servers print every message, which would measure the terminal, not the server
+    sys.stdout = open(os.devnull, 'w')
+
+    if backend == 'asyncio':
+        async def main():
+            server = AsyncChatServer(HOST, 0)
+            await server.start()
+            port_queue.put(server.port)
+            await server.server.serve_forever()
+
+        asyncio.run(main())
+    else:
+        # the rate limits would measure the limits, not the server
+        # main_loop wakes up every timer tick, so the idle pings go out on time and the load clients can answer them
+        server = ChatServer(HOST, 0, backend, message_rate=None, byte_rate=None)
+        port_queue.put(server.port)
+        server.main_loop()
+
+def percentile(values, p):
+    # nearest-rank percentile of a sorted list
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * p / 100))
+    return values[index]
+
+def run_clients(port, clients, messages, window):
+    selector = selectors.DefaultSelector()
+    sockets = []
+    decoders = {}
+
+    # connect every client and send its nickname
+    for i in range(clients):
+        client_socket = socket.create_connection((HOST, port))
+        client_socket.sendall(encode_frame(f'bench{i}'.encode()))
+        selector.register(client_socket, selectors.EVENT_READ)
+        sockets.append(client_socket)
+        decoders[client_socket] = FrameDecoder()
+
+    # warm up: repeat a message from the first client until every other client receives it
+    # after that every nickname has been handled by the server
+    warm = set()
+    while len(warm) < clients - 1:
+        sockets[0].sendall(encode_frame(b'warmup'))
+        for key, _ in selector.select(0.05):
+            if decoders[key.fileobj].feed(key.fileobj.recv(65536)):
+                warm.add(key.fileobj)
+
+    # key: message id, value: [send time, deliveries so far]
+    in_flight = {}
+    delivery_latencies = []
+    fanout_latencies = []
+    expected = clients - 1
+    sent = 0
+    done = 0
+
+    start = time.perf_counter()
+    while done < messages:
+        # keep at most `window` messages in flight, sent round-robin by the clients
+        while sent < messages and len(in_flight) < window:
+            sender = sockets[sent % clients]
+            in_flight[sent] = [time.perf_counter(), 0]
+            sender.sendall(encode_frame(f'{sent}\n'.encode()))
+            sent += 1
+
+        for key, _ in selector.select(1):
+            now = time.perf_counter()
+            for kind, payload in decoders[key.fileobj].feed(key.fileobj.recv(65536)):
+                # a client that waits long for its turn is pinged, it is closed if it does not answer
+                if kind == FRAME_PING:
+                    key.fileobj.sendall(encode_frame(b'', FRAME_PONG))
+                    continue
+
+                # payload: "benchN: <message id>\n", warm-up leftovers are ignored
+                text = payload.split(b': ', 1)[1]
+                if text == b'warmup':
+                    continue
+
+                message_id = int(text)
+                entry = in_flight[message_id]
+                entry[1] += 1
+                delivery_latencies.append(now - entry[0])
+
+                # the fan-out of a message is complete when every other client has it
+                if entry[1] == expected:
+                    fanout_latencies.append(now - entry[0])
+                    del in_flight[message_id]
+                    done += 1
+    elapsed = time.perf_counter() - start
+
+    for client_socket in sockets:
+        selector.unregister(client_socket)
+        client_socket.close()
+    selector.close()
+
+    delivery_latencies.sort()
+    fanout_latencies.sort()
+    return {
+        'messages_per_sec': messages / elapsed,
+        'deliveries_per_sec': len(delivery_latencies) / elapsed,
+        'delivery_p50_ms': percentile(delivery_latencies, 50) * 1000,
+        'delivery_p99_ms': percentile(delivery_latencies, 99) * 1000,
+        'fanout_p50_ms': percentile(fanout_latencies, 50) * 1000,
+        'fanout_p99_ms': percentile(fanout_latencies, 99) * 1000,
+    }
+
+def benchmark(backend, clients, messages, window):
+    # run the server in its own process so it gets its own core
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_server, args=(backend, port_queue), daemon=True)
+    process.start()
+    try:
+        port = port_queue.get(timeout=10)
+        return run_clients(port, clients, messages, window)
+    finally:
+        process.terminate()
+        process.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the selectors and asyncio chat servers')
+    parser.add_argument('--clients', type=int, default=50, help='number of simulated clients')
+    parser.add_argument('--messages', type=int, default=2000, help='number of messages to send')
+    parser.add_argument('--window', type=int, default=32, help='maximum number of messages in flight')
+    parser.add_argument('--backends', nargs='+', default=['selectors', 'asyncio'])
+    args = parser.parse_args()
+
+    print(f'{args.clients} clients, {args.messages} messages, window {args.window}')
+    print(f"{'backend':<10} {'msg/s':>10} {'deliv/s':>12} {'deliv p50':>10} {'deliv p99':>10} {'fanout p50':>11} {'fanout p99':>11}")
+    for backend in args.backends:
+        result = benchmark(backend, args.clients, args.messages, args.window)
+        print(f"{backend:<10} {result['messages_per_sec']:>10.0f} {result['deliveries_per_sec']:>12.0f} "
+              f"{result['delivery_p50_ms']:>8.2f}ms {result['delivery_p99_ms']:>8.2f}ms "
+              f"{result['fanout_p50_ms']:>9.2f}ms {result['fanout_p99_ms']:>9.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
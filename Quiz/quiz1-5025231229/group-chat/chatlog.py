@@ -0,0 +1,388 @@
+import bisect
+import logging
+import os
+import queue
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from collections import deque
+from io import StringIO
+
+# every broadcast is one record of the log
+# record: time (8 bytes, float seconds), room name length (1 byte), text length (4 bytes), room name, text
+RECORD = struct.Struct('!dBI')
+
+# the sparse index of a segment: time of a record and its position in the segment
+INDEX_ENTRY = struct.Struct('!dQ')
+
+# a segment is closed and a new one started once it is bigger than SEGMENT_SIZE
+# the index has one entry every INDEX_INTERVAL bytes, so a query reads at most that much before its first record
+SEGMENT_SIZE = 16 * 1024 * 1024
+INDEX_INTERVAL = 4096
+
+# the writer thread calls fsync at most every FSYNC_INTERVAL seconds, 0 after every batch, None leaves it to the OS
+FSYNC_INTERVAL = 1.0
+
+# a query reads the segments in blocks of this many bytes
+READ_SIZE = 64 * 1024
+
+logger = logging.getLogger('group-chat')
+
+def encode_record(timestamp, room, text):
+    return RECORD.pack(timestamp, len(room), len(text)) + room + text
+
+def read_records(path, start, end):
+    # yield (position, time, room, text) of every whole record between start and end
+    # the file is read in blocks, so a query that stops early reads little
+    with open(path, 'rb') as f:
+        f.seek(start)
+        buffer = bytearray()
+
+        # file position of buffer[0]
+        offset = start
+        while True:
+            block = f.read(min(READ_SIZE, end - offset - len(buffer)))
+            if not block:
+                return
+            buffer += block
+
+            consumed = 0
+            while len(buffer) - consumed >= RECORD.size:
+                timestamp, room_length, length = RECORD.unpack_from(buffer, consumed)
+                room_start = consumed + RECORD.size
+                stop = room_start + room_length + length
+
+                # wait for the next block, a record may be bigger than one block
+                if stop > len(buffer):
+                    break
+
+                yield offset + consumed, timestamp, bytes(buffer[room_start:room_start + room_length]), bytes(buffer[room_start + room_length:stop])
+                consumed = stop
+
+            del buffer[:consumed]
+            offset += consumed
+
+class Segment:
+    def __init__(self, directory, base):
+        # base: position of the first byte of the segment in the whole log, also the file name
+        self.base = base
+        self.path = os.path.join(directory, f'{base:020d}.log')
+        self.index_path = os.path.join(directory, f'{base:020d}.index')
+
+        # bytes of the segment, including the ones the writer thread has not written yet
+        self.size = 0
+
+        # the sparse index, times and positions of every INDEX_INTERVAL bytes, the first record always
+        self.times = []
+        self.positions = []
+
+    def position_at(self, timestamp):
+        # position to read from to find the first record at or after timestamp
+        i = bisect.bisect_left(self.times, timestamp) - 1
+        return self.positions[max(i, 0)]
+
+    def recover(self, index_interval):
+        # load the index, check the segment ends with a whole record and index what the index misses
+        # return the time of the last record, None if the segment is empty
+        self.size = os.path.getsize(self.path)
+        entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            entries = [INDEX_ENTRY.unpack_from(data, offset) for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+        entries = [(timestamp, position) for timestamp, position in entries if position < self.size]
+
+        # only the end of the segment is read, from the last index entry on
+        end = entries[-1][1] if entries else 0
+        last_time = entries[-1][0] if entries else None
+        for position, timestamp, room, text in read_records(self.path, end, self.size):
+            if not entries or position - entries[-1][1] >= index_interval:
+                entries.append((timestamp, position))
+            end = position + RECORD.size + len(room) + len(text)
+            last_time = timestamp
+
+        # the server stopped in the middle of a write, drop the partial record
+        if end < self.size:
+            logger.warning('Chat log %s ends with a partial record, truncated from %d to %d bytes', self.path, self.size, end)
+            os.truncate(self.path, end)
+            self.size = end
+
+        with open(self.index_path, 'wb') as f:
+            f.write(b''.join(INDEX_ENTRY.pack(timestamp, position) for timestamp, position in entries))
+        self.times = [timestamp for timestamp, _ in entries]
+        self.positions = [position for _, position in entries]
+        return last_time
+
+class ChatLog:
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, fsync_interval=FSYNC_INTERVAL, index_interval=INDEX_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.index_interval = index_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # segments on disk, the oldest first
+        # times in the log never go backwards, so segments and index entries are searched by time
+        self.segments = []
+        self.last_time = 0.0
+        self.recover()
+
+        # position of the end of the log, including the records not written yet
+        last = self.segments[-1] if self.segments else None
+        self.offset = last.base + last.size if last else 0
+
+        # records of the current loop iteration, handed to the writer thread in one batch
+        self.pending = []
+
+        # records the writer thread may not have written yet, so a query finds them in memory
+        # (offset, time, room, text), the writer thread moves `written` past them
+        self.tail = deque()
+        self.written = self.offset
+
+        # the event loop never waits for the disk, one thread writes every batch and calls fsync
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_batches, name='chat-log', daemon=True)
+        self.writer.start()
+
+    def recover(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.log'))
+        for name in names:
+            segment = Segment(self.directory, int(name[:-len('.log')]))
+            last_time = segment.recover(self.index_interval)
+
+            # an empty segment was created right before a crash
+            if last_time is None:
+                os.remove(segment.path)
+                os.remove(segment.index_path)
+                continue
+
+            self.segments.append(segment)
+            self.last_time = max(self.last_time, last_time)
+
+    def append(self, room, text, timestamp=None):
+        # add one record, nothing is written here
+        timestamp = max(time.time() if timestamp is None else timestamp, self.last_time)
+        self.last_time = timestamp
+
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.size >= self.segment_size:
+            segment = Segment(self.directory, self.offset)
+            self.segments.append(segment)
+
+        record = encode_record(timestamp, room, text)
+        position = segment.size
+        index = b''
+        if not segment.positions or position - segment.positions[-1] >= self.index_interval:
+            segment.times.append(timestamp)
+            segment.positions.append(position)
+            index = INDEX_ENTRY.pack(timestamp, position)
+
+        self.pending.append((segment, record, index))
+        self.tail.append((self.offset, timestamp, room, text))
+        segment.size += len(record)
+        self.offset += len(record)
+
+    def trim(self):
+        # forget the records the writer thread has written
+        written = self.written
+        while self.tail and self.tail[0][0] < written:
+            self.tail.popleft()
+
+    def flush(self):
+        # hand the records of this loop iteration to the writer thread, one write per segment
+        self.trim()
+        if not self.pending:
+            return
+
+        writes = []
+        for segment, record, index in self.pending:
+            if not writes or writes[-1][0] is not segment:
+                writes.append((segment, [], []))
+            writes[-1][1].append(record)
+            writes[-1][2].append(index)
+        self.queue.put(([(segment.path, segment.index_path, b''.join(records), b''.join(index)) for segment, records, index in writes], self.offset))
+        self.pending = []
+
+    def write_batches(self):
+        # runs in the writer thread
+        path = None
+        log_file = index_file = None
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            # wake up for the next fsync even without a new batch
+            timeout = None
+            if dirty and self.fsync_interval is not None:
+                timeout = max(0, last_sync + self.fsync_interval - time.monotonic())
+            try:
+                batch = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                batch = ()
+            if batch is None:
+                break
+
+            try:
+                if batch:
+                    writes, offset = batch
+                    for log_path, index_path, data, index in writes:
+                        # a new segment, the previous one is complete and synced before it is closed
+                        if log_path != path:
+                            if log_file is not None:
+                                self.sync(log_file, index_file)
+                                log_file.close()
+                                index_file.close()
+                            path = log_path
+                            log_file = open(log_path, 'ab')
+                            index_file = open(index_path, 'ab')
+
+                        # the records first, an index entry never points past the end of the segment
+                        log_file.write(data)
+                        log_file.flush()
+                        if index:
+                            index_file.write(index)
+                            index_file.flush()
+                    self.written = offset
+                    dirty = True
+
+                if dirty and self.fsync_interval is not None and time.monotonic() - last_sync >= self.fsync_interval:
+                    self.sync(log_file, index_file)
+                    last_sync = time.monotonic()
+                    dirty = False
+            except OSError:
+                logger.exception('Writing the chat log failed')
+
+        if log_file is not None:
+            self.sync(log_file, index_file)
+            log_file.close()
+            index_file.close()
+
+    def sync(self, log_file, index_file):
+        log_file.flush()
+        index_file.flush()
+        os.fsync(log_file.fileno())
+        os.fsync(index_file.fileno())
+
+    def since(self, timestamp, room, limit, max_bytes=None, max_scan=None, overhead=0):
+        # texts of the room from timestamp on, the oldest first, at most limit of them and max_bytes of text
+        # every text counts overhead bytes more against max_bytes, e.g. the header of the frame it is sent in
+        # the index finds the segment and the position to start reading, the log is never scanned from the start
+        # it runs on the event loop, so it reads at most max_scan bytes of the files, a rare room costs no more than a busy one
+        # returns (texts, more), more is the time of the first record left out when the answer is cut short, else None
+        self.trim()
+        tail = list(self.tail)
+
+        # everything before the first record in memory is on disk
+        end = tail[0][0] if tail else self.offset
+
+        results = []
+        size = 0
+        scanned = 0
+
+        def records():
+            firsts = [segment.times[0] for segment in self.segments]
+            first = max(bisect.bisect_left(firsts, timestamp) - 1, 0)
+            for i, segment in enumerate(self.segments[first:]):
+                if segment.base >= end:
+                    break
+                start = segment.position_at(timestamp) if i == 0 else 0
+                for record in read_records(segment.path, start, min(segment.size, end - segment.base)):
+                    yield True, record
+            for record in tail:
+                yield False, record
+
+        for on_disk, (_, record_time, record_room, text) in records():
+            if on_disk:
+                if max_scan is not None and scanned >= max_scan:
+                    return results, record_time
+                scanned += RECORD.size + len(record_room) + len(text)
+            if record_time >= timestamp and record_room == room:
+                # the first text is always sent, however big, so asking again moves on
+                if len(results) == limit or max_bytes is not None and results and size + overhead + len(text) > max_bytes:
+                    return results, record_time
+                results.append(text)
+                size += overhead + len(text)
+        return results, None
+
+    def close(self):
+        # write what is left, sync and stop the writer thread
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+
+
+# A 'null' stream that discards anything written to it
+class NullWriter(StringIO):
+    def write(self, txt):
+        pass
+
+class TestChatLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_query(self):
+        print('Testing chat log append and query ...')
+        log = ChatLog(self.directory, segment_size=256, index_interval=64)
+        for i in range(50):
+            log.append(b'lobby' if i % 2 else b'games', f'user: {i}\n'.encode(), timestamp=1000 + i)
+
+        # the records are still in memory, a query finds them anyway
+        self.assertEqual(log.since(1040, b'lobby', 10), ([f'user: {i}\n'.encode() for i in range(41, 50, 2)], None))
+        log.flush()
+        log.close()
+
+        # small segments, each one with a sparse index
+        self.assertEqual(len(log.segments) > 1, True)
+        self.assertEqual(all(len(segment.positions) < 10 for segment in log.segments), True)
+        print(f"segments: {len(log.segments)}")
+
+        # a reopened log answers from the disk, across segments, up to the limit
+        log = ChatLog(self.directory, segment_size=256, index_interval=64)
+        self.assertEqual(log.since(1010, b'games', 3), ([b'user: 10\n', b'user: 12\n', b'user: 14\n'], 1016))
+        self.assertEqual(log.since(2000, b'games', 3), ([], None))
+
+        # the answer is cut by bytes too, the time to ask again from is the first text left out
+        self.assertEqual(log.since(1010, b'games', 10, max_bytes=20), ([b'user: 10\n', b'user: 12\n'], 1014))
+        self.assertEqual(log.since(1010, b'games', 10, max_bytes=1), ([b'user: 10\n'], 1012))
+        self.assertEqual(log.since(1010, b'games', 10, max_bytes=20, overhead=5), ([b'user: 10\n'], 1012))
+
+        # a query of a room that is not in the log stops after max_scan bytes of the files
+        self.assertEqual(log.since(0, b'empty', 10, max_scan=100), ([], 1004))
+        self.assertEqual(log.since(0, b'empty', 10), ([], None))
+        log.close()
+        print()
+
+    def test_recover_partial_record(self):
+        print('Testing chat log recovery ...')
+        log = ChatLog(self.directory)
+        log.append(b'lobby', b'user: one\n', timestamp=1)
+        log.append(b'lobby', b'user: two\n', timestamp=2)
+        log.close()
+
+        # the server stopped in the middle of the third record
+        path = log.segments[-1].path
+        with open(path, 'ab') as f:
+            f.write(encode_record(3, b'lobby', b'user: three\n')[:10])
+
+        log = ChatLog(self.directory)
+        self.assertEqual(log.since(0, b'lobby', 10), ([b'user: one\n', b'user: two\n'], None))
+
+        # new records go after the last whole one
+        log.append(b'lobby', b'user: four\n', timestamp=4)
+        log.close()
+        log = ChatLog(self.directory)
+        self.assertEqual(log.since(0, b'lobby', 10), ([b'user: one\n', b'user: two\n', b'user: four\n'], None))
+        log.close()
+        print(f"segment size: {os.path.getsize(path)}")
+        print()
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(stream=NullWriter())
+    unittest.main(testRunner=runner, exit=False)
@@ -1,60 +1,317 @@
+import codecs
+import json
+import selectors
 import socket
-import select
 import sys
+import unittest
 from io import StringIO
+from collections import deque
 from unittest.mock import patch, MagicMock
 
+from protocol import (ATTACHMENT_ABORT, ATTACHMENT_CHUNK, ATTACHMENT_CHUNK_SIZE, ATTACHMENT_END, ATTACHMENT_START,
+                      FRAME_ATTACHMENT, FRAME_DEFLATE, FRAME_DEFLATE_ECHO, FRAME_DEFLATE_RESET, FRAME_MESSAGE, FRAME_PING, FRAME_PONG,
+                      FRAME_PRESENCE, FRAME_ROOM, FRAME_SEQUENCED, FRAME_TYPING, PRESENCE_JOIN, PRESENCE_LEAVE, PRESENCE_TYPING,
+                      FrameDecoder, compressor, decode_attachment, decode_presence, decode_room, decode_sequenced, decompressor,
+                      deflate, encode_attachment, encode_frame, encode_hello, encode_presence, encode_room, encode_sequenced, inflate)
+
+# one recv_into fills up to this many bytes of the receive buffer
+RECV_SIZE = 64 * 1024
+
+# how a presence event is shown
+PRESENCE_EVENTS = {PRESENCE_JOIN: 'joined', PRESENCE_LEAVE: 'left', PRESENCE_TYPING: 'is typing'}
+
 class ChatClient:
-    def __init__(self, nickname, host='127.0.0.1', port=65432):
+    def __init__(self, nickname, host='127.0.0.1', port=65432, framed=False, headless=False):
         # define host and port
         self.host = host
         self.port = port
 
+        # framed: every message is sent with a length header (ChatServer)
+        # not framed: every recv is one message (the select backend)
+        self.framed = framed
+        self.decoder = FrameDecoder()
+
+        # deflate streams, only when compression is asked for in connect
+        self.compressor = None
+        self.decompressor = None
+
+        # with sequence numbers: the room we are in, the last number we got, the epoch of the server and how many we missed
+        # None until the server tells us the room
+        self.sequence = False
+        self.room = None
+        self.seq = 0
+        self.epoch = None
+        self.missed = 0
+
+        # presence: the server sends the join, leave and typing events of our room
+        self.presence = False
+
+        # headless: no stdin, loop_iteration returns what it received instead of writing it, for bots and load tests
+        self.headless = headless
+
+        # the socket and stdin are registered once, in connect
+        # the socket waits for write-ready only while something is waiting to be sent
+        self.selector = selectors.DefaultSelector()
+        self.closed = False
+        self.writing = False
+
+        # frames waiting to be sent, the first one may be partially sent already
+        # uploads: [transfer id, data, bytes sent] of the attachments being sent, a chunk at a time, round-robin
+        self.outgoing = deque()
+        self.uploads = deque()
+        self.next_transfer = 0
+
+        # attachments being received, key: transfer id, value: (start, received bytes)
+        # and the complete ones: (sender, name, data)
+        self.downloads = {}
+        self.attachments = []
+
+        # one buffer for every recv, and a decoder that keeps a character split between two reads
+        self.buffer = bytearray(RECV_SIZE)
+        self.view = memoryview(self.buffer)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
         # create socket
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         # do not forget to encode nickname
         self.nickname = nickname.encode()
 
-    def connect(self):
+    def connect(self, compress=False, sequence=False, presence=False):
         # connect to server
         self.client_socket.connect((self.host, self.port))
 
         # set blocking to False
         self.client_socket.setblocking(False)
+        self.selector.register(self.client_socket, selectors.EVENT_READ, self.receive)
+        if not self.headless and sys.stdin not in self.selector.get_map():
+            self.selector.register(sys.stdin, selectors.EVENT_READ, self.read_input)
+        self.closed = False
+
+        # every option needs the framed protocol, they are asked for in the hello frame
+        options = {}
+        if (compress or sequence or presence) and not self.framed:
+            raise ValueError('Options need the framed protocol')
+
+        # after a reconnect only the missed messages are sent
+        if sequence:
+            if compress:
+                raise ValueError('Sequence numbers and compression cannot be used together')
+            self.sequence = True
+            if self.room is None:
+                options['sequence'] = True
+            else:
+                options['resume'] = {'room': self.room.decode(), 'seq': self.seq, 'epoch': self.epoch}
 
-        # send nickname
-        self.client_socket.send(self.nickname)
+        if compress:
+            self.compressor = compressor()
+            self.decompressor = decompressor()
+            options['compress'] = True
 
-    def main_loop(self):
-        while True:
-            self.loop_iteration()
+        # join, leave and typing events of the room
+        if presence:
+            self.presence = True
+            options['presence'] = True
 
-    def loop_iteration(self):
-        # second element of the sockets_list is the client_socket
-        sockets_list = [sys.stdin, self.client_socket]
+        if options:
+            self.write(encode_hello(self.nickname, **options))
+            return
 
-        # use select to check which one is read ready: stdin or client socket
-        read_sockets, _, _ = select.select(sockets_list, [], [])
+        # send nickname
+        self.write(self.encode(self.nickname))
 
-        # check for read-ready socket
-        for sock in read_sockets:
-            # if the read-ready socket is the client socket
-            if sock == self.client_socket:
-                # receive message
-                message = self.client_socket.recv(1024)
+    def reconnect(self):
+        # a new connection that resumes where the last one stopped
+        if self.client_socket in self.selector.get_map():
+            self.selector.unregister(self.client_socket)
+        self.client_socket.close()
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.decoder = FrameDecoder()
+
+        # the server aborted the uploads and downloads of the old connection
+        self.outgoing.clear()
+        self.uploads.clear()
+        self.downloads.clear()
+        self.writing = False
+
+        # the options of the last connection, compression starts new streams on both sides
+        self.connect(compress=self.compressor is not None, sequence=self.sequence, presence=self.presence)
+
+    def typing(self):
+        # tell the room we are typing, the server sends it at most once per tick
+        self.write(encode_frame(b'', FRAME_TYPING))
+
+    def send_attachment(self, name, data):
+        # share a file with the room, it is sent in chunks between the messages
+        # return the transfer id
+        transfer = self.next_transfer
+        self.next_transfer = (self.next_transfer + 1) % 2 ** 32
+        start = json.dumps({'name': name, 'size': len(data)}).encode()
+        self.outgoing.append(encode_attachment(transfer, ATTACHMENT_START, start))
+        self.uploads.append([transfer, memoryview(data), 0])
+        self.flush()
+        return transfer
+
+    def next_chunk(self):
+        # the next chunk of the next upload, with the end of the transfer after its last chunk
+        upload = self.uploads.popleft()
+        transfer, data, offset = upload
+        chunk = data[offset:offset + ATTACHMENT_CHUNK_SIZE]
+        upload[2] += len(chunk)
+
+        frame = encode_attachment(transfer, ATTACHMENT_CHUNK, chunk)
+        if upload[2] < len(data):
+            self.uploads.append(upload)
+        else:
+            frame += encode_attachment(transfer, ATTACHMENT_END)
+        return frame
+
+    def write(self, frame):
+        # frames go out in order, after the ones still waiting
+        self.outgoing.append(frame)
+        self.flush()
+
+    def flush(self):
+        # send the waiting frames, then the chunks of the uploads, while the socket takes them
+        # a chunk is only added when nothing else is waiting, so a message waits for at most one chunk
+        while self.outgoing or self.uploads:
+            if not self.outgoing:
+                self.outgoing.append(self.next_chunk())
+            frame = self.outgoing[0]
+            try:
+                sent = self.client_socket.send(frame)
+            except (BlockingIOError, InterruptedError):
+                break
+
+            # keep the unsent rest, without copying it
+            if sent < len(frame):
+                self.outgoing[0] = memoryview(frame)[sent:]
+                break
+            self.outgoing.popleft()
+
+        # wait for write-ready only while something is waiting
+        writing = bool(self.outgoing or self.uploads)
+        if writing != self.writing and not self.closed:
+            self.writing = writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self.selector.modify(self.client_socket, events, self.receive)
+
+    def encode(self, message):
+        # compress with the stream of the connection, so repeated text gets smaller
+        if self.compressor is not None:
+            return encode_frame(deflate(self.compressor, message), FRAME_DEFLATE)
+
+        # add the length header when the protocol is framed
+        if self.framed:
+            return encode_frame(message)
+        return message
 
-                # write message to stdout
-                sys.stdout.write(message.decode())
+    def main_loop(self):
+        while not self.closed:
+            self.loop_iteration()
+
+    def loop_iteration(self, timeout=None):
+        # the sockets stay registered, only the ready ones are returned
+        # the data of each registration is the handler, it adds what is to be shown to output
+        output = []
+        for key, mask in self.selector.select(timeout):
+            if mask & selectors.EVENT_READ:
+                handler = key.data
+                handler(output)
+            if mask & selectors.EVENT_WRITE and not self.closed:
+                self.flush()
+
+        # everything received in this iteration is shown with one write
+        if output and not self.headless:
+            sys.stdout.write(''.join(output))
+            sys.stdout.flush()
+        return output
+
+    def receive(self, output):
+        # receive into the same buffer every time, nothing is allocated for an empty read
+        try:
+            count = self.client_socket.recv_into(self.buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+
+        # the server closed the connection
+        if not count:
+            self.selector.unregister(self.client_socket)
+            self.closed = True
+            return
+        data = self.view[:count]
+
+        # a character may be split between two reads, the decoder keeps its first bytes for the next one
+        if not self.framed:
+            output.append(self.text_decoder.decode(data))
+            return
+
+        # one recv may hold many messages or only a part of one
+        for kind, payload in self.decoder.feed(data):
+            if kind == FRAME_MESSAGE:
+                output.append(payload.decode(errors='replace'))
+            elif kind == FRAME_DEFLATE_RESET:
+                # the server started a new stream for the room
+                self.decompressor = decompressor()
+            elif kind == FRAME_DEFLATE:
+                output.append(inflate(self.decompressor, payload).decode(errors='replace'))
+            elif kind == FRAME_DEFLATE_ECHO:
+                # our own message, only to keep the stream in sync
+                inflate(self.decompressor, payload)
+            elif kind == FRAME_ROOM:
+                # the next frames are numbered from here, by the server process named by the epoch
+                self.seq, self.epoch, self.room = decode_room(payload)
+            elif kind == FRAME_SEQUENCED:
+                seq, text = decode_sequenced(payload)
+                self.missed += max(0, seq - self.seq - 1)
+                self.seq = seq
+
+                # our own messages come back only for their number
+                if not text.startswith(self.nickname + b': '):
+                    output.append(text.decode(errors='replace'))
+            elif kind == FRAME_ATTACHMENT:
+                self.attachment(output, payload)
+            elif kind == FRAME_PRESENCE:
+                for event, user in decode_presence(payload):
+                    output.append(f'* {user.decode(errors="replace")} {PRESENCE_EVENTS[event]}\n')
+            elif kind == FRAME_PING:
+                # the server checks that an idle client is still there
+                self.write(encode_frame(b'', FRAME_PONG))
+
+    def attachment(self, output, payload):
+        # put the chunks of a transfer together, the chunks of other transfers may come in between
+        transfer, part, data = decode_attachment(payload)
+        if part == ATTACHMENT_START:
+            self.downloads[transfer] = (json.loads(bytes(data)), bytearray())
+            return
+
+        download = self.downloads.get(transfer)
+        if download is None:
+            return
+        start, received = download
+
+        if part == ATTACHMENT_CHUNK:
+            received += data
+        elif part == ATTACHMENT_END:
+            del self.downloads[transfer]
+            if len(received) == start['size']:
+                self.attachments.append((start['from'], start['name'], bytes(received)))
+                output.append(f"* {start['from']} sent {start['name']} ({start['size']} bytes)\n")
             else:
-                # read message from readline
-                message = sys.stdin.readline()
+                output.append(f"* {start['from']} sent {start['name']}, but it arrived incomplete\n")
+        elif part == ATTACHMENT_ABORT:
+            del self.downloads[transfer]
+            output.append(f"* {start['from']} stopped sending {start['name']}\n")
 
-                # send message
-                self.client_socket.send(message.encode())
+    def read_input(self, output):
+        # read message from readline and send it
+        self.send(sys.stdin.readline())
 
-                # flush the stdout
-                sys.stdout.flush()
+    def send(self, message):
+        # send a message, str or bytes, e.g. from a bot in headless mode
+        if isinstance(message, str):
+            message = message.encode()
+        self.write(self.encode(message))
 
 
 # A 'null' stream that discards anything written to it
@@ -80,6 +337,24 @@ class TestChatClient(unittest.TestCase):
 
         # Instantiating ChatClient with mocked input and socket
         self.chat_client = ChatClient('TestNickname')
+
+        # the selector is mocked too, ready() chooses what it returns
+        self.chat_client.selector = MagicMock()
+
+        # the tests give the received data with recv, recv_into copies it into the buffer
+        def recv_into(buffer):
+            data = self.mock_socket_instance.recv(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+        self.mock_socket_instance.recv_into.side_effect = recv_into
+
+        # every send is accepted in full
+        self.mock_socket_instance.send.side_effect = len
+
+    def ready(self, handler):
+        # the selector returns one ready registration, its data is the handler
+        key = selectors.SelectorKey(None, 0, selectors.EVENT_READ, handler)
+        self.chat_client.selector.select.return_value = [(key, selectors.EVENT_READ)]
     
     def test_connect(self):
         # This method will test the connect functionality
@@ -105,15 +380,14 @@ class TestChatClient(unittest.TestCase):
         assert_true(client.nickname, b'testuser')
         print()
 
-    @patch('select.select')
-    def test_loop_iteration_receive_message(self, mock_select):
+    def test_loop_iteration_receive_message(self):
         print('Testing receive message ...')
 
         # Prepare the mock objects for receiving a message
         self.mock_socket_instance.recv.return_value = b"Hello, World!\n"
         print(f"recv return value: {self.mock_socket_instance.recv.return_value}")
 
-        mock_select.return_value = ([self.chat_client.client_socket], [], [])
+        self.ready(self.chat_client.receive)
 
         # Use a with statement to limit the scope of the sys.stdout patch
         with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
@@ -127,16 +401,15 @@ class TestChatClient(unittest.TestCase):
         print(f"write called with: {mock_stdout.write.call_args}")
         print()
 
-    @patch('select.select')
     @patch('sys.stdin', new=MagicMock())
-    def test_loop_iteration_send_message(self, mock_select):
+    def test_loop_iteration_send_message(self):
         print('Testing send message ...')
 
         # Simulate user input
         sys.stdin.readline.return_value = "Hi there!"
         print(f"readline return value: {sys.stdin.readline.return_value}")
 
-        mock_select.return_value = ([sys.stdin], [], [])
+        self.ready(self.chat_client.read_input)
 
         # Run a single iteration of the main loop to simulate sending a message
         self.chat_client.loop_iteration()
@@ -145,11 +418,210 @@ class TestChatClient(unittest.TestCase):
         self.mock_socket_instance.send.assert_called_with(b'Hi there!')
         print(f"send called with: {self.mock_socket_instance.send.call_args}")
 
+    def test_loop_iteration_receive_framed(self):
+        print('Testing receive framed messages ...')
+        self.chat_client.framed = True
+
+        # two messages in one recv, the second one split over two recvs
+        data = encode_frame(b"a: one\n") + encode_frame(b"b: two\n")
+        self.mock_socket_instance.recv.side_effect = [data[:-3], data[-3:]]
+        self.ready(self.chat_client.receive)
+
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_called_once_with('a: one\n')
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_called_with('b: two\n')
+
+        print(f"write called with: {mock_stdout.write.call_args_list}")
+        print()
+
+    @patch('sys.stdin', new=MagicMock())
+    def test_loop_iteration_send_framed(self):
+        print('Testing send framed message ...')
+        self.chat_client.framed = True
+        sys.stdin.readline.return_value = "Hi there!"
+        self.ready(self.chat_client.read_input)
+
+        self.chat_client.loop_iteration()
+
+        self.mock_socket_instance.send.assert_called_with(encode_frame(b'Hi there!'))
+        print(f"send called with: {self.mock_socket_instance.send.call_args}")
+        print()
+
+    def test_loop_iteration_answer_ping(self):
+        print('Testing answer ping ...')
+        self.chat_client.framed = True
+        self.mock_socket_instance.recv.return_value = encode_frame(b'', FRAME_PING)
+        self.ready(self.chat_client.receive)
+
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_not_called()
+
+        self.mock_socket_instance.send.assert_called_once_with(encode_frame(b'', FRAME_PONG))
+        print(f"send called with: {self.mock_socket_instance.send.call_args}")
+        print()
+
+    def test_loop_iteration_compressed(self):
+        print('Testing compressed messages ...')
+        self.chat_client.framed = True
+        self.chat_client.connect(compress=True)
+        hello = self.mock_socket_instance.send.call_args[0][0]
+        self.assertIn(b'"compress": true', hello)
+        print(f"hello: {hello}")
+
+        # a new stream, our own message and a message from another client
+        stream = compressor()
+        self.mock_socket_instance.recv.return_value = (
+            encode_frame(b'', FRAME_DEFLATE_RESET)
+            + encode_frame(deflate(stream, b'TestNickname: hi\n'), FRAME_DEFLATE_ECHO)
+            + encode_frame(deflate(stream, b'other: hi\n'), FRAME_DEFLATE))
+        self.ready(self.chat_client.receive)
+
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_called_once_with('other: hi\n')
+
+        # what we send is compressed with our own stream
+        sent = self.chat_client.encode(b'hello\n')
+        self.assertEqual(inflate(decompressor(), FrameDecoder().feed(sent)[0][1]), b'hello\n')
+        print(f"write called with: {mock_stdout.write.call_args}")
+
+        # a reconnect asks for compression again, and starts a new stream the new session can inflate
+        with patch('socket.socket', return_value=self.mock_socket_instance):
+            self.chat_client.reconnect()
+        hello = self.mock_socket_instance.send.call_args[0][0]
+        self.assertIn(b'"compress": true', hello)
+        sent = self.chat_client.encode(b'again\n')
+        self.assertEqual(inflate(decompressor(), FrameDecoder().feed(sent)[0][1]), b'again\n')
+        print(f"hello after reconnect: {hello}")
+        print()
+
+    def test_loop_iteration_sequenced(self):
+        print('Testing sequenced messages ...')
+        self.chat_client.framed = True
+        self.chat_client.connect(sequence=True)
+        self.assertIn(b'"sequence": true', self.mock_socket_instance.send.call_args[0][0])
+
+        # the room, our own message, a message from another client, then a gap
+        self.mock_socket_instance.recv.return_value = (
+            encode_room(4, 77, b'games')
+            + encode_sequenced(5, b'TestNickname: hi\n')
+            + encode_sequenced(6, b'other: hi\n')
+            + encode_sequenced(9, b'other: again\n'))
+        self.ready(self.chat_client.receive)
+
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_called_once_with('other: hi\nother: again\n')
+        self.assertEqual((self.chat_client.room, self.chat_client.seq, self.chat_client.missed), (b'games', 9, 2))
+
+        # a reconnect resumes after the last number
+        with patch('socket.socket', return_value=self.mock_socket_instance):
+            self.chat_client.reconnect()
+        hello = self.mock_socket_instance.send.call_args[0][0]
+        self.assertIn(b'"resume": {"room": "games", "seq": 9, "epoch": 77}', hello)
+        print(f"hello: {hello}")
+        print()
+
+    def test_loop_iteration_presence(self):
+        print('Testing presence events ...')
+        self.chat_client.framed = True
+        self.chat_client.connect(presence=True)
+        self.assertIn(b'"presence": true', self.mock_socket_instance.send.call_args[0][0])
+
+        self.mock_socket_instance.recv.return_value = encode_frame(encode_presence([(PRESENCE_JOIN, b'a'), (PRESENCE_TYPING, b'b')]), FRAME_PRESENCE)
+        self.ready(self.chat_client.receive)
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_called_once_with('* a joined\n* b is typing\n')
+
+        self.chat_client.typing()
+        self.mock_socket_instance.send.assert_called_with(encode_frame(b'', FRAME_TYPING))
+        print(f"write called with: {mock_stdout.write.call_args_list}")
+        print()
+
+    def test_loop_iteration_split_character(self):
+        print('Testing character split between two reads ...')
+        data = 'héllo wörld\n'.encode()
+        self.mock_socket_instance.recv.side_effect = [data[:2], data[2:]]
+        self.ready(self.chat_client.receive)
+
+        # the first read ends in the middle of 'é', it is shown with the second read
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+            self.chat_client.loop_iteration()
+            self.assertEqual(''.join(call[0][0] for call in mock_stdout.write.call_args_list), 'héllo wörld\n')
+        print(f"write called with: {mock_stdout.write.call_args_list}")
+        print()
+
+    def test_headless(self):
+        print('Testing headless mode ...')
+        client = ChatClient('bot', framed=True, headless=True)
+        client.selector = MagicMock()
+        client.client_socket.close()
+        client.client_socket = self.mock_socket_instance
+        self.mock_socket_instance.recv.return_value = encode_frame(b'a: one\n') + encode_frame(b'b: two\n')
+        key = selectors.SelectorKey(None, 0, selectors.EVENT_READ, client.receive)
+        client.selector.select.return_value = [(key, selectors.EVENT_READ)]
+
+        # the messages are returned, nothing is written
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.assertEqual(client.loop_iteration(0), ['a: one\n', 'b: two\n'])
+            mock_stdout.write.assert_not_called()
+
+        client.send('hi\n')
+        self.mock_socket_instance.send.assert_called_with(encode_frame(b'hi\n'))
+        print(f"send called with: {self.mock_socket_instance.send.call_args}")
+        print()
+
+    def test_attachment(self):
+        print('Testing attachment ...')
+        self.chat_client.framed = True
+        data = bytes(range(256)) * (ATTACHMENT_CHUNK_SIZE * 3 // 256 + 1)
+
+        # the socket takes the start and one chunk, 10 bytes of the next chunk, then it is full
+        wire = bytearray()
+        def send(frame):
+            calls = self.mock_socket_instance.send.call_count
+            if calls > 3:
+                raise BlockingIOError
+            sent = len(frame) if calls < 3 else 10
+            wire.extend(frame[:sent])
+            return sent
+        self.mock_socket_instance.send.side_effect = send
+        transfer = self.chat_client.send_attachment('data.bin', data)
+        self.chat_client.send('hi\n')
+
+        # the message waits for the chunk being sent, not for the rest of the file
+        self.mock_socket_instance.send.side_effect = lambda frame: wire.extend(frame) or len(frame)
+        self.chat_client.flush()
+        frames = FrameDecoder().feed(wire)
+        parts = [(kind, decode_attachment(payload)[1] if kind == FRAME_ATTACHMENT else None) for kind, payload in frames]
+        start, chunk, end = ((FRAME_ATTACHMENT, part) for part in (ATTACHMENT_START, ATTACHMENT_CHUNK, ATTACHMENT_END))
+        self.assertEqual(parts, [start, chunk, chunk, (FRAME_MESSAGE, None), chunk, chunk, end])
+        print(f"frames sent: {parts}")
+
+        # the same frames, as the server forwards them, are put together again
+        start = json.dumps({'name': 'data.bin', 'size': len(data), 'from': 'alice'}).encode()
+        forwarded = [encode_attachment(transfer, ATTACHMENT_START, start)] + [encode_frame(payload, kind) for kind, payload in frames[1:]]
+        self.mock_socket_instance.recv.return_value = b''.join(forwarded)
+        self.ready(self.chat_client.receive)
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_called_once_with(f'hi\n* alice sent data.bin ({len(data)} bytes)\n')
+        self.assertEqual(self.chat_client.attachments, [('alice', 'data.bin', data)])
+        print(f"attachments: {[(sender, name, len(data)) for sender, name, data in self.chat_client.attachments]}")
+        print()
 
 if __name__ == "__main__":
     # uncomment this to test communication between client and server on your local computer
     # nickname = input("Choose your nickname: ")
     # client = ChatClient(nickname)
+    # use framed=True to talk to the selectors backend of the server (ChatServer)
+    # headless=True for a bot: call send() and loop_iteration(timeout), which returns the received messages
+    # client = ChatClient(nickname, framed=True)
     # client.connect()
     # client.main_loop()
 
@@ -0,0 +1,227 @@
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import threading
+import time
+import unittest
+
+from benchmark import HOST, percentile, run_server
+from protocol import FRAME_PING, FRAME_PONG, FrameDecoder, encode_frame
+from server import ChatServer
+
+def process_cpu_seconds(pid):
+    # user + system CPU time of a process, from /proc (Linux only)
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+
+    # utime and stime are fields 14 and 15 of the stat line, in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+class LoadGenerator:
+    def __init__(self, host, port, clients, rate, duration, drain=2.0):
+        # define host and port of the server under test
+        # a list of ports spreads the connections round-robin over many servers, e.g. a cluster
+        self.host = host
+        self.ports = list(port) if isinstance(port, (list, tuple)) else [port]
+
+        # number of connections, messages per second over all connections, seconds of sending
+        self.clients = clients
+        self.rate = rate
+        self.duration = duration
+
+        # seconds to wait for the last messages after sending stops
+        self.drain = drain
+
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        self.decoders = {}
+
+        # key: message id, value: send time
+        self.sent_at = {}
+        self.latencies = []
+        self.received = 0
+        self.received_bytes = 0
+
+    def connect(self):
+        # every connection does the same handshake as ChatClient(framed=True)
+        for i in range(self.clients):
+            client_socket = socket.create_connection((self.host, self.ports[i % len(self.ports)]))
+            client_socket.sendall(encode_frame(f'load{i}'.encode()))
+            self.selector.register(client_socket, selectors.EVENT_READ)
+            self.sockets.append(client_socket)
+            self.decoders[client_socket] = FrameDecoder()
+
+        # give the server time to handle every nickname before measuring
+        deadline = time.perf_counter() + 1
+        while time.perf_counter() < deadline:
+            self.receive(0.05, measure=False)
+
+    def receive(self, timeout, measure=True):
+        for key, _ in self.selector.select(timeout):
+            data = key.fileobj.recv(65536)
+            now = time.perf_counter()
+            if not data:
+                raise ConnectionError('The server closed a connection')
+
+            for kind, payload in self.decoders[key.fileobj].feed(data):
+                # a quiet connection is pinged by the server, it is closed if it does not answer
+                if kind == FRAME_PING:
+                    key.fileobj.sendall(encode_frame(b'', FRAME_PONG))
+                    continue
+                if not measure:
+                    continue
+
+                # payload: "loadN: <message id> <send time>\n", other messages (e.g. history) are ignored
+                fields = payload.split(b': ', 1)[-1].split()
+                if len(fields) != 2 or not fields[0].isdigit():
+                    continue
+
+                self.received += 1
+                self.received_bytes += len(payload)
+                self.latencies.append(now - float(fields[1]))
+
+    def run(self):
+        interval = 1 / self.rate
+        sent = 0
+        start = time.perf_counter()
+        stop = start + self.duration
+
+        # send on a fixed schedule, round-robin over the connections, and receive in between
+        next_send = start
+        while True:
+            now = time.perf_counter()
+            if now >= stop:
+                break
+
+            while next_send <= now and next_send < stop:
+                client_socket = self.sockets[sent % self.clients]
+                client_socket.sendall(encode_frame(f'{sent} {time.perf_counter()!r}\n'.encode()))
+                sent += 1
+                next_send += interval
+
+            self.receive(max(0.0, min(next_send, stop) - time.perf_counter()))
+
+        # wait for the messages still in flight
+        deadline = time.perf_counter() + self.drain
+        expected = sent * (self.clients - 1)
+        while self.received < expected and time.perf_counter() < deadline:
+            self.receive(0.05)
+        elapsed = time.perf_counter() - start
+
+        self.latencies.sort()
+        return {
+            'sent': sent,
+            'delivered': self.received,
+            'expected_deliveries': expected,
+            'send_rate': sent / self.duration,
+            'deliveries_per_sec': self.received / elapsed,
+            'delivered_bytes_per_sec': self.received_bytes / elapsed,
+            'latency_ms': {
+                'p50': percentile(self.latencies, 50) * 1000,
+                'p99': percentile(self.latencies, 99) * 1000,
+                'p999': percentile(self.latencies, 99.9) * 1000,
+                'max': (self.latencies[-1] if self.latencies else 0.0) * 1000,
+            },
+        }
+
+    def close(self):
+        for client_socket in self.sockets:
+            self.selector.unregister(client_socket)
+            client_socket.close()
+        self.selector.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator and fan-out latency benchmark for the chat server')
+    parser.add_argument('--clients', type=int, default=100, help='number of connections')
+    parser.add_argument('--rate', type=float, default=200, help='messages per second over all connections')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--backend', default='selectors', help='backend of the server started by the load generator')
+    parser.add_argument('--port', type=int, help='use a running server on this port instead of starting one')
+    parser.add_argument('--server-pid', type=int, help='pid of the running server, to measure its CPU time')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    process = None
+    port = args.port
+    pid = args.server_pid
+    if port is None:
+        port_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_server, args=(args.backend, port_queue), daemon=True)
+        process.start()
+        port = port_queue.get(timeout=10)
+        pid = process.pid
+
+    generator = LoadGenerator(HOST, port, args.clients, args.rate, args.duration)
+    try:
+        generator.connect()
+        cpu_before = process_cpu_seconds(pid) if pid else None
+        cpu_start = time.perf_counter()
+        results = generator.run()
+        cpu_after = process_cpu_seconds(pid) if pid else None
+        cpu_elapsed = time.perf_counter() - cpu_start
+    finally:
+        generator.close()
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    # share of one core the server used while sending and draining
+    if cpu_before is not None and cpu_after is not None:
+        results['server_cpu_seconds'] = cpu_after - cpu_before
+        results['server_cpu_percent'] = (cpu_after - cpu_before) / cpu_elapsed * 100
+
+    report = {
+        'config': {
+            'clients': args.clients,
+            'rate': args.rate,
+            'duration': args.duration,
+            'backend': args.backend if args.port is None else None,
+        },
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def test_quiet_clients_answer_pings(self):
+        print('Testing load clients quiet for longer than the idle timeout ...')
+        server = ChatServer(HOST, 0, message_rate=None, byte_rate=None, idle_timeout=0.2, pong_timeout=0.2, timer_resolution=0.05)
+        running = True
+
+        def serve():
+            while running:
+                server.loop_iteration(0.05)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        # one message every 0.5 seconds, so every connection is quiet for 1.5 seconds between its messages
+        generator = LoadGenerator(HOST, server.port, 3, 2, 2, drain=1.0)
+        try:
+            # connect waits for a second without sending, more than the idle and pong timeouts
+            generator.connect()
+            results = generator.run()
+            self.assertEqual(len(server.clients), 3)
+            self.assertEqual(server.metrics.disconnects['idle'], 0)
+            self.assertEqual(results['delivered'], results['expected_deliveries'])
+            print(f"delivered: {results['delivered']}")
+        finally:
+            generator.close()
+            running = False
+            thread.join()
+            server.close()
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+import json
+import struct
+import unittest
+import zlib
+from io import StringIO
+
+# every frame is a header followed by the payload
+# header: payload length (4 bytes, big endian) and frame kind (1 byte)
+HEADER = struct.Struct('!IB')
+
+# kinds of frame
+# FRAME_RELAY carries an encoded message frame from one server (or worker) to another
+# FRAME_PING asks the other side to answer with FRAME_PONG, both have an empty payload
+FRAME_MESSAGE = 0
+FRAME_RELAY = 1
+FRAME_PING = 2
+FRAME_PONG = 3
+
+# compressed frames carry raw deflate data, flushed at the end of every message
+# every connection (and every room on the server) is one deflate stream, so repeated text compresses across messages
+# FRAME_DEFLATE_RESET starts a new stream, FRAME_DEFLATE_ECHO is the sender's own message: decompressed, not shown
+FRAME_DEFLATE = 4
+FRAME_DEFLATE_ECHO = 5
+FRAME_DEFLATE_RESET = 6
+
+# the first frame of a connection is the nickname, or FRAME_HELLO with a JSON object
+# {"nickname": "...", "compress": true}
+# {"nickname": "...", "sequence": true, "resume": {"room": "...", "seq": 41, "epoch": 5081236190}}
+FRAME_HELLO = 7
+
+# a client that asked for sequence numbers gets every room message as FRAME_SEQUENCED: sequence number, then text
+# FRAME_ROOM tells it the room it is in and the sequence number the next frames follow: sequence number, epoch, then room name
+# the numbers count the messages of one room on one server process, the epoch names that process (a restart or another worker has another)
+# a resume sends the room, the last number seen and the epoch, to get only the gap, or the whole history when the epoch is not the server's
+FRAME_SEQUENCED = 8
+FRAME_ROOM = 9
+SEQUENCE = struct.Struct('!Q')
+ROOM = struct.Struct('!QQ')
+
+# a client that asked for presence ({"presence": true} in the hello) gets the join, leave and typing events of its room
+# batched: at most one FRAME_PRESENCE per tick, payload: one entry per event, event (1 byte), nickname length (2 bytes), nickname
+# FRAME_TYPING is sent by a client while its user is typing, with an empty payload
+FRAME_PRESENCE = 10
+FRAME_TYPING = 11
+PRESENCE_ENTRY = struct.Struct('!BH')
+
+# events of a FRAME_PRESENCE entry
+PRESENCE_JOIN = 1
+PRESENCE_LEAVE = 2
+PRESENCE_TYPING = 3
+
+# an attachment is sent as FRAME_ATTACHMENT frames, each one is a part of one transfer
+# payload: transfer id (4 bytes), part (1 byte), data
+# ATTACHMENT_START: JSON {"name": "...", "size": 1234}, the server adds "from": "<nickname>"
+# ATTACHMENT_CHUNK: up to ATTACHMENT_CHUNK_SIZE bytes of the file, ATTACHMENT_END: empty
+# ATTACHMENT_ABORT: empty, the sender left before the end
+# every chunk is its own frame, so messages and other transfers are sent between the chunks
+FRAME_ATTACHMENT = 12
+ATTACHMENT = struct.Struct('!IB')
+ATTACHMENT_START = 0
+ATTACHMENT_CHUNK = 1
+ATTACHMENT_END = 2
+ATTACHMENT_ABORT = 3
+ATTACHMENT_CHUNK_SIZE = 16 * 1024
+MAX_ATTACHMENT_SIZE = 64 * 1024 * 1024
+
+# the servers of a cluster relay a message along a tree of links, each server forwards it on its other links
+# every message is numbered by the server it started on, so a server that sees it twice (a loop of links) drops it
+# relay payload: origin server id (8 bytes), message number (8 bytes), room name length (1 byte), room name, message frame
+RELAY = struct.Struct('!QQB')
+
+# a /msg for a user that is not on this server is relayed the same way, with the nickname instead of the room name
+# the server that has the user delivers it and relays it no further
+FRAME_RELAY_PRIVATE = 13
+
+# the presence events of a room are relayed once per tick, the message is the FRAME_PRESENCE frame of the local events
+# every server sends it on to its own watchers of the room as it is, so a watcher gets one frame per server per tick
+FRAME_RELAY_PRESENCE = 14
+
+COMPRESSION_LEVEL = 6
+
+# a frame bigger than this is a protocol error, not a message
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+def encode_frame(payload, kind=FRAME_MESSAGE):
+    # header followed by the payload, ready to be sent
+    return HEADER.pack(len(payload), kind) + payload
+
+def encode_hello(nickname, **options):
+    # nickname and options of the connection
+    hello = {'nickname': nickname.decode()}
+    hello.update(options)
+    return encode_frame(json.dumps(hello).encode(), FRAME_HELLO)
+
+def decode_hello(payload):
+    # return the nickname and the options of a FRAME_HELLO payload
+    hello = json.loads(payload)
+    if not isinstance(hello, dict) or not isinstance(hello.get('nickname'), str):
+        raise ValueError('Hello without nickname')
+    return hello.pop('nickname').encode(), hello
+
+def encode_sequenced(seq, data, kind=FRAME_SEQUENCED):
+    # a FRAME_SEQUENCED frame
+    return encode_frame(SEQUENCE.pack(seq) + data, kind)
+
+def decode_sequenced(payload):
+    # return the sequence number and the text of the payload
+    return SEQUENCE.unpack_from(payload)[0], payload[SEQUENCE.size:]
+
+def encode_room(seq, epoch, name):
+    # a FRAME_ROOM frame
+    return encode_frame(ROOM.pack(seq, epoch) + name, FRAME_ROOM)
+
+def decode_room(payload):
+    # return the sequence number, the epoch and the room name of the payload
+    seq, epoch = ROOM.unpack_from(payload)
+    return seq, epoch, payload[ROOM.size:]
+
+def encode_presence(events):
+    # payload of a FRAME_PRESENCE frame, events: (event, nickname) pairs
+    return b''.join(PRESENCE_ENTRY.pack(event, len(nickname)) + nickname for event, nickname in events)
+
+def decode_presence(payload):
+    # return the (event, nickname) pairs of a FRAME_PRESENCE payload
+    events = []
+    offset = 0
+    while offset < len(payload):
+        event, length = PRESENCE_ENTRY.unpack_from(payload, offset)
+        offset += PRESENCE_ENTRY.size
+        events.append((event, payload[offset:offset + length]))
+        offset += length
+    return events
+
+def encode_attachment(transfer, part, data=b''):
+    return encode_frame(ATTACHMENT.pack(transfer, part) + data, FRAME_ATTACHMENT)
+
+def decode_attachment(payload):
+    # return the transfer id, the part and the data of a FRAME_ATTACHMENT payload, the data is not copied
+    transfer, part = ATTACHMENT.unpack_from(payload)
+    return transfer, part, memoryview(payload)[ATTACHMENT.size:]
+
+def compressor():
+    # raw deflate, without zlib header and checksum, because the stream never ends
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+def decompressor():
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+def deflate(stream, data):
+    # compress one message and flush it, so the other side can decompress it right away
+    return stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+
+def inflate(stream, data, max_size=MAX_FRAME_SIZE):
+    # decompress one message, a message bigger than max_size is a protocol error
+    message = stream.decompress(data, max_size)
+    if stream.unconsumed_tail:
+        raise ValueError(f'Compressed message is bigger than {max_size} bytes')
+    return message
+
+def encode_relay(origin, number, room, message):
+    # payload of a FRAME_RELAY frame
+    return RELAY.pack(origin, number, len(room)) + room + message
+
+def decode_relay(payload):
+    # return the origin, the number, the room name and the message frame of a FRAME_RELAY payload
+    origin, number, length = RELAY.unpack_from(payload)
+    start = RELAY.size + length
+    return origin, number, payload[RELAY.size:start], payload[start:]
+
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        # bytes received but not decoded yet, e.g. half of a frame
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        # add received bytes and return every whole frame as (kind, payload)
+        # one recv may hold many frames, or only a part of one frame
+        self.buffer += data
+
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise ValueError(f'Frame of {length} bytes is bigger than {self.max_frame_size} bytes')
+
+            # wait for the rest of the frame
+            start = offset + HEADER.size
+            end = start + length
+            if end > len(self.buffer):
+                break
+
+            frames.append((kind, bytes(self.buffer[start:end])))
+            offset = end
+
+        # remove the decoded frames from the buffer, once per feed
+        del self.buffer[:offset]
+        return frames
+
+
+# A 'null' stream that discards anything written to it
+class NullWriter(StringIO):
+    def write(self, txt):
+        pass
+
+class TestProtocol(unittest.TestCase):
+
+    def test_encode_frame(self):
+        print('Testing encode frame ...')
+        frame = encode_frame(b'Hello')
+        self.assertEqual(frame, b'\x00\x00\x00\x05\x00Hello')
+        print(f"frame: {frame}")
+        print()
+
+    def test_decode_many_frames(self):
+        print('Testing decode many frames in one feed ...')
+        decoder = FrameDecoder()
+        frames = decoder.feed(encode_frame(b'one') + encode_frame(b'two') + encode_frame(b''))
+        self.assertEqual(frames, [(FRAME_MESSAGE, b'one'), (FRAME_MESSAGE, b'two'), (FRAME_MESSAGE, b'')])
+        print(f"frames: {frames}")
+        print()
+
+    def test_decode_split_frame(self):
+        print('Testing decode split frame ...')
+        decoder = FrameDecoder()
+        data = encode_frame(b'Hello, World!')
+
+        # the frame arrives one byte at a time
+        frames = []
+        for i in range(len(data)):
+            frames += decoder.feed(data[i:i + 1])
+        self.assertEqual(frames, [(FRAME_MESSAGE, b'Hello, World!')])
+        self.assertEqual(len(decoder.buffer), 0)
+        print(f"frames: {frames}")
+        print()
+
+    def test_relay_payload(self):
+        print('Testing relay payload ...')
+        payload = encode_relay(3, 41, b'lobby', encode_frame(b'a: hi'))
+        self.assertEqual(decode_relay(payload), (3, 41, b'lobby', encode_frame(b'a: hi')))
+        print(f"relay payload: {payload}")
+        print()
+
+    def test_hello(self):
+        print('Testing hello ...')
+        nickname, options = decode_hello(encode_hello(b'alice', compress=True)[HEADER.size:])
+        self.assertEqual((nickname, options), (b'alice', {'compress': True}))
+        with self.assertRaises(ValueError):
+            decode_hello(b'{}')
+        print(f"hello: {nickname}, {options}")
+        print()
+
+    def test_sequenced(self):
+        print('Testing sequenced frame ...')
+        frame = encode_sequenced(42, b'a: hi\n')
+        kind, payload = FrameDecoder().feed(frame)[0]
+        self.assertEqual((kind, decode_sequenced(payload)), (FRAME_SEQUENCED, (42, b'a: hi\n')))
+        print(f"frame: {frame}")
+        print()
+
+    def test_presence(self):
+        print('Testing presence payload ...')
+        events = [(PRESENCE_JOIN, b'alice'), (PRESENCE_TYPING, b'bob'), (PRESENCE_LEAVE, b'carol')]
+        payload = encode_presence(events)
+        self.assertEqual(decode_presence(payload), events)
+        print(f"payload: {payload}")
+        print()
+
+    def test_attachment(self):
+        print('Testing attachment frame ...')
+        kind, payload = FrameDecoder().feed(encode_attachment(7, ATTACHMENT_CHUNK, b'\x00\xff'))[0]
+        transfer, part, data = decode_attachment(payload)
+        self.assertEqual((kind, transfer, part, bytes(data)), (FRAME_ATTACHMENT, 7, ATTACHMENT_CHUNK, b'\x00\xff'))
+        print(f"transfer: {transfer}, part: {part}, data: {bytes(data)}")
+        print()
+
+    def test_deflate_stream(self):
+        print('Testing deflate stream ...')
+        sender, receiver = compressor(), decompressor()
+        first = deflate(sender, b'good morning everyone')
+        second = deflate(sender, b'good morning everyone')
+
+        # the repeated message is much smaller, it refers to the first one
+        self.assertLess(len(second), len(first))
+        self.assertEqual(inflate(receiver, first), b'good morning everyone')
+        self.assertEqual(inflate(receiver, second), b'good morning everyone')
+        print(f"compressed sizes: {len(first)}, {len(second)}")
+
+        with self.assertRaises(ValueError):
+            inflate(decompressor(), deflate(compressor(), b'x' * 100), max_size=10)
+        print()
+
+    def test_decode_too_big(self):
+        print('Testing decode frame too big ...')
+        decoder = FrameDecoder(max_frame_size=4)
+        with self.assertRaises(ValueError):
+            decoder.feed(encode_frame(b'Hello'))
+        print()
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(stream=NullWriter())
+    unittest.main(testRunner=runner, exit=False)
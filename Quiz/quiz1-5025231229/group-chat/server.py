@@ -1,13 +1,141 @@
+import asyncio
+import errno
+import heapq
+import json
+import logging
+import multiprocessing
+import os
 import socket
 import select
+import selectors
+import shutil
+import struct
+import tempfile
+import time
 import unittest
+import zlib
+from collections import Counter, deque
+from itertools import islice
 from io import StringIO
 from unittest.mock import MagicMock, patch
 
+from chatlog import FSYNC_INTERVAL, ChatLog
+from protocol import (ATTACHMENT, ATTACHMENT_ABORT, ATTACHMENT_CHUNK, ATTACHMENT_END, ATTACHMENT_START, FRAME_ATTACHMENT,
+                      FRAME_DEFLATE, FRAME_DEFLATE_ECHO, FRAME_DEFLATE_RESET, FRAME_HELLO, FRAME_MESSAGE, FRAME_PING, FRAME_PONG,
+                      FRAME_PRESENCE, FRAME_RELAY, FRAME_RELAY_PRESENCE, FRAME_RELAY_PRIVATE, FRAME_ROOM, FRAME_SEQUENCED, FRAME_TYPING, HEADER, MAX_ATTACHMENT_SIZE,
+                      PRESENCE_JOIN, PRESENCE_LEAVE, PRESENCE_TYPING, RELAY, ROOM, SEQUENCE, FrameDecoder, compressor, decode_attachment,
+                      decode_hello, decode_presence, decode_relay, decompressor, deflate, encode_attachment, encode_frame,
+                      encode_hello, encode_presence, encode_relay, encode_room, encode_sequenced, inflate)
+
 # define host and port
 HOST = '127.0.0.1'
 PORT = 65432
 
+# event loop backends that can be chosen when starting the server
+# 'select' is the original select.select loop, capped at FD_SETSIZE (1024) sockets
+# 'asyncio' is AsyncChatServer, built on asyncio Protocols
+# the other backends use the selectors module and dispatch only the ready sockets
+# their connection ceiling is the open-file limit (RLIMIT_NOFILE), not 1024
+BACKENDS = {
+    'select': None,
+    'selectors': 'DefaultSelector',
+    'epoll': 'EpollSelector',
+    'poll': 'PollSelector',
+    'kqueue': 'KqueueSelector',
+    'devpoll': 'DevpollSelector',
+    'asyncio': None,
+}
+BACKEND = 'select'
+
+# a client with more queued bytes than the high-water mark lags too far behind
+# policy 'disconnect' closes the client, policy 'drop' skips messages until it catches up
+HIGH_WATER_MARK = 1024 * 1024
+SLOW_CLIENT_POLICY = 'disconnect'
+
+# one recv takes up to this many bytes, which may hold many frames
+RECV_SIZE = 64 * 1024
+
+# queued chunks are sent with one scatter-gather sendmsg, up to IOV_MAX chunks per call
+# sendmsg is not available on Windows, there every chunk is one send
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# messages are logged at DEBUG level, connections at INFO level
+# the log line of a message is only formatted when DEBUG is enabled
+LOG_LEVEL = logging.INFO
+logger = logging.getLogger('group-chat')
+
+# metrics can be read from this local port, None to disable it
+# send 'json' for a JSON answer, anything else for plain text
+ADMIN_HOST = '127.0.0.1'
+ADMIN_PORT = None
+
+# a client silent for IDLE_TIMEOUT seconds gets a ping
+# it is disconnected if it is still silent PONG_TIMEOUT seconds later
+IDLE_TIMEOUT = 30
+PONG_TIMEOUT = 10
+
+# the timer wheel counts time in ticks of TIMER_RESOLUTION seconds
+# 4 levels of 64 slots cover 64 ** 4 ticks, about 19 days with 0.1 second ticks
+# a tick is short enough to resume a rate-limited client without a noticeable stall
+TIMER_RESOLUTION = 0.1
+TIMER_SLOTS = 64
+TIMER_LEVELS = 4
+
+# every client starts in the default room, /join <room> moves it to another room
+DEFAULT_ROOM = b'lobby'
+MAX_ROOM_NAME = 64
+
+# a server keeps at most MAX_ROOMS rooms besides the default room, an empty room keeps its history until a new room needs its place
+# the empty room that has been empty the longest goes first, a new room is refused when every room has members
+# the default room is not counted, it is always there for a client that cannot get another room
+MAX_ROOMS = 1000
+
+# every room keeps its most recent messages, bounded by count and by bytes
+# a client joining the room gets them in one write
+HISTORY_MESSAGES = 100
+HISTORY_BYTES = 64 * 1024
+
+# join, leave and typing events are sent every PRESENCE_INTERVAL seconds, one frame per room for all the events of the tick
+PRESENCE_INTERVAL = 0.1
+
+# every broadcast is appended to a log of segment files in this directory, None to disable it
+# the log is synced to disk at most every LOG_FSYNC_INTERVAL seconds, 0 after every batch, None leaves it to the OS
+# '/history since <time>' reads at most HISTORY_QUERY_MESSAGES messages and HISTORY_QUERY_BYTES bytes of it
+# the answer is one write, so it is never bigger than the high-water mark either
+# a query runs on the event loop and reads at most HISTORY_QUERY_SCAN bytes of the log files, the client asks again for more
+LOG_DIR = None
+LOG_FSYNC_INTERVAL = FSYNC_INTERVAL
+HISTORY_QUERY_MESSAGES = 500
+HISTORY_QUERY_BYTES = 256 * 1024
+HISTORY_QUERY_SCAN = 4 * 1024 * 1024
+
+# every client may send RATE_MESSAGES messages and RATE_BYTES bytes per second
+# with bursts of up to BURST_MESSAGES messages and BURST_BYTES bytes, None disables a limit
+# a client over its limit is not read until its buckets refill, so TCP pushes back on it, nothing is dropped
+RATE_MESSAGES = 20
+BURST_MESSAGES = 40
+RATE_BYTES = 64 * 1024
+BURST_BYTES = 256 * 1024
+
+# servers of a cluster are linked over TCP, a server accepts the links of the others on CLUSTER_PORT, None for no links
+# the cluster socket listens on CLUSTER_HOST, an address the other hosts can reach ('0.0.0.0' for every interface)
+# the links must form a tree, a message crosses every link once, a loop of links only costs the copies it drops
+# a lost link this server connected is connected again every CLUSTER_RETRY seconds
+# the last RELAY_WINDOW message numbers of every origin server are remembered to find the copies
+# for at most RELAY_ORIGINS origins, the one not heard from the longest is forgotten first (a restarted server is a new origin)
+CLUSTER_HOST = HOST
+CLUSTER_PORT = None
+CLUSTER_RETRY = 1.0
+RELAY_WINDOW = 4096
+RELAY_ORIGINS = 1024
+
+# a /msg to a longer nickname is not relayed, the relay header has one byte for its length
+MAX_NICKNAME_RELAY = 255
+
 def receive_message(client_socket):
     try:
         # receive message
@@ -30,7 +158,1712 @@ def broadcast(message, sender_socket, clients):
         if client_socket != sender_socket:
             client_socket.send(message)
 
-def start_server():
+def parse_since(text, now=None):
+    # a unix time, or a time ago with a unit: 30s, 15m, 2h, 1d
+    units = {b's': 1, b'm': 60, b'h': 3600, b'd': 86400}
+    if text[-1:] in units:
+        now = time.time() if now is None else now
+        return now - float(text[:-1]) * units[text[-1:]]
+    return float(text)
+
+def make_selector(backend):
+    # get the selector class name of the backend
+    if backend not in BACKENDS or BACKENDS[backend] is None:
+        raise ValueError(f'Unknown selectors backend: {backend}')
+
+    # not every platform has every selector (epoll is Linux only, kqueue is BSD/macOS only)
+    selector_class = getattr(selectors, BACKENDS[backend], None)
+    if selector_class is None:
+        raise ValueError(f'Backend {backend} is not available on this platform')
+
+    return selector_class()
+
+def raise_fd_limit():
+    # every client is one file descriptor, so the open-file limit is the connection ceiling
+    # raise the soft limit up to the hard limit and return the new ceiling
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+
+    return soft
+
+class OutboundQueue:
+    def __init__(self):
+        # chunks waiting to be sent, the first one may be partially sent already
+        self.chunks = deque()
+
+        # number of bytes waiting to be sent, attachments included
+        self.size = 0
+
+        # frames of attachments, key: transfer id, value: frames of the transfer
+        # they are moved to the chunks one frame at a time, round-robin over the transfers, only when the chunks are empty
+        # so a message waits for at most one attachment frame, and a small file does not wait for a big one
+        self.transfers = {}
+        self.turns = deque()
+
+    def __len__(self):
+        return self.size
+
+    def append(self, parts, transfer=None):
+        # the parts are shared by every queue of a broadcast, they are never copied
+        if transfer is not None:
+            frames = self.transfers.get(transfer)
+            if frames is None:
+                frames = self.transfers[transfer] = deque()
+                self.turns.append(transfer)
+            frames.append(parts)
+            self.size += sum(len(part) for part in parts)
+            return
+
+        for part in parts:
+            if part:
+                self.chunks.append(part)
+                self.size += len(part)
+
+    def schedule(self):
+        # move the next frame of the next transfer to the chunks, its bytes are counted in size already
+        transfer = self.turns.popleft()
+        frames = self.transfers[transfer]
+        self.chunks.extend(part for part in frames.popleft() if part)
+        if frames:
+            self.turns.append(transfer)
+        else:
+            del self.transfers[transfer]
+
+    def send(self, client_socket):
+        # send as many chunks as the socket accepts without blocking
+        # OSError (e.g. broken pipe) is raised to the caller
+        while self.chunks or self.turns:
+            if not self.chunks:
+                self.schedule()
+            try:
+                if HAS_SENDMSG:
+                    batch = list(islice(self.chunks, IOV_MAX))
+                    sent = client_socket.sendmsg(batch)
+                else:
+                    batch = [self.chunks[0]]
+                    sent = client_socket.send(batch[0])
+            except (BlockingIOError, InterruptedError):
+                return
+
+            self.size -= sent
+            complete = sent == sum(len(chunk) for chunk in batch)
+
+            # remove the sent chunks
+            while sent:
+                chunk = self.chunks[0]
+                if sent < len(chunk):
+                    # keep the unsent rest of a partially sent chunk, without copying it
+                    self.chunks[0] = memoryview(chunk)[sent:]
+                    break
+                sent -= len(chunk)
+                self.chunks.popleft()
+
+            # the socket buffer is full
+            if not complete:
+                return
+
+class History:
+    def __init__(self, max_messages=HISTORY_MESSAGES, max_bytes=HISTORY_BYTES):
+        # encoded frames, the oldest one first
+        self.frames = deque()
+        self.size = 0
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+    def __len__(self):
+        return len(self.frames)
+
+    def append(self, parts, seq=0):
+        # a frame is kept as the parts it was sent with, see ChatServer.message, and its sequence number
+        length = sum(len(part) for part in parts)
+
+        # a frame bigger than the whole budget is never kept
+        if length > self.max_bytes:
+            return
+
+        self.frames.append((length, seq, parts))
+        self.size += length
+
+        # drop the oldest frames until both limits are met
+        while len(self.frames) > self.max_messages or self.size > self.max_bytes:
+            self.size -= self.frames.popleft()[0]
+
+    def replay(self):
+        # all frames joined, so catching up is one send
+        return b''.join(part for _, _, parts in self.frames for part in parts)
+
+    def since(self, seq):
+        # (sequence number, parts) of the frames after seq, the oldest first
+        # the walk starts at the newest frame, so it costs the gap, not the whole history
+        frames = []
+        for _, frame_seq, parts in reversed(self.frames):
+            if frame_seq <= seq:
+                break
+            frames.append((frame_seq, parts))
+        frames.reverse()
+        return frames
+
+class Room:
+    def __init__(self, name):
+        self.name = name
+
+        # recent messages of the room, for the clients joining later
+        self.history = History()
+
+        # sockets of the local members, a broadcast only walks this set
+        self.members = set()
+
+        # number of messages sent to the room
+        self.messages = 0
+
+        # sequence number of the last message, and the members that get the numbers
+        self.seq = 0
+        self.sequenced_members = 0
+
+        # members that get the presence events, and the events of the current tick
+        # key: nickname, value: its last event, so a user is in a batch at most once
+        self.watchers = set()
+        self.presence = {}
+
+        # the deflate stream of the room, shared by every member that asked for compression
+        # None until the next broadcast, which starts a new stream
+        self.compressor = None
+        self.compressed_members = 0
+
+class TokenBucket:
+    def __init__(self, rate, burst, now=None):
+        # rate tokens are added per second, up to burst tokens
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.last = time.monotonic() if now is None else now
+
+    def wait(self, amount, now=None):
+        # seconds until amount tokens are available, 0 if they are available now
+        # an amount bigger than the bucket only needs a full bucket, the debt delays what comes next
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        need = min(amount, self.capacity)
+        if self.tokens >= need:
+            return 0
+        return (need - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+class RelayWindow:
+    def __init__(self, size=RELAY_WINDOW):
+        # the highest message number of one origin server, and the numbers seen close to it
+        self.size = size
+        self.highest = 0
+        self.seen = set()
+
+    def add(self, number):
+        # return False for a number seen before, or too old to tell, the message is a copy
+        if number <= self.highest - self.size or number in self.seen:
+            return False
+        self.seen.add(number)
+
+        # forget the old numbers once in a while, not on every message
+        if number > self.highest:
+            self.highest = number
+            if len(self.seen) > 2 * self.size:
+                self.seen = {seen for seen in self.seen if seen > number - self.size}
+        return True
+
+class Transfer:
+    __slots__ = ('id', 'remaining', 'recipients')
+
+    def __init__(self, transfer_id, size, recipients):
+        self.id = transfer_id
+
+        # bytes the sender announced and has not sent yet
+        self.remaining = size
+
+        # the members of the room when the transfer started, the only ones that get its chunks
+        self.recipients = recipients
+
+class Timer:
+    __slots__ = ('expires', 'callback', 'args', 'slot')
+
+    def __init__(self, expires, callback, args):
+        # tick at which the timer fires
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+
+        # the set of the wheel the timer is in, None when it fired or was cancelled
+        self.slot = None
+
+class TimerWheel:
+    def __init__(self, resolution=TIMER_RESOLUTION, slots=TIMER_SLOTS, levels=TIMER_LEVELS, now=None):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+
+        # level L has slots of slots ** L ticks each, a timer is kept in the lowest level that reaches it
+        # adding and cancelling a timer is O(1), a timer is moved down at most levels - 1 times
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        now = time.monotonic() if now is None else now
+        self.tick = int(now / resolution)
+
+    def __len__(self):
+        return sum(len(slot) for wheel in self.wheels for slot in wheel)
+
+    def schedule(self, delay, callback, *args):
+        # call callback(*args) after delay seconds, at the earliest on the next tick
+        ticks = max(1, int(delay / self.resolution + 0.999999))
+        ticks = min(ticks, self.slots ** self.levels - 1)
+        timer = Timer(self.tick + ticks, callback, args)
+        self.place(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+
+    def place(self, timer):
+        delta = timer.expires - self.tick
+        level = 0
+        while level < self.levels - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+
+        # the slot is chosen by the absolute expiry tick, so slots never move
+        index = (timer.expires // self.slots ** level) % self.slots
+        timer.slot = self.wheels[level][index]
+        timer.slot.add(timer)
+
+    def advance(self, now=None):
+        # run every timer that expires up to now
+        now = time.monotonic() if now is None else now
+        target = int(now / self.resolution)
+        expired = []
+        while self.tick < target:
+            self.tick += 1
+
+            # at the start of a block of a higher level, move its timers down
+            for level in range(1, self.levels):
+                if self.tick % self.slots ** level:
+                    break
+                index = (self.tick // self.slots ** level) % self.slots
+                slot = self.wheels[level][index]
+                self.wheels[level][index] = set()
+                for timer in slot:
+                    self.place(timer)
+
+            # every timer in the level 0 slot of this tick expires now
+            index = self.tick % self.slots
+            slot = self.wheels[0][index]
+            if slot:
+                self.wheels[0][index] = set()
+                expired.extend(slot)
+
+        # call after the wheel is consistent, the callbacks may schedule new timers
+        for timer in expired:
+            if timer.slot is not None:
+                timer.slot = None
+                timer.callback(*timer.args)
+
+class Histogram:
+    def __init__(self, bounds):
+        # upper bounds of the buckets, the last bucket has no upper bound
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        # bounds are sorted, so a binary search finds the bucket
+        lo, hi = 0, len(self.bounds)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if value <= self.bounds[mid]:
+                hi = mid
+            else:
+                lo = mid + 1
+        self.counts[lo] += 1
+        self.count += 1
+        self.sum += value
+
+    def buckets(self):
+        # cumulative (upper bound, count) pairs, like a Prometheus histogram
+        total = 0
+        result = []
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class Metrics:
+    def __init__(self):
+        # totals since the server started
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+
+        # per second rates of the last finished window
+        self.window_start = time.monotonic()
+        self.window_messages_in = 0
+        self.window_messages_out = 0
+        self.messages_in_per_sec = 0.0
+        self.messages_out_per_sec = 0.0
+
+        # broadcast duration in seconds, from 1 microsecond to about 1 second
+        self.broadcast_seconds = Histogram([2 ** i / 1000000 for i in range(21)])
+
+        # key: reason, value: number of disconnects
+        self.disconnects = Counter()
+
+        # presence events recorded, and presence frames sent
+        self.presence_events = 0
+        self.presence_frames = 0
+
+        # number of times a client was paused for its rate limit, and the seconds it stayed paused
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+        # messages relayed by other servers, and the copies of them that came back over a loop of links
+        self.relayed_in = 0
+        self.relay_duplicates = 0
+
+    def tick(self, now=None):
+        # close the current window when it is at least one second long
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.window_start
+        if elapsed < 1:
+            return
+
+        self.messages_in_per_sec = (self.messages_in - self.window_messages_in) / elapsed
+        self.messages_out_per_sec = (self.messages_out - self.window_messages_out) / elapsed
+        self.window_start = now
+        self.window_messages_in = self.messages_in
+        self.window_messages_out = self.messages_out
+
+class ChatServer:
+    def __init__(self, host=HOST, port=PORT, backend='selectors', high_water_mark=HIGH_WATER_MARK, slow_client_policy=SLOW_CLIENT_POLICY, reuse_port=False, admin_port=ADMIN_PORT, idle_timeout=IDLE_TIMEOUT, pong_timeout=PONG_TIMEOUT, timer_resolution=TIMER_RESOLUTION,
+                 message_rate=RATE_MESSAGES, message_burst=BURST_MESSAGES, byte_rate=RATE_BYTES, byte_burst=BURST_BYTES, log_dir=LOG_DIR, log_fsync_interval=LOG_FSYNC_INTERVAL,
+                 presence_interval=PRESENCE_INTERVAL, cluster_host=CLUSTER_HOST, cluster_port=CLUSTER_PORT, cluster_peers=(), node_id=None, max_rooms=MAX_ROOMS):
+        # define host and port
+        self.host = host
+        self.port = port
+
+        # create the selector, epoll on Linux when backend is 'selectors'
+        self.backend = backend
+        self.selector = make_selector(backend)
+
+        # connection ceiling, bounded by the open-file limit instead of FD_SETSIZE
+        self.max_connections = raise_fd_limit()
+
+        # create socket, reuse address, bind and listen with the largest backlog
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # with SO_REUSEPORT every worker listens on the same port and the kernel spreads the connections
+        if reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(socket.SOMAXCONN)
+        self.server_socket.setblocking(False)
+
+        # update the port when binding to port 0
+        self.port = self.server_socket.getsockname()[1]
+
+        # the data of each registration is the handler to call when the socket is read-ready
+        # so one event costs one dictionary lookup, no scan over all sockets
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
+
+        # key: client_socket, value: user
+        # key: user, value: client_socket, so a user is found by nickname in O(1)
+        self.clients = {}
+        self.nicknames = {}
+
+        # key: client_socket, value: OutboundQueue of the bytes not sent yet
+        self.queues = {}
+
+        # key: client_socket, value: FrameDecoder of the bytes received so far
+        self.decoders = {}
+
+        # key: client_socket, value: b'user: ' prefix of the messages of the client
+        self.prefixes = {}
+
+        # links to the other workers and to the other servers of the cluster, they get every message of the local clients
+        # the workers of a server are a full mesh, a message from a worker reached the other workers already
+        self.peers = set()
+        self.mesh = set()
+
+        # every message relayed from here is numbered, the other servers drop the copies they see again
+        # key: origin server id, value: RelayWindow of the numbers seen
+        self.node_id = node_id if node_id is not None else int.from_bytes(os.urandom(8), 'big')
+
+        # sequence numbers are counted by this process only, a resume from another worker or from before a restart
+        # has another epoch and gets the whole history, 48 bits so that any JSON parser keeps it exact
+        self.epoch = int.from_bytes(os.urandom(6), 'big')
+        self.relay_number = 0
+        self.relay_windows = {}
+
+        # links this server connects to, key: socket, value: (host, port)
+        # key: socket, value: (host, port) of a connection in progress
+        self.links = {}
+        self.connecting = {}
+
+        # key: room name, value: Room with its member sockets
+        # key: client_socket, value: Room of the client
+        self.rooms = {DEFAULT_ROOM: Room(DEFAULT_ROOM)}
+        self.client_rooms = {}
+
+        # names of the empty rooms kept for their history, the one empty the longest first
+        self.max_rooms = max_rooms
+        self.empty_rooms = {}
+
+        # what to do with a client whose queue grows over the high-water mark
+        if slow_client_policy not in ('disconnect', 'drop'):
+            raise ValueError(f'Unknown slow client policy: {slow_client_policy}')
+        self.high_water_mark = high_water_mark
+        self.slow_client_policy = slow_client_policy
+
+        self.metrics = Metrics()
+
+        # idle connections are found by a timer per connection, not by scanning every connection
+        # key: client_socket, value: time of the last received data
+        # key: client_socket, value: Timer of the next idle check
+        self.idle_timeout = idle_timeout
+        self.pong_timeout = pong_timeout
+        self.timer_wheel = TimerWheel(timer_resolution)
+        self.last_seen = {}
+        self.timers = {}
+
+        # clients that asked for sequence numbers, they can resume where they left off after a reconnect
+        self.sequenced = set()
+
+        # attachments being sent, key: client_socket, value: {transfer id of the client: Transfer}
+        # the server numbers the transfers itself, the ids of two clients may be the same
+        self.uploads = {}
+        self.next_transfer = 0
+
+        # clients that asked for presence events, and the rooms with events waiting for the next tick
+        # one timer for every room, it runs only while there are events
+        self.watching = set()
+        self.presence_interval = presence_interval
+        self.presence_rooms = set()
+        self.presence_timer = None
+
+        # clients that asked for compression, with the deflate stream of what they send
+        # a desynced client missed a compressed frame, it gets plain frames until its room starts a new stream
+        self.decompressors = {}
+        self.desynced = set()
+
+        # the rate limits of every client, checked before a message is fanned out
+        # key: client_socket, value: (message bucket, byte bucket), None for a disabled limit
+        # key: client_socket, value: (frames not handled yet, time) of a paused client
+        # key: client_socket, value: Timer that resumes a paused client
+        # key: client_socket, value: seconds the client was paused
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.buckets = {}
+        self.paused = {}
+        self.resume_timers = {}
+        self.throttled = {}
+
+        # the durable log of every broadcast, written by its own thread so the loop never waits for the disk
+        self.chat_log = ChatLog(log_dir, fsync_interval=log_fsync_interval) if log_dir is not None else None
+
+        # sockets to close as soon as their queue is sent, e.g. admin connections
+        self.closing = set()
+
+        # the admin socket is served by the same loop, an answer never blocks it
+        self.admin_socket = None
+        if admin_port is not None:
+            self.admin_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.admin_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.admin_socket.bind((ADMIN_HOST, admin_port))
+            self.admin_socket.listen()
+            self.admin_socket.setblocking(False)
+            self.admin_port = self.admin_socket.getsockname()[1]
+            self.selector.register(self.admin_socket, selectors.EVENT_READ, self.admin_accept)
+
+        # the other servers of the cluster connect to the cluster socket, this server connects to cluster_peers
+        self.cluster_socket = None
+        if cluster_port is not None:
+            self.cluster_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.cluster_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.cluster_socket.bind((cluster_host, cluster_port))
+            self.cluster_socket.listen()
+            self.cluster_socket.setblocking(False)
+            self.cluster_port = self.cluster_socket.getsockname()[1]
+            self.selector.register(self.cluster_socket, selectors.EVENT_READ, self.cluster_accept)
+        for address in cluster_peers:
+            self.connect_peer(tuple(address))
+
+    def main_loop(self):
+        logger.info(f'Listening for connections on {self.host}:{self.port} ({self.backend}, up to {self.max_connections} connections)...')
+        if self.admin_socket is not None:
+            logger.info(f'Metrics on {ADMIN_HOST}:{self.admin_port}')
+
+        # wake up at least every timer tick and every second, for the timers and the rates
+        timeout = min(1, self.timer_wheel.resolution)
+        while True:
+            self.loop_iteration(timeout)
+
+    def loop_iteration(self, timeout=None):
+        # only the ready sockets are returned, so the work is O(ready) and not O(connected)
+        for key, mask in self.selector.select(timeout):
+            # an earlier handler of this batch may have closed the socket, e.g. a broadcast that dropped a slow client
+            if key.fileobj.fileno() == -1:
+                continue
+
+            if mask & selectors.EVENT_READ:
+                handler = key.data
+                handler(key.fileobj)
+
+            # the read handler may have disconnected the socket already
+            if mask & selectors.EVENT_WRITE:
+                if key.fileobj in self.queues:
+                    self.flush(key.fileobj)
+                elif key.fileobj in self.connecting:
+                    self.connected(key.fileobj)
+
+        # the broadcasts of this iteration go to the log in one batch
+        if self.chat_log is not None:
+            self.chat_log.flush()
+        self.timer_wheel.advance()
+        self.metrics.tick()
+
+    def admin_accept(self, admin_socket):
+        try:
+            client_socket, _ = admin_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        client_socket.setblocking(False)
+        self.queues[client_socket] = OutboundQueue()
+        self.selector.register(client_socket, selectors.EVENT_READ, self.admin_read)
+
+    def admin_read(self, client_socket):
+        # the request is one line: 'json' or 'text'
+        data = self.recv(client_socket)
+        if data is None:
+            return
+        if not data:
+            self.disconnect(client_socket)
+            return
+
+        if data.strip().lower() == b'json':
+            answer = json.dumps(self.metrics_snapshot(), indent=2) + '\n'
+        else:
+            answer = self.metrics_text()
+
+        self.send_and_close(client_socket, answer.encode())
+
+    def send_and_close(self, client_socket, data):
+        # send the data and close, the queue sends it without blocking
+        self.closing.add(client_socket)
+        self.enqueue(client_socket, (data,))
+        if client_socket in self.queues and not len(self.queues[client_socket]):
+            self.disconnect(client_socket)
+
+    def metrics_snapshot(self):
+        metrics = self.metrics
+        metrics.tick()
+
+        # bytes waiting in the queues of the clients, the biggest ones by name
+        queued = [(len(self.queues[client_socket]), user) for client_socket, user in self.clients.items()]
+        largest = heapq.nlargest(10, queued)
+
+        # the clients paused the longest by their rate limit
+        throttled = heapq.nlargest(10, ((seconds, self.clients[client_socket]) for client_socket, seconds in self.throttled.items() if seconds))
+
+        return {
+            'connected_clients': len(self.clients),
+            'rooms': len(self.rooms),
+            'messages_in': metrics.messages_in,
+            'messages_out': metrics.messages_out,
+            'bytes_in': metrics.bytes_in,
+            'messages_in_per_sec': metrics.messages_in_per_sec,
+            'messages_out_per_sec': metrics.messages_out_per_sec,
+            'bytes_queued': sum(size for size, _ in queued),
+            'bytes_queued_largest': [{'user': user.decode(errors='replace'), 'bytes': size} for size, user in largest],
+            'broadcast_seconds': {
+                'count': metrics.broadcast_seconds.count,
+                'sum': metrics.broadcast_seconds.sum,
+                'buckets': [[bound if bound != float('inf') else '+Inf', count] for bound, count in metrics.broadcast_seconds.buckets()],
+            },
+            'disconnects': dict(metrics.disconnects),
+            'presence_events': metrics.presence_events,
+            'presence_frames': metrics.presence_frames,
+            'throttled': metrics.throttled,
+            'throttled_seconds': metrics.throttled_seconds,
+            'throttled_seconds_largest': [{'user': user.decode(errors='replace'), 'seconds': seconds} for seconds, user in throttled],
+            'peers': len(self.peers),
+            'relayed_in': metrics.relayed_in,
+            'relay_duplicates': metrics.relay_duplicates,
+        }
+
+    def metrics_text(self):
+        # one 'name value' line per metric
+        snapshot = self.metrics_snapshot()
+        lines = []
+        for name in ('connected_clients', 'rooms', 'messages_in', 'messages_out', 'bytes_in',
+                     'messages_in_per_sec', 'messages_out_per_sec', 'bytes_queued',
+                     'presence_events', 'presence_frames', 'throttled', 'throttled_seconds',
+                     'peers', 'relayed_in', 'relay_duplicates'):
+            lines.append(f'{name} {snapshot[name]}')
+        for entry in snapshot['bytes_queued_largest']:
+            lines.append(f'bytes_queued{{user="{entry["user"]}"}} {entry["bytes"]}')
+        for bound, count in snapshot['broadcast_seconds']['buckets']:
+            lines.append(f'broadcast_seconds_bucket{{le="{bound}"}} {count}')
+        lines.append(f"broadcast_seconds_count {snapshot['broadcast_seconds']['count']}")
+        lines.append(f"broadcast_seconds_sum {snapshot['broadcast_seconds']['sum']}")
+        for reason, count in sorted(snapshot['disconnects'].items()):
+            lines.append(f'disconnects{{reason="{reason}"}} {count}')
+        for entry in snapshot['throttled_seconds_largest']:
+            lines.append(f'throttled_seconds{{user="{entry["user"]}"}} {entry["seconds"]}')
+        return '\n'.join(lines) + '\n'
+
+    def accept(self, server_socket):
+        # accept connection
+        try:
+            client_socket, _ = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        # a slow reader must never block the loop, so every client socket is non-blocking
+        client_socket.setblocking(False)
+
+        # small messages go out right away, not after Nagle waits for the ack of the previous one (asyncio does the same)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # do not wait here for the nickname, a silent client would stall every other client
+        # the first frame from the client socket is handled as the nickname
+        self.decoders[client_socket] = FrameDecoder()
+        self.selector.register(client_socket, selectors.EVENT_READ, self.read)
+
+        # a client that never sends its nickname is reaped like an idle client
+        self.last_seen[client_socket] = time.monotonic()
+        self.timers[client_socket] = self.timer_wheel.schedule(self.idle_timeout, self.check_idle, client_socket)
+
+    def check_idle(self, client_socket):
+        # the timer of a client fired, the client may have sent something since it was scheduled
+        # so the wheel is only touched once per timeout, not once per message
+        idle = time.monotonic() - self.last_seen[client_socket]
+        if idle < self.idle_timeout:
+            self.timers[client_socket] = self.timer_wheel.schedule(self.idle_timeout - idle, self.check_idle, client_socket)
+            return
+
+        # a paused client is not read, it is waiting for its rate limit, not silent
+        if client_socket in self.paused:
+            self.timers[client_socket] = self.timer_wheel.schedule(self.idle_timeout, self.check_idle, client_socket)
+            return
+
+        # silent after the ping too, or never sent its nickname
+        if idle >= self.idle_timeout + self.pong_timeout or client_socket not in self.clients:
+            self.disconnect(client_socket, 'idle')
+            return
+
+        # ask the client to answer, any data from it counts as the answer
+        self.timers[client_socket] = self.timer_wheel.schedule(self.idle_timeout + self.pong_timeout - idle, self.check_idle, client_socket)
+        if not self.send(client_socket, (encode_frame(b'', FRAME_PING),)):
+            self.disconnect(client_socket, 'slow')
+
+    def add_peer(self, peer_socket, mesh=False):
+        # a peer is another worker, connected with a local (Unix) socket, or another server of the cluster
+        peer_socket.setblocking(False)
+        self.peers.add(peer_socket)
+        if mesh:
+            self.mesh.add(peer_socket)
+        self.decoders[peer_socket] = FrameDecoder()
+        self.queues[peer_socket] = OutboundQueue()
+        self.selector.register(peer_socket, selectors.EVENT_READ, self.read)
+
+    def cluster_accept(self, cluster_socket):
+        try:
+            peer_socket, address = cluster_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        logger.info('Accepted cluster link from %s:%s', *address[:2])
+        self.add_peer(peer_socket)
+
+    def connect_peer(self, address):
+        # connect without blocking the loop, the socket is write-ready when the connection is made or failed
+        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer_socket.setblocking(False)
+        error = peer_socket.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            peer_socket.close()
+            logger.warning('Cluster link to %s:%s failed: %s', *address[:2], os.strerror(error))
+            self.timer_wheel.schedule(CLUSTER_RETRY, self.connect_peer, address)
+            return
+
+        self.connecting[peer_socket] = address
+        self.selector.register(peer_socket, selectors.EVENT_WRITE)
+
+    def connected(self, peer_socket):
+        address = self.connecting.pop(peer_socket)
+        self.selector.unregister(peer_socket)
+        error = peer_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            peer_socket.close()
+            logger.warning('Cluster link to %s:%s failed: %s', *address[:2], os.strerror(error))
+            self.timer_wheel.schedule(CLUSTER_RETRY, self.connect_peer, address)
+            return
+
+        logger.info('Connected cluster link to %s:%s', *address[:2])
+        self.links[peer_socket] = address
+        self.add_peer(peer_socket)
+
+    def recv(self, client_socket):
+        # receive from a non-blocking socket
+        # return None if there is nothing to read yet, b'' if the connection is closed
+        try:
+            return client_socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return None
+        except OSError:
+            return b''
+
+    def read(self, client_socket):
+        # receive everything the client sent so far with one recv
+        data = self.recv(client_socket)
+        if data is None:
+            return
+
+        # empty data means the connection is closed
+        if not data:
+            self.disconnect(client_socket, 'closed')
+            return
+        self.metrics.bytes_in += len(data)
+        if client_socket in self.last_seen:
+            self.last_seen[client_socket] = time.monotonic()
+
+        # a burst of messages is decoded from one recv, a split message waits for the rest
+        try:
+            frames = self.decoders[client_socket].feed(data)
+        except ValueError:
+            self.disconnect(client_socket, 'protocol')
+            return
+
+        self.handle(client_socket, frames)
+
+    def handle(self, client_socket, frames):
+        for index, (kind, payload) in enumerate(frames):
+            # the client may have been disconnected by an earlier frame, or is being closed
+            if client_socket not in self.decoders or client_socket in self.closing:
+                return
+
+            # the rate limits are checked before the fan-out, attachment chunks count as bytes only
+            # a client over its limit is paused with the rest of its frames, nothing is dropped
+            if kind in (FRAME_MESSAGE, FRAME_DEFLATE, FRAME_ATTACHMENT) and client_socket in self.buckets:
+                wait = self.throttle(client_socket, len(payload), kind != FRAME_ATTACHMENT)
+                if wait:
+                    self.pause(client_socket, frames[index:], wait)
+                    return
+
+            if client_socket in self.peers:
+                if kind in (FRAME_RELAY, FRAME_RELAY_PRIVATE, FRAME_RELAY_PRESENCE):
+                    self.relayed(client_socket, payload, kind)
+            elif client_socket not in self.clients:
+                self.handshake(client_socket, kind, payload)
+            elif kind == FRAME_MESSAGE:
+                self.message(client_socket, payload)
+            elif kind == FRAME_DEFLATE and client_socket in self.decompressors:
+                try:
+                    message = inflate(self.decompressors[client_socket], payload)
+                except (ValueError, zlib.error):
+                    self.disconnect(client_socket, 'protocol')
+                    return
+                self.message(client_socket, message)
+            elif kind == FRAME_ATTACHMENT:
+                self.attachment(client_socket, payload)
+            elif kind == FRAME_TYPING:
+                self.presence(self.client_rooms[client_socket], self.clients[client_socket], PRESENCE_TYPING)
+            elif kind == FRAME_PING:
+                self.send(client_socket, (encode_frame(b'', FRAME_PONG),))
+
+    def throttle(self, client_socket, size, messages=1):
+        # seconds until the client may send a frame of size bytes, 0 if it may send it now
+        # the tokens are taken only when every bucket has enough
+        now = time.monotonic()
+        buckets = [(bucket, amount) for bucket, amount in zip(self.buckets[client_socket], (messages, size)) if bucket is not None]
+        wait = max(bucket.wait(amount, now) for bucket, amount in buckets)
+        if not wait:
+            for bucket, amount in buckets:
+                bucket.take(amount)
+        return wait
+
+    def pause(self, client_socket, frames, wait):
+        # stop reading the client until its buckets refill
+        # what it sends meanwhile stays in the kernel buffers, and TCP slows the sender down
+        self.paused[client_socket] = (frames, time.monotonic())
+        self.resume_timers[client_socket] = self.timer_wheel.schedule(wait, self.resume, client_socket)
+        self.metrics.throttled += 1
+        self.update_events(client_socket)
+
+    def resume(self, client_socket):
+        frames, since = self.paused.pop(client_socket)
+        del self.resume_timers[client_socket]
+        now = time.monotonic()
+        self.throttled[client_socket] += now - since
+        self.metrics.throttled_seconds += now - since
+
+        # read again, after the frames decoded before the pause, which may pause the client again
+        self.last_seen[client_socket] = now
+        self.update_events(client_socket)
+        self.handle(client_socket, frames)
+
+    def handshake(self, client_socket, kind, user):
+        # the first frame is the nickname, or a hello with the nickname and the options
+        options = {}
+        if kind == FRAME_HELLO:
+            try:
+                user, options = decode_hello(user)
+            except ValueError:
+                user = b''
+
+        # empty nickname is not allowed
+        if not user:
+            self.disconnect(client_socket, 'protocol')
+            return
+
+        # a resuming client names its room, the last sequence number it got and the epoch of the numbers
+        room_name, since, epoch = DEFAULT_ROOM, None, None
+        resume = options.get('resume')
+        if resume is not None:
+            try:
+                room_name, since, epoch = resume['room'].encode(), resume['seq'], resume.get('epoch')
+                # a JSON number, not a float (1e400 is infinity) and not true or false
+                if not isinstance(since, int) or isinstance(since, bool) or since < 0:
+                    raise ValueError(since)
+            except (KeyError, TypeError, AttributeError, ValueError):
+                room_name = b''
+            if not room_name or len(room_name) > MAX_ROOM_NAME:
+                self.disconnect(client_socket, 'protocol')
+                return
+
+        # a nickname is used by one client at a time on this server (or worker)
+        # the other workers and cluster servers have their own clients, a nickname is not checked against them
+        if user in self.nicknames:
+            self.metrics.disconnects['duplicate'] += 1
+            self.queues[client_socket] = OutboundQueue()
+            self.send_and_close(client_socket, encode_frame(f'Nickname {user.decode(errors="replace")} is already taken\n'.encode()))
+            return
+
+        # add client socket and user to the clients dictionary and the nickname index
+        self.clients[client_socket] = user
+        self.nicknames[user] = client_socket
+        self.queues[client_socket] = OutboundQueue()
+        self.uploads[client_socket] = {}
+        if self.message_rate or self.byte_rate:
+            self.buckets[client_socket] = (TokenBucket(self.message_rate, self.message_burst) if self.message_rate else None,
+                                           TokenBucket(self.byte_rate, self.byte_burst) if self.byte_rate else None)
+            self.throttled[client_socket] = 0.0
+
+        # the frames of a room are either sequenced or compressed, sequence numbers win
+        if options.get('sequence') or resume is not None:
+            self.sequenced.add(client_socket)
+        elif options.get('compress'):
+            self.decompressors[client_socket] = decompressor()
+        if options.get('presence'):
+            self.watching.add(client_socket)
+
+        # the encoded "user: " prefix of every message of the client, built once
+        self.prefixes[client_socket] = user + b': '
+        # a resumed room that cannot be created any more is replaced by the default room
+        if not self.join(client_socket, room_name, since, epoch):
+            self.join(client_socket, DEFAULT_ROOM)
+        logger.info('Accepted new connection from %s:%s, nickname: %s', *client_socket.getpeername()[:2], user.decode(errors='replace'))
+
+    def join(self, client_socket, name, since=None, epoch=None):
+        # return False if the room does not exist and there is no place for a new one, the client stays where it is
+        # the room the client leaves makes place too when the client is its last member
+        current = self.client_rooms.get(client_socket)
+        freed = current is not None and current.name != DEFAULT_ROOM and len(current.members) == 1
+        if name not in self.rooms and name != DEFAULT_ROOM and self.rooms_full() and not self.empty_rooms and not freed:
+            return False
+
+        # leave the current room first, a client is in one room at a time
+        self.leave(client_socket)
+
+        room = self.rooms.get(name)
+        if room is None:
+            # the room empty the longest makes place for the new one
+            if name != DEFAULT_ROOM and self.rooms_full():
+                oldest = next(iter(self.empty_rooms))
+                del self.empty_rooms[oldest]
+                del self.rooms[oldest]
+            room = self.rooms[name] = Room(name)
+        self.empty_rooms.pop(name, None)
+        room.members.add(client_socket)
+        self.client_rooms[client_socket] = room
+        if client_socket in self.watching:
+            room.watchers.add(client_socket)
+        self.presence(room, self.clients[client_socket], PRESENCE_JOIN)
+
+        # a sequenced client gets the messages after since, or the whole history
+        if client_socket in self.sequenced:
+            room.sequenced_members += 1
+            self.catch_up(client_socket, room, since, epoch)
+            return True
+
+        # the new member cannot decompress the current stream of the room, start a new one
+        if client_socket in self.decompressors:
+            room.compressed_members += 1
+            room.compressor = None
+
+        # replay the recent messages of the room
+        if len(room.history):
+            self.send(client_socket, (room.history.replay(),))
+        return True
+
+    def catch_up(self, client_socket, room, since, epoch=None):
+        # the room and the number the replay starts after, then only the frames after since, in one send
+        # numbers of another epoch (another worker, or this one before a restart) or that the room never reached
+        # say nothing about this room, the client gets the whole history
+        resuming = since is not None and epoch == self.epoch and since <= room.seq
+        if not resuming:
+            since = 0
+        frames = room.history.since(since)
+        start = frames[0][0] - 1 if frames else room.seq
+
+        data = [encode_room(start, self.epoch, room.name)]
+        for seq, parts in frames:
+            length = sum(len(part) for part in parts[1:])
+            data.append(HEADER.pack(SEQUENCE.size + length, FRAME_SEQUENCED) + SEQUENCE.pack(seq))
+            data.extend(parts[1:])
+        self.send(client_socket, (b''.join(data),))
+
+        # the oldest messages of the gap are no longer in the history
+        if resuming and start > since:
+            self.notice(client_socket, f'{start - since} messages are no longer available\n')
+
+    def rooms_full(self):
+        # the default room is not counted against max_rooms
+        return len(self.rooms) - (DEFAULT_ROOM in self.rooms) >= self.max_rooms
+
+    def leave(self, client_socket):
+        room = self.client_rooms.pop(client_socket, None)
+        if room is None:
+            return
+
+        # forget empty rooms without history, except the default room, the others wait in empty_rooms
+        room.members.discard(client_socket)
+        room.watchers.discard(client_socket)
+        self.presence(room, self.clients[client_socket], PRESENCE_LEAVE)
+        if client_socket in self.sequenced:
+            room.sequenced_members -= 1
+        if client_socket in self.decompressors:
+            room.compressed_members -= 1
+        self.desynced.discard(client_socket)
+        if not room.members and room.name != DEFAULT_ROOM:
+            if len(room.history):
+                self.empty_rooms[room.name] = None
+            else:
+                del self.rooms[room.name]
+
+    def presence(self, room, user, event):
+        # record a join, leave or typing event, sent with the other events of the room at the next tick
+        # only the net change of a tick is sent: a join and a leave cancel out, typing is sent once
+        # the other workers and servers may have watchers of the room, the events are relayed to them
+        if not room.watchers and not self.peers:
+            return
+        self.metrics.presence_events += 1
+
+        pending = room.presence.get(user)
+        if event == PRESENCE_TYPING:
+            # a join says more than typing, and typing again changes nothing
+            if pending is not None:
+                return
+            room.presence[user] = event
+        elif pending in (PRESENCE_JOIN, PRESENCE_LEAVE) and pending != event:
+            del room.presence[user]
+        else:
+            room.presence[user] = event
+
+        self.presence_rooms.add(room)
+        if self.presence_timer is None:
+            self.presence_timer = self.timer_wheel.schedule(self.presence_interval, self.flush_presence)
+
+    def flush_presence(self):
+        # one frame per room with events, shared by its watchers
+        # so the traffic is one frame per watcher per tick, however many events happened
+        self.presence_timer = None
+        rooms, self.presence_rooms = self.presence_rooms, set()
+
+        for room in rooms:
+            if not room.presence:
+                continue
+            frame = encode_frame(encode_presence((event, user) for user, event in room.presence.items()), FRAME_PRESENCE)
+            room.presence = {}
+            self.send_presence(room, frame)
+            self.relay(room.name, (frame,), kind=FRAME_RELAY_PRESENCE)
+
+    def send_presence(self, room, frame):
+        # the same frame for every watcher of the room, from this server or relayed
+        lagging = []
+        for client_socket in room.watchers:
+            if self.send(client_socket, (frame,)):
+                self.metrics.presence_frames += 1
+            else:
+                lagging.append(client_socket)
+
+        # disconnect outside the loop because it changes the watchers
+        for client_socket in lagging:
+            self.disconnect(client_socket, 'slow')
+
+    def attachment(self, client_socket, payload):
+        # a part of an attachment, forwarded to the members of the room the transfer started in
+        try:
+            client_transfer, part, data = decode_attachment(payload)
+        except struct.error:
+            self.disconnect(client_socket, 'protocol')
+            return
+        uploads = self.uploads[client_socket]
+
+        if part == ATTACHMENT_START:
+            try:
+                start = json.loads(bytes(data))
+                name, size = start['name'], start['size']
+                if not isinstance(name, str) or not isinstance(size, int) or size < 0 or client_transfer in uploads:
+                    raise ValueError(start)
+            except (ValueError, TypeError, KeyError):
+                self.disconnect(client_socket, 'protocol')
+                return
+
+            # the chunks of a refused attachment have no transfer, they are ignored
+            if size > MAX_ATTACHMENT_SIZE:
+                self.notice(client_socket, f'Attachment {name} is bigger than {MAX_ATTACHMENT_SIZE} bytes\n')
+                return
+
+            room = self.client_rooms[client_socket]
+            transfer = uploads[client_transfer] = Transfer(self.next_transfer, size, room.members - {client_socket})
+            self.next_transfer = (self.next_transfer + 1) % 2 ** 32
+            data = json.dumps({'name': name, 'size': size, 'from': self.clients[client_socket].decode(errors='replace')}).encode()
+            self.forward(transfer, ATTACHMENT_START, data)
+            return
+
+        transfer = uploads.get(client_transfer)
+        if transfer is None:
+            return
+
+        if part == ATTACHMENT_CHUNK:
+            # more bytes than announced is a protocol error
+            transfer.remaining -= len(data)
+            if transfer.remaining < 0:
+                self.disconnect(client_socket, 'protocol')
+                return
+            self.forward(transfer, ATTACHMENT_CHUNK, data)
+        elif part == ATTACHMENT_END:
+            del uploads[client_transfer]
+            self.forward(transfer, ATTACHMENT_END)
+
+    def forward(self, transfer, part, data=b''):
+        # queue one part for every recipient, with the transfer id, so the queue interleaves it fairly
+        parts = (HEADER.pack(ATTACHMENT.size + len(data), FRAME_ATTACHMENT), ATTACHMENT.pack(transfer.id, part), data)
+        length = HEADER.size + ATTACHMENT.size + len(data)
+
+        gone = []
+        lagging = []
+        for client_socket in transfer.recipients:
+            if client_socket not in self.clients:
+                gone.append(client_socket)
+            elif not self.send(client_socket, parts, length, transfer.id):
+                lagging.append(client_socket)
+        transfer.recipients.difference_update(gone)
+
+        # disconnect outside the loop because it changes the clients dictionary
+        for client_socket in lagging:
+            self.disconnect(client_socket, 'slow')
+
+    def command(self, client_socket, message):
+        # handle a /command, return False if the message is not a command
+        parts = message.strip().split(maxsplit=1)
+        if not parts:
+            return False
+
+        if parts[0] == b'/msg':
+            # the text keeps its trailing newline, like a broadcast message
+            parts = message.split(maxsplit=2)
+            if len(parts) != 3:
+                self.notice(client_socket, 'Usage: /msg <nickname> <text>\n')
+                return True
+            self.private(client_socket, parts[1], parts[2])
+            return True
+
+        if parts[0] == b'/join' and len(parts) == 2:
+            name = parts[1]
+            if len(name) > MAX_ROOM_NAME:
+                self.notice(client_socket, f'Room name is longer than {MAX_ROOM_NAME} bytes\n')
+                return True
+
+            # room names are text, they are sent back in notices and in FRAME_ROOM
+            try:
+                name.decode()
+            except UnicodeDecodeError:
+                self.notice(client_socket, 'Room name is not valid UTF-8\n')
+                return True
+            if not self.join(client_socket, name):
+                self.notice(client_socket, f'Too many rooms, {name.decode()} cannot be created\n')
+                return True
+            self.notice(client_socket, f'You joined {name.decode()}\n')
+            return True
+
+        if parts[0] == b'/leave':
+            self.join(client_socket, DEFAULT_ROOM)
+            self.notice(client_socket, f'You joined {DEFAULT_ROOM.decode()}\n')
+            return True
+
+        if parts[0] == b'/history':
+            self.history(client_socket, message.split()[1:])
+            return True
+
+        if parts[0] == b'/rooms':
+            lines = [f'{name.decode(errors="replace")}: {members} members, {messages} messages\n' for name, members, messages in self.room_stats()]
+            self.notice(client_socket, ''.join(lines))
+            return True
+
+        return False
+
+    def private(self, client_socket, nickname, text):
+        # deliver a message to one user, found in the nickname index without scanning the clients
+        target = self.nicknames.get(nickname)
+        prefix = self.clients[client_socket] + b' (private): '
+        parts = (HEADER.pack(len(prefix) + len(text), FRAME_MESSAGE), prefix, text)
+        if target is None:
+            # the user may be on another worker or cluster server, they get it over the links
+            # nobody answers when no server has the user, so only a server without links says so
+            if self.peers and len(nickname) <= MAX_NICKNAME_RELAY:
+                self.relay(nickname, parts, kind=FRAME_RELAY_PRIVATE)
+            else:
+                self.notice(client_socket, f'No such user: {nickname.decode(errors="replace")}\n')
+            return
+
+        if not self.send(target, parts):
+            self.disconnect(target, 'slow')
+            return
+        self.metrics.messages_out += 1
+
+    def history(self, client_socket, arguments):
+        # '/history since <time>', the messages of the room of the client from the log
+        if self.chat_log is None:
+            self.notice(client_socket, 'History is not logged on this server\n')
+            return
+        try:
+            if len(arguments) != 2 or arguments[0] != b'since':
+                raise ValueError(arguments)
+            since = parse_since(arguments[1])
+        except ValueError:
+            self.notice(client_socket, 'Usage: /history since <unix time | 30s | 15m | 2h | 1d>\n')
+            return
+
+        # the answer fits under the high-water mark with what is already waiting, the frame headers count too
+        # the first message is always taken, an empty queue takes one frame of any size
+        queue = self.queues[client_socket]
+        max_bytes = max(0, min(HISTORY_QUERY_BYTES, self.high_water_mark - len(queue)))
+        texts, more = self.chat_log.since(since, self.client_rooms[client_socket].name, HISTORY_QUERY_MESSAGES, max_bytes, HISTORY_QUERY_SCAN, HEADER.size)
+        answer = [b''.join(HEADER.pack(len(text), FRAME_MESSAGE) + text for text in texts)] if texts else []
+
+        # send() would drop an answer over the mark, or disconnect the client, the client is told instead
+        # the notices are queued past the mark, they are small and a client never loses the reason it got less
+        if answer and len(queue) and len(queue) + len(answer[0]) > self.high_water_mark:
+            answer = [encode_frame(b'Too much is waiting to be sent, ask again later\n')]
+        elif more is not None:
+            answer.append(encode_frame(f'Stopped after {len(texts)} messages, ask again with /history since {more!r}\n'.encode()))
+        if answer and not self.enqueue(client_socket, tuple(answer)):
+            self.disconnect(client_socket)
+
+    def notice(self, client_socket, text):
+        # a message from the server to one client
+        self.send(client_socket, (encode_frame(text.encode()),))
+
+    def room_stats(self):
+        # (name, local members, messages) of every room
+        return [(room.name, len(room.members), room.messages) for room in self.rooms.values()]
+
+    def message(self, client_socket, message):
+        # commands are answered to the client only
+        if message.startswith(b'/') and self.command(client_socket, message):
+            return
+
+        self.metrics.messages_in += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            user = self.clients[client_socket]
+            logger.debug('Received message from %s: %s', user.decode(errors='replace'), message.decode(errors='replace'))
+
+        # broadcast message with nickname prefixed to the room of the client
+        # the frame is the header, the cached prefix and the received payload, nothing is decoded or copied
+        # every queue holds the same three objects and sendmsg gathers them
+        room = self.client_rooms[client_socket]
+        prefix = self.prefixes[client_socket]
+        parts = (HEADER.pack(len(prefix) + len(message), FRAME_MESSAGE), prefix, message)
+        self.broadcast(parts, client_socket, room)
+        self.relay(room.name, parts)
+
+    def relay(self, room_name, parts, origin=None, number=None, source=None, kind=FRAME_RELAY):
+        # send the message once on every link but the one it came from, the other side fans it out and relays it further
+        # a FRAME_RELAY_PRIVATE carries the nickname of the recipient in place of the room name
+        if not self.peers:
+            return
+
+        # a message of a local client is numbered here
+        if origin is None:
+            self.relay_number += 1
+            origin, number = self.node_id, self.relay_number
+
+        # relay payload: origin, number, room name length, room name, message frame
+        relay_header = RELAY.pack(origin, number, len(room_name)) + room_name
+        length = len(relay_header) + sum(len(part) for part in parts)
+        frame = (HEADER.pack(length, kind), relay_header) + tuple(parts)
+        from_mesh = source in self.mesh
+        for peer_socket in list(self.peers):
+            if peer_socket is source or from_mesh and peer_socket in self.mesh:
+                continue
+
+            # a peer is never dropped for lagging, its queue has no high-water mark
+            if not self.enqueue(peer_socket, frame):
+                self.disconnect(peer_socket, 'peer')
+
+    def relayed(self, peer_socket, payload, kind=FRAME_RELAY):
+        # a message of a client of another server or worker, for the local members of the room and the other links
+        try:
+            origin, number, room_name, message = decode_relay(payload)
+        except (struct.error, IndexError):
+            self.disconnect(peer_socket, 'protocol')
+            return
+
+        # the message came back over a loop of links, or it is one of ours
+        # the dict is in the order the origins were last heard from, the first one makes place for a new one
+        window = self.relay_windows.pop(origin, None)
+        if window is None:
+            window = RelayWindow()
+            if len(self.relay_windows) >= RELAY_ORIGINS:
+                del self.relay_windows[next(iter(self.relay_windows))]
+        self.relay_windows[origin] = window
+        if origin == self.node_id or not window.add(number):
+            self.metrics.relay_duplicates += 1
+            return
+        self.metrics.relayed_in += 1
+
+        # a private message stops at the server of its recipient
+        if kind == FRAME_RELAY_PRIVATE:
+            target = self.nicknames.get(room_name)
+            if target is None:
+                self.relay(room_name, (message,), origin, number, peer_socket, kind)
+            elif self.send(target, (message,)):
+                self.metrics.messages_out += 1
+            else:
+                self.disconnect(target, 'slow')
+            return
+
+        # the presence events of a tick of another server, for the local watchers as they are
+        if kind == FRAME_RELAY_PRESENCE:
+            room = self.rooms.get(room_name)
+            if room is not None:
+                self.send_presence(room, message)
+            self.relay(room_name, (message,), origin, number, peer_socket, kind)
+            return
+
+        room = self.rooms.get(room_name)
+        if room is not None:
+            # split the header from the text, without copying
+            view = memoryview(message)
+            self.broadcast((view[:HEADER.size], view[HEADER.size:]), None, room)
+        self.relay(room_name, (message,), origin, number, peer_socket)
+
+    def compress(self, room, parts):
+        # compress the message once for every compressed member of the room
+        # return the parts for the members and for the sender, which only feeds them to its stream
+        reset = ()
+        if room.compressor is None:
+            room.compressor = compressor()
+            reset = (encode_frame(b'', FRAME_DEFLATE_RESET),)
+
+            # every member starts the new stream, so the desynced ones are in sync again
+            self.desynced.difference_update(room.members)
+
+        # parts[0] is the header of the plain frame, the rest is the text
+        data = deflate(room.compressor, b''.join(parts[1:]))
+        return (reset + (HEADER.pack(len(data), FRAME_DEFLATE), data),
+                reset + (HEADER.pack(len(data), FRAME_DEFLATE_ECHO), data))
+
+    def broadcast(self, parts, sender_socket, room):
+        # queue the message for every member of the room except the sender, nothing here blocks
+        # the cost is O(members of the room), not O(connected clients)
+        start = time.perf_counter()
+        room.messages += 1
+        room.seq += 1
+        room.history.append(parts, room.seq)
+        if self.chat_log is not None:
+            self.chat_log.append(room.name, b''.join(parts[1:]))
+        length = sum(len(part) for part in parts)
+
+        # sequenced members get the same text after the sequence number of the message
+        if room.sequenced_members:
+            sequenced = (HEADER.pack(length - HEADER.size + SEQUENCE.size, FRAME_SEQUENCED), SEQUENCE.pack(room.seq)) + tuple(parts[1:])
+            sequenced_length = length + SEQUENCE.size
+
+        # compressed members get the same compressed parts, built once
+        if room.compressed_members:
+            compressed, echo = self.compress(room, parts)
+            compressed_length = sum(len(part) for part in compressed)
+
+        lagging = []
+        sent = 0
+        for client_socket in room.members:
+            if client_socket in self.decompressors and client_socket not in self.desynced:
+                # a compressed sender must see its message too, or its stream would miss it
+                if client_socket == sender_socket:
+                    ok = self.send(client_socket, echo, compressed_length)
+                else:
+                    ok = self.send(client_socket, compressed, compressed_length)
+                    sent += ok
+            elif client_socket in self.sequenced:
+                # a sequenced sender gets its own message too, so every number reaches it and a gap is a lost message
+                ok = self.send(client_socket, sequenced, sequenced_length)
+                sent += ok and client_socket != sender_socket
+            elif client_socket == sender_socket:
+                continue
+            else:
+                ok = self.send(client_socket, parts, length)
+                sent += ok
+            if not ok:
+                lagging.append(client_socket)
+
+        # disconnect outside the loop because it changes the clients dictionary
+        for client_socket in lagging:
+            self.disconnect(client_socket, 'slow')
+
+        self.metrics.messages_out += sent
+        self.metrics.broadcast_seconds.observe(time.perf_counter() - start)
+
+    def send(self, client_socket, parts, length=None, transfer=None):
+        # queue the parts of a frame for a client and try to send them right away
+        # return False if the client lags too far behind and must be disconnected
+        queue = self.queues[client_socket]
+        if length is None:
+            length = sum(len(part) for part in parts)
+
+        # a client over the high-water mark is not reading, drop or disconnect it
+        # an empty queue takes one frame of any size, a frame may be bigger than the mark (up to MAX_FRAME_SIZE)
+        if len(queue) and len(queue) + length > self.high_water_mark:
+            if self.slow_client_policy == 'disconnect':
+                return False
+
+            # a compressed client that misses a frame cannot decompress the next ones
+            if client_socket in self.decompressors and client_socket not in self.desynced:
+                self.desynced.add(client_socket)
+                self.client_rooms[client_socket].compressor = None
+            return True
+
+        return self.enqueue(client_socket, parts, transfer)
+
+    def enqueue(self, client_socket, parts, transfer=None):
+        # add the parts to the queue of the socket, return False if the socket is broken
+        queue = self.queues[client_socket]
+        was_empty = not len(queue)
+        queue.append(parts, transfer)
+
+        # only wait for write-ready when the queue was empty before
+        # otherwise the socket is already in the write set
+        if was_empty:
+            try:
+                queue.send(client_socket)
+            except OSError:
+                return False
+            if len(queue):
+                self.update_events(client_socket)
+
+        return True
+
+    def flush(self, client_socket):
+        # the socket is write-ready, send what is waiting in its queue
+        queue = self.queues[client_socket]
+        try:
+            queue.send(client_socket)
+        except OSError:
+            self.disconnect(client_socket, 'error')
+            return
+
+        # stop waiting for write-ready when the queue is empty
+        if not len(queue):
+            if client_socket in self.closing:
+                self.disconnect(client_socket)
+                return
+            self.update_events(client_socket)
+
+    def update_events(self, client_socket):
+        # read unless the client is paused, wait for write-ready while its queue is not empty
+        events = 0 if client_socket in self.paused else selectors.EVENT_READ
+        if len(self.queues.get(client_socket, ())):
+            events |= selectors.EVENT_WRITE
+
+        try:
+            key = self.selector.get_key(client_socket)
+        except KeyError:
+            key = None
+
+        # a selector cannot wait for no event, a paused client with nothing to send is unregistered
+        if not events:
+            if key is not None:
+                self.selector.unregister(client_socket)
+        elif key is None:
+            self.selector.register(client_socket, events, self.read)
+        elif key.events != events:
+            self.selector.modify(client_socket, events, key.data)
+
+    def disconnect(self, client_socket, reason='closed'):
+        # a socket is disconnected once, a second call (e.g. from a stale event) does nothing
+        if client_socket.fileno() == -1:
+            return
+
+        # leave the room first, the leave event needs the nickname
+        self.leave(client_socket)
+
+        # the attachments the client was sending will not end
+        for transfer in self.uploads.pop(client_socket, {}).values():
+            self.forward(transfer, ATTACHMENT_ABORT)
+        user = self.clients.pop(client_socket, None)
+        if user is not None:
+            del self.nicknames[user]
+        self.queues.pop(client_socket, None)
+        self.decoders.pop(client_socket, None)
+        self.prefixes.pop(client_socket, None)
+        self.peers.discard(client_socket)
+        self.mesh.discard(client_socket)
+        address = self.links.pop(client_socket, None)
+        self.closing.discard(client_socket)
+        self.sequenced.discard(client_socket)
+        self.watching.discard(client_socket)
+        self.decompressors.pop(client_socket, None)
+        self.last_seen.pop(client_socket, None)
+        timer = self.timers.pop(client_socket, None)
+        if timer is not None:
+            self.timer_wheel.cancel(timer)
+        self.buckets.pop(client_socket, None)
+        self.paused.pop(client_socket, None)
+        self.throttled.pop(client_socket, None)
+        timer = self.resume_timers.pop(client_socket, None)
+        if timer is not None:
+            self.timer_wheel.cancel(timer)
+        if user is not None:
+            self.metrics.disconnects[reason] += 1
+            logger.info('Closed connection from: %s (%s)', user.decode(errors='replace'), reason)
+
+        # unregister and close socket, a paused client may not be registered
+        if client_socket in self.selector.get_map():
+            self.selector.unregister(client_socket)
+        client_socket.close()
+
+        # a lost link to another server is connected again
+        if address is not None and reason != 'shutdown':
+            logger.warning('Cluster link to %s:%s lost (%s)', *address[:2], reason)
+            self.timer_wheel.schedule(CLUSTER_RETRY, self.connect_peer, address)
+
+    def close(self):
+        for client_socket in list(self.decoders) + list(self.closing):
+            self.disconnect(client_socket, 'shutdown')
+        for peer_socket in list(self.connecting):
+            del self.connecting[peer_socket]
+            self.selector.unregister(peer_socket)
+            peer_socket.close()
+        for listening_socket in (self.server_socket, self.admin_socket, self.cluster_socket):
+            if listening_socket is not None:
+                self.selector.unregister(listening_socket)
+                listening_socket.close()
+        if self.chat_log is not None:
+            self.chat_log.close()
+        self.selector.close()
+
+class ChatProtocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+        # nickname of the client, None until the first frame is received
+        self.user = None
+        self.decoder = FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        # the same framing as ChatServer, many frames may come in one call
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError:
+            self.transport.abort()
+            return
+
+        for kind, payload in frames:
+            if self.transport.is_closing():
+                return
+
+            if self.user is None:
+                self.server.handshake(self, payload)
+            elif kind == FRAME_MESSAGE:
+                self.server.message(self, payload)
+
+    def connection_lost(self, exc):
+        self.server.disconnect(self)
+
+class AsyncChatServer:
+    def __init__(self, host=HOST, port=PORT, high_water_mark=HIGH_WATER_MARK, slow_client_policy=SLOW_CLIENT_POLICY):
+        # define host and port
+        self.host = host
+        self.port = port
+
+        # the transport buffers what cannot be sent yet, like OutboundQueue in ChatServer
+        if slow_client_policy not in ('disconnect', 'drop'):
+            raise ValueError(f'Unknown slow client policy: {slow_client_policy}')
+        self.high_water_mark = high_water_mark
+        self.slow_client_policy = slow_client_policy
+
+        # key: ChatProtocol, value: user
+        self.clients = {}
+        self.server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: ChatProtocol(self), self.host, self.port, reuse_address=True, backlog=socket.SOMAXCONN)
+
+        # update the port when binding to port 0
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def main_loop(self):
+        await self.start()
+        logger.info(f'Listening for connections on {self.host}:{self.port} (asyncio)...')
+        async with self.server:
+            await self.server.serve_forever()
+
+    def handshake(self, protocol, user):
+        # empty nickname is not allowed
+        if not user:
+            protocol.transport.close()
+            return
+
+        # add protocol and user to the clients dictionary
+        protocol.user = user
+        self.clients[protocol] = user
+        logger.info('Accepted new connection from %s:%s, nickname: %s', *protocol.transport.get_extra_info('peername')[:2], user.decode(errors='replace'))
+
+    def message(self, protocol, message):
+        user = protocol.user
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Received message from %s: %s', user.decode(errors='replace'), message.decode(errors='replace'))
+
+        # broadcast message with nickname prefixed, the bytes as they came, like ChatServer
+        full_message = encode_frame(user + b': ' + message)
+        self.broadcast(full_message, protocol)
+
+    def broadcast(self, message, sender):
+        lagging = []
+        for protocol in self.clients:
+            if protocol == sender:
+                continue
+
+            # a client over the high-water mark is not reading, drop or disconnect it
+            transport = protocol.transport
+            buffered = transport.get_write_buffer_size()
+            if buffered and buffered + len(message) > self.high_water_mark:
+                if self.slow_client_policy == 'disconnect':
+                    lagging.append(protocol)
+                continue
+
+            transport.write(message)
+
+        # abort outside the loop because it changes the clients dictionary
+        for protocol in lagging:
+            protocol.transport.abort()
+            self.disconnect(protocol)
+
+    def disconnect(self, protocol):
+        user = self.clients.pop(protocol, None)
+        if user is not None:
+            logger.info('Closed connection from: %s', user.decode(errors='replace'))
+
+    async def close(self):
+        for protocol in list(self.clients):
+            protocol.transport.abort()
+        self.server.close()
+        await self.server.wait_closed()
+
+def run_worker(backend, peer_sockets, log_dir=None, log_fsync_interval=LOG_FSYNC_INTERVAL, cluster_host=CLUSTER_HOST, cluster_port=None, cluster_peers=()):
+    # one worker of the multi-process server, every worker accepts on the same port
+    # every worker broadcasts every message, so each one keeps a whole log in its own directory
+    server = ChatServer(HOST, PORT, backend, reuse_port=True, log_dir=log_dir, log_fsync_interval=log_fsync_interval, cluster_host=cluster_host, cluster_port=cluster_port, cluster_peers=cluster_peers)
+    for peer_socket in peer_sockets:
+        server.add_peer(peer_socket, mesh=True)
+    server.main_loop()
+
+def start_workers(workers, backend, log_dir=None, log_fsync_interval=LOG_FSYNC_INTERVAL, cluster_host=CLUSTER_HOST, cluster_port=None, cluster_peers=()):
+    # connect every pair of workers with a Unix socket pair (a full mesh)
+    # so a message crosses exactly one link to reach each other worker
+    links = [[] for _ in range(workers)]
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            left, right = socket.socketpair()
+            links[i].append(left)
+            links[j].append(right)
+
+    # the first worker links the server to the cluster, the others reach it through the mesh
+    processes = []
+    for i in range(workers):
+        worker_log_dir = os.path.join(log_dir, f'worker{i}') if log_dir is not None else None
+        cluster = (cluster_host, cluster_port, cluster_peers) if i == 0 else (cluster_host, None, ())
+        process = multiprocessing.Process(target=run_worker, args=(backend, links[i], worker_log_dir, log_fsync_interval, *cluster), daemon=True)
+        process.start()
+        processes.append(process)
+
+    # the sockets now belong to the workers
+    for worker_links in links:
+        for peer_socket in worker_links:
+            peer_socket.close()
+
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+
+def start_server(backend=BACKEND, workers=1, admin_port=ADMIN_PORT, log_dir=LOG_DIR, log_fsync_interval=LOG_FSYNC_INTERVAL, cluster_host=CLUSTER_HOST, cluster_port=CLUSTER_PORT, cluster_peers=()):
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(message)s')
+
+    # only ChatServer relays to other workers and servers
+    if (workers > 1 or cluster_port is not None or cluster_peers) and backend in ('select', 'asyncio'):
+        backend = 'selectors'
+
+    # use many processes, one ChatServer each, so a room spans all cores
+    if workers > 1:
+        start_workers(workers, backend, log_dir, log_fsync_interval, cluster_host, cluster_port, cluster_peers)
+        return
+
+    # use the asyncio based server
+    if backend == 'asyncio':
+        server = AsyncChatServer(HOST, PORT)
+        asyncio.run(server.main_loop())
+        return
+
+    # use the selectors based server for any backend other than select
+    if backend != 'select':
+        server = ChatServer(HOST, PORT, backend, admin_port=admin_port, log_dir=log_dir, log_fsync_interval=log_fsync_interval, cluster_host=cluster_host, cluster_port=cluster_port, cluster_peers=cluster_peers)
+        server.main_loop()
+        return
+
     # create socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -241,10 +2074,1058 @@ class TestChatServer(unittest.TestCase):
         print(f"recv called with: {mock_client_socket.recv.call_args}")
         print()
 
+    def test_make_selector(self):
+        print('Testing make selector ...')
+        selector = make_selector('selectors')
+        self.assertIsInstance(selector, selectors.BaseSelector)
+        print(f"selectors backend: {type(selector).__name__}")
+        selector.close()
+
+        # the select backend is the select.select loop, not a selector
+        with self.assertRaises(ValueError):
+            make_selector('select')
+        print()
+
+    def test_chat_server_broadcast(self):
+        print('Testing chat server broadcast ...')
+        server = ChatServer('127.0.0.1', 0)
+
+        # connect two clients and send their nicknames
+        sender = socket.create_connection(('127.0.0.1', server.port))
+        receiver = socket.create_connection(('127.0.0.1', server.port))
+        sender.send(encode_frame(b'sender'))
+        pump(server)
+        receiver.send(encode_frame(b'receiver'))
+        pump(server)
+        assert_true(sorted(server.clients.values()), [b'receiver', b'sender'])
+        self.assertTrue(all(client_socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) for client_socket in server.clients))
+
+        # the message is sent to the receiver only
+        sender.send(encode_frame(b'Hello, Group!'))
+        pump(server)
+        receiver.settimeout(1)
+        self.assertEqual(receiver.recv(1024), encode_frame(b'sender: Hello, Group!'))
+        print(f"receiver got: {b'sender: Hello, Group!'}")
+
+        # closing the sender removes it from the server
+        sender.close()
+        pump(server)
+        self.assertEqual(list(server.clients.values()), [b'receiver'])
+
+        receiver.close()
+        server.close()
+        print()
+
+    def test_chat_server_framed_burst(self):
+        print('Testing chat server framed burst ...')
+        server = ChatServer('127.0.0.1', 0)
+        sender = socket.create_connection(('127.0.0.1', server.port))
+        receiver = socket.create_connection(('127.0.0.1', server.port))
+        receiver.send(encode_frame(b'receiver'))
+        pump(server)
+
+        # nickname and two messages in one send, the last message split in two sends
+        sender.send(encode_frame(b'sender') + encode_frame(b'one') + encode_frame(b'two') + encode_frame(b'three')[:6])
+        pump(server)
+        sender.send(encode_frame(b'three')[6:])
+        pump(server)
+
+        # every message arrives whole and in order
+        receiver.settimeout(1)
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < 3:
+            frames += decoder.feed(receiver.recv(1024))
+        self.assertEqual([payload for _, payload in frames], [b'sender: one', b'sender: two', b'sender: three'])
+        print(f"receiver got: {frames}")
+
+        sender.close()
+        receiver.close()
+        server.close()
+        print()
+
+    def test_async_chat_server_broadcast(self):
+        print('Testing asyncio chat server broadcast ...')
+
+        async def scenario():
+            server = AsyncChatServer('127.0.0.1', 0)
+            await server.start()
+
+            # connect two clients and send their nicknames
+            sender_reader, sender = await asyncio.open_connection('127.0.0.1', server.port)
+            receiver_reader, receiver = await asyncio.open_connection('127.0.0.1', server.port)
+            receiver.write(encode_frame(b'receiver'))
+            await receiver.drain()
+            await asyncio.sleep(0.05)
+            sender.write(encode_frame(b'sender') + encode_frame(b'\xff') + encode_frame(b'Hello, Group!'))
+            await sender.drain()
+
+            # the same nickname handshake and broadcast format as ChatServer, text that is not UTF-8 is passed on as it is
+            invalid = await asyncio.wait_for(receiver_reader.readexactly(len(encode_frame(b'sender: \xff'))), 1)
+            self.assertEqual(invalid, encode_frame(b'sender: \xff'))
+            data = await asyncio.wait_for(receiver_reader.readexactly(len(encode_frame(b'sender: Hello, Group!'))), 1)
+            clients = sorted(server.clients.values())
+
+            sender.close()
+            receiver.close()
+            await server.close()
+            return data, clients
+
+        data, clients = asyncio.run(scenario())
+        self.assertEqual(data, encode_frame(b'sender: Hello, Group!'))
+        assert_true(clients, [b'receiver', b'sender'])
+        print(f"receiver got: {data}")
+        print()
+
+    def test_chat_server_relay_between_workers(self):
+        print('Testing relay between workers ...')
+        first = ChatServer('127.0.0.1', 0)
+        second = ChatServer('127.0.0.1', 0)
+
+        # link the two workers like start_workers does
+        left, right = socket.socketpair()
+        first.add_peer(left)
+        second.add_peer(right)
+
+        # one client on each worker
+        sender = socket.create_connection(('127.0.0.1', first.port))
+        receiver = socket.create_connection(('127.0.0.1', second.port))
+        sender.send(encode_frame(b'sender'))
+        receiver.send(encode_frame(b'receiver'))
+        pump(first)
+        pump(second)
+
+        # the message crosses the link and is fanned out by the second worker
+        sender.send(encode_frame(b'Hello, Group!'))
+        pump(first)
+        pump(second)
+        receiver.settimeout(1)
+        self.assertEqual(receiver.recv(1024), encode_frame(b'sender: Hello, Group!'))
+        print(f"receiver got: {b'sender: Hello, Group!'}")
+
+        sender.close()
+        receiver.close()
+        first.close()
+        second.close()
+        print()
+
+    def test_chat_server_cluster(self):
+        print('Testing cluster links ...')
+        first = ChatServer('127.0.0.1', 0, cluster_port=0)
+        second = ChatServer('127.0.0.1', 0, cluster_port=0, cluster_peers=[('127.0.0.1', first.cluster_port)])
+        third = ChatServer('127.0.0.1', 0, cluster_port=0, cluster_peers=[('127.0.0.1', second.cluster_port)])
+        servers = (first, second, third)
+
+        # one client on each server
+        clients = []
+        for server, user in zip(servers, (b'alice', b'bob', b'carol')):
+            client = socket.create_connection(('127.0.0.1', server.port))
+            client.send(encode_frame(user))
+            client.settimeout(1)
+            clients.append(client)
+        for _ in range(3):
+            for server in servers:
+                pump(server, 2)
+        self.assertEqual([len(server.peers) for server in servers], [1, 2, 1])
+
+        # the message crosses both links of the chain once, the middle server fans it out and relays it
+        alice, bob, carol = clients
+        alice.send(encode_frame(b'Hello, cluster!'))
+        for server in servers:
+            pump(server, 2)
+        self.assertEqual(bob.recv(1024), encode_frame(b'alice: Hello, cluster!'))
+        self.assertEqual(carol.recv(1024), encode_frame(b'alice: Hello, cluster!'))
+        self.assertEqual(sum(server.metrics.relay_duplicates for server in servers), 0)
+
+        # a link that closes the loop brings copies, they are dropped, every client still gets the message once
+        first.connect_peer(('127.0.0.1', third.cluster_port))
+        for _ in range(3):
+            for server in servers:
+                pump(server, 2)
+        carol.send(encode_frame(b'Hello, loop!'))
+        for _ in range(3):
+            for server in servers:
+                pump(server, 2)
+        self.assertEqual(alice.recv(1024), encode_frame(b'carol: Hello, loop!'))
+        self.assertEqual(bob.recv(1024), encode_frame(b'carol: Hello, loop!'))
+        self.assertGreater(sum(server.metrics.relay_duplicates for server in servers), 0)
+        print(f"duplicates dropped: {[server.metrics.relay_duplicates for server in servers]}")
+
+        # a /msg finds its user on another server
+        alice.send(encode_frame(b'/msg carol psst\n'))
+        for _ in range(3):
+            for server in servers:
+                pump(server, 2)
+        self.assertEqual(carol.recv(1024), encode_frame(b'alice (private): psst\n'))
+        bob.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            bob.recv(1024)
+
+        for client in clients:
+            client.close()
+        for server in servers:
+            server.close()
+        print()
+
+    def test_chat_server_cluster_host(self):
+        print('Testing cluster links on another address ...')
+        address = local_address()
+        if address is None:
+            self.skipTest('no address other than loopback')
+
+        # the clients stay on loopback, the link between the servers goes over the other address
+        first = ChatServer('127.0.0.1', 0, cluster_host='0.0.0.0', cluster_port=0)
+        second = ChatServer('127.0.0.1', 0, cluster_host=address, cluster_port=0, cluster_peers=[(address, first.cluster_port)])
+        self.assertEqual(second.cluster_socket.getsockname()[0], address)
+
+        clients = []
+        for server, user in ((first, b'alice'), (second, b'bob')):
+            client = socket.create_connection(('127.0.0.1', server.port))
+            client.send(encode_frame(user))
+            client.settimeout(1)
+            clients.append(client)
+        for _ in range(3):
+            pump(first, 2)
+            pump(second, 2)
+        self.assertEqual([len(server.peers) for server in (first, second)], [1, 1])
+
+        alice, bob = clients
+        alice.send(encode_frame(b'Hello, host!'))
+        pump(first, 2)
+        pump(second, 2)
+        self.assertEqual(bob.recv(1024), encode_frame(b'alice: Hello, host!'))
+        print(f"linked on {address}")
+
+        for client in clients:
+            client.close()
+        first.close()
+        second.close()
+        print()
+
+    def test_chat_server_relay_origins(self):
+        print('Testing relay origins limit ...')
+        server = ChatServer('127.0.0.1', 0)
+        left, right = socket.socketpair()
+        server.add_peer(left)
+        message = encode_frame(b'x: hi')
+
+        # a fourth origin makes place by forgetting the one not heard from the longest
+        with patch('server.RELAY_ORIGINS', 3):
+            for origin in (1, 2, 3, 1, 4):
+                server.relayed(left, encode_relay(origin, origin * 10, b'lobby', message))
+        self.assertEqual(list(server.relay_windows), [3, 1, 4])
+        print(f"origins: {list(server.relay_windows)}")
+
+        right.close()
+        server.close()
+        print()
+
+    def test_chat_server_reuse_port(self):
+        print('Testing reuse port ...')
+        first = ChatServer('127.0.0.1', 0, reuse_port=True)
+
+        # a second worker can listen on the same port
+        second = ChatServer('127.0.0.1', first.port, reuse_port=True)
+        assert_true(second.port, first.port)
+        self.assertEqual(second.port, first.port)
+
+        first.close()
+        second.close()
+        print()
+
+    def test_chat_server_rooms(self):
+        print('Testing chat server rooms ...')
+        server = ChatServer('127.0.0.1', 0)
+        alice = socket.create_connection(('127.0.0.1', server.port))
+        bob = socket.create_connection(('127.0.0.1', server.port))
+        carol = socket.create_connection(('127.0.0.1', server.port))
+        for client, user in ((alice, b'alice'), (bob, b'bob'), (carol, b'carol')):
+            client.send(encode_frame(user))
+        pump(server)
+
+        # alice and bob join another room, carol stays in the lobby
+        alice.send(encode_frame(b'/join python\n'))
+        bob.send(encode_frame(b'/join python\n'))
+        pump(server)
+        for client in (alice, bob):
+            client.settimeout(1)
+            self.assertEqual(client.recv(1024), encode_frame(b'You joined python\n'))
+
+        # the message reaches bob only
+        alice.send(encode_frame(b'Hello, Python!'))
+        pump(server)
+        self.assertEqual(bob.recv(1024), encode_frame(b'alice: Hello, Python!'))
+        carol.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            carol.recv(1024)
+
+        # per-room counters
+        stats = sorted(server.room_stats())
+        self.assertEqual(stats, [(b'lobby', 1, 0), (b'python', 2, 1)])
+        print(f"room stats: {stats}")
+
+        # leaving the last member keeps the room for its history
+        alice.send(encode_frame(b'/leave'))
+        bob.close()
+        pump(server)
+        self.assertEqual(sorted(server.rooms), [b'lobby', b'python'])
+        self.assertEqual(server.rooms[b'python'].members, set())
+
+        # a room name that is not UTF-8 is refused, the server keeps running
+        carol.setblocking(True)
+        carol.settimeout(1)
+        carol.send(encode_frame(b'/join \xff') + encode_frame(b'/rooms'))
+        pump(server)
+        frames = FrameDecoder().feed(carol.recv(1024))
+        self.assertEqual(frames[0], (FRAME_MESSAGE, b'Room name is not valid UTF-8\n'))
+        self.assertEqual(server.client_rooms[next(s for s, user in server.clients.items() if user == b'carol')].name, b'lobby')
+
+        alice.close()
+        carol.close()
+        server.close()
+        print()
+
+    def test_chat_server_room_limit(self):
+        print('Testing room limit ...')
+        server = ChatServer('127.0.0.1', 0, max_rooms=2)
+        client = socket.create_connection(('127.0.0.1', server.port))
+        client.settimeout(1)
+        client.send(encode_frame(b'alice'))
+        pump(server)
+
+        # every room with a message is kept once it is empty, until a new room needs its place, the lobby is not counted
+        for name in (b'one', b'two', b'three'):
+            client.send(encode_frame(b'/join ' + name) + encode_frame(b'hi'))
+            pump(server)
+        self.assertEqual(sorted(server.rooms), [b'lobby', b'three', b'two'])
+
+        # with every room in use a new one is refused, bob is not the last member of his room
+        other = socket.create_connection(('127.0.0.1', server.port))
+        third = socket.create_connection(('127.0.0.1', server.port))
+        other.settimeout(1)
+        other.send(encode_frame(b'bob') + encode_frame(b'/join two'))
+        third.send(encode_frame(b'carol') + encode_frame(b'/join two'))
+        pump(server)
+        decoder = FrameDecoder()
+        while (FRAME_MESSAGE, b'You joined two\n') not in decoder.feed(other.recv(1024)):
+            pass
+        other.send(encode_frame(b'/join four'))
+        pump(server)
+        while (FRAME_MESSAGE, b'Too many rooms, four cannot be created\n') not in decoder.feed(other.recv(1024)):
+            pass
+        self.assertEqual(len(server.rooms), 3)
+        print(f"rooms: {sorted(server.rooms)}")
+
+        client.close()
+        other.close()
+        third.close()
+        server.close()
+
+        # with room for one room, a client alone in it can still move: its room makes place for the next one
+        server = ChatServer('127.0.0.1', 0, max_rooms=1)
+        client = socket.create_connection(('127.0.0.1', server.port))
+        client.settimeout(1)
+        client.send(encode_frame(b'alice') + encode_frame(b'/join one') + encode_frame(b'hi'))
+        pump(server)
+        client.send(encode_frame(b'/join two'))
+        pump(server)
+        decoder = FrameDecoder()
+        while (FRAME_MESSAGE, b'You joined two\n') not in decoder.feed(client.recv(1024)):
+            pass
+        self.assertEqual(sorted(server.rooms), [b'lobby', b'two'])
+
+        # a refused client stays in its room
+        other = socket.create_connection(('127.0.0.1', server.port))
+        other.settimeout(1)
+        other.send(encode_frame(b'bob') + encode_frame(b'/join three'))
+        pump(server)
+        decoder = FrameDecoder()
+        while (FRAME_MESSAGE, b'Too many rooms, three cannot be created\n') not in decoder.feed(other.recv(1024)):
+            pass
+        self.assertEqual(server.client_rooms[server.nicknames[b'bob']].name, b'lobby')
+        print(f"rooms: {sorted(server.rooms)}")
+
+        client.close()
+        other.close()
+        server.close()
+        print()
+
+    def test_history_budget(self):
+        print('Testing history budget ...')
+        history = History(max_messages=3, max_bytes=12)
+        for frame in (b'aaaa', b'bbbb', b'cccc', b'dddd'):
+            history.append((frame,))
+
+        # the count limit drops the oldest frame
+        self.assertEqual(history.replay(), b'bbbbccccdddd')
+
+        # the byte limit drops frames until the new one fits
+        history.append((b'eee', b'eee'))
+        self.assertEqual(history.replay(), b'ddddeeeeee')
+        self.assertEqual(history.size, 10)
+
+        # a frame bigger than the budget is not kept
+        history.append((b'x' * 13,))
+        self.assertEqual(len(history), 2)
+        print(f"history: {history.replay()}")
+        print()
+
+    def test_chat_server_history_replay(self):
+        print('Testing history replay on join ...')
+        server = ChatServer('127.0.0.1', 0)
+        sender = socket.create_connection(('127.0.0.1', server.port))
+        sender.send(encode_frame(b'sender') + encode_frame(b'one') + encode_frame(b'two'))
+        pump(server)
+
+        # a client joining later gets both messages in one frame burst
+        late = socket.create_connection(('127.0.0.1', server.port))
+        late.send(encode_frame(b'late'))
+        pump(server)
+        late.settimeout(1)
+        expected = encode_frame(b'sender: one') + encode_frame(b'sender: two')
+        self.assertEqual(late.recv(1024), expected)
+        print(f"late client got: {expected}")
+
+        sender.close()
+        late.close()
+        server.close()
+        print()
+
+    def test_histogram(self):
+        print('Testing histogram ...')
+        histogram = Histogram([1, 2, 4])
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.buckets(), [(1, 2), (2, 2), (4, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.sum, 14.5)
+        print(f"buckets: {histogram.buckets()}")
+        print()
+
+    def test_chat_server_admin_metrics(self):
+        print('Testing admin metrics ...')
+        server = ChatServer('127.0.0.1', 0, admin_port=0)
+        sender = socket.create_connection(('127.0.0.1', server.port))
+        receiver = socket.create_connection(('127.0.0.1', server.port))
+        sender.send(encode_frame(b'sender'))
+        receiver.send(encode_frame(b'receiver'))
+        pump(server)
+        sender.send(encode_frame(b'one') + encode_frame(b'two'))
+        sender.close()
+        pump(server)
+
+        # ask for the metrics in JSON, the answer ends with the connection
+        admin = socket.create_connection(('127.0.0.1', server.admin_port))
+        admin.send(b'json\n')
+        pump(server)
+        admin.settimeout(1)
+        answer = b''
+        while True:
+            data = admin.recv(65536)
+            if not data:
+                break
+            answer += data
+        metrics = json.loads(answer)
+
+        self.assertEqual(metrics['connected_clients'], 1)
+        self.assertEqual(metrics['messages_in'], 2)
+        self.assertEqual(metrics['messages_out'], 2)
+        self.assertEqual(metrics['broadcast_seconds']['count'], 2)
+        self.assertEqual(metrics['disconnects'], {'closed': 1})
+        print(f"metrics: {metrics['messages_in']} in, {metrics['messages_out']} out")
+
+        # the plain text answer has one metric per line
+        self.assertIn('connected_clients 1\n', server.metrics_text())
+
+        admin.close()
+        receiver.close()
+        server.close()
+        print()
+
+    def test_timer_wheel(self):
+        print('Testing timer wheel ...')
+        fired = []
+        wheel = TimerWheel(resolution=1, slots=4, levels=3, now=0)
+
+        # timers in level 0, level 1 and level 2
+        for delay in (1, 3, 6, 17, 40):
+            wheel.schedule(delay, fired.append, delay)
+        cancelled = wheel.schedule(5, fired.append, 5)
+        wheel.cancel(cancelled)
+
+        # every timer fires on its own tick, after moving down the levels
+        for now in range(1, 64):
+            wheel.advance(now)
+            self.assertEqual(fired, [delay for delay in (1, 3, 6, 17, 40) if delay <= now])
+        self.assertEqual(len(wheel), 0)
+        print(f"fired: {fired}")
+        print()
+
+    def test_chat_server_idle_reaping(self):
+        print('Testing idle reaping ...')
+        server = ChatServer('127.0.0.1', 0, idle_timeout=0.2, pong_timeout=0.2, timer_resolution=0.05)
+        silent = socket.create_connection(('127.0.0.1', server.port))
+        alive = socket.create_connection(('127.0.0.1', server.port))
+        silent.send(encode_frame(b'silent'))
+        alive.send(encode_frame(b'alive'))
+        pump(server)
+
+        # the alive client answers every ping, the silent one never does
+        alive.setblocking(False)
+        decoder = FrameDecoder()
+        deadline = time.monotonic() + 1
+        pings = 0
+        while time.monotonic() < deadline:
+            server.loop_iteration(0.05)
+            try:
+                data = alive.recv(1024)
+            except BlockingIOError:
+                continue
+            for kind, _ in decoder.feed(data):
+                if kind == FRAME_PING:
+                    pings += 1
+                    alive.send(encode_frame(b'', FRAME_PONG))
+
+        self.assertGreater(pings, 0)
+        self.assertEqual(list(server.clients.values()), [b'alive'])
+        self.assertEqual(server.metrics.disconnects['idle'], 1)
+        self.assertEqual(len(server.timer_wheel), 1)
+        print(f"pings answered: {pings}, clients: {list(server.clients.values())}")
+
+        silent.close()
+        alive.close()
+        server.close()
+        print()
+
+    def test_chat_server_compression(self):
+        print('Testing compression ...')
+        server = ChatServer('127.0.0.1', 0)
+        sender = socket.create_connection(('127.0.0.1', server.port))
+        first = socket.create_connection(('127.0.0.1', server.port))
+        second = socket.create_connection(('127.0.0.1', server.port))
+        plain = socket.create_connection(('127.0.0.1', server.port))
+        sender.send(encode_hello(b'sender', compress=True))
+        first.send(encode_hello(b'first', compress=True))
+        second.send(encode_hello(b'second', compress=True))
+        plain.send(encode_frame(b'plain'))
+        pump(server)
+
+        # the sender compresses with its own stream
+        stream = compressor()
+        for _ in range(2):
+            sender.send(encode_frame(deflate(stream, b'good morning everyone'), FRAME_DEFLATE))
+        pump(server)
+
+        def frames(client):
+            client.settimeout(1)
+            decoder = FrameDecoder()
+            result = []
+            while len(result) < 3:
+                result += decoder.feed(client.recv(65536))
+            return result
+
+        # both compressed members get the same bytes: a new stream and two messages
+        received = frames(first)
+        self.assertEqual(received, frames(second))
+        self.assertEqual([kind for kind, _ in received], [FRAME_DEFLATE_RESET, FRAME_DEFLATE, FRAME_DEFLATE])
+        stream = decompressor()
+        self.assertEqual([inflate(stream, payload) for _, payload in received[1:]], [b'sender: good morning everyone'] * 2)
+
+        # the sender gets the echo of its messages, the plain member gets plain frames
+        self.assertEqual([kind for kind, _ in frames(sender)], [FRAME_DEFLATE_RESET, FRAME_DEFLATE_ECHO, FRAME_DEFLATE_ECHO])
+        plain.settimeout(1)
+        expected = encode_frame(b'sender: good morning everyone') * 2
+        data = b''
+        while len(data) < len(expected):
+            data += plain.recv(65536)
+        self.assertEqual(data, expected)
+        print(f"compressed sizes: {[len(payload) for _, payload in received[1:]]}")
+
+        for client in (sender, first, second, plain):
+            client.close()
+        server.close()
+        print()
+
+    def test_chat_server_private_message(self):
+        print('Testing private message ...')
+        server = ChatServer('127.0.0.1', 0)
+        alice = socket.create_connection(('127.0.0.1', server.port))
+        bob = socket.create_connection(('127.0.0.1', server.port))
+        carol = socket.create_connection(('127.0.0.1', server.port))
+        alice.send(encode_frame(b'alice'))
+        bob.send(encode_frame(b'bob'))
+        carol.send(encode_frame(b'carol'))
+        pump(server)
+
+        # bob gets the message, carol does not, even in the same room
+        alice.send(encode_frame(b'/msg bob see you at 5\n'))
+        pump(server)
+        bob.settimeout(1)
+        self.assertEqual(bob.recv(1024), encode_frame(b'alice (private): see you at 5\n'))
+        carol.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            carol.recv(1024)
+
+        # an unknown nickname is answered to the sender
+        alice.send(encode_frame(b'/msg dave hi\n'))
+        pump(server)
+        alice.settimeout(1)
+        self.assertEqual(alice.recv(1024), encode_frame(b'No such user: dave\n'))
+
+        # the index follows disconnects
+        bob.close()
+        pump(server)
+        self.assertEqual(sorted(server.nicknames), [b'alice', b'carol'])
+        print(f"nicknames: {sorted(server.nicknames)}")
+
+        alice.close()
+        carol.close()
+        server.close()
+        print()
+
+    def test_chat_server_duplicate_nickname(self):
+        print('Testing duplicate nickname ...')
+        server = ChatServer('127.0.0.1', 0)
+        first = socket.create_connection(('127.0.0.1', server.port))
+        first.send(encode_frame(b'alice'))
+        pump(server)
+
+        # the second alice is told why and closed
+        second = socket.create_connection(('127.0.0.1', server.port))
+        second.send(encode_frame(b'alice') + encode_frame(b'hi'))
+        pump(server)
+        second.settimeout(1)
+        self.assertEqual(second.recv(1024), encode_frame(b'Nickname alice is already taken\n'))
+        self.assertEqual(second.recv(1024), b'')
+        self.assertEqual(server.nicknames[b'alice'] in server.clients, True)
+        self.assertEqual(len(server.clients), 1)
+        print(f"clients: {list(server.clients.values())}")
+
+        first.close()
+        second.close()
+        server.close()
+        print()
+
+    def test_chat_server_stale_event(self):
+        print('Testing event of a disconnected socket ...')
+        server = ChatServer('127.0.0.1', 0)
+        client = socket.create_connection(('127.0.0.1', server.port))
+        client.send(encode_frame(b'slow'))
+        pump(server)
+        client_socket = next(iter(server.clients))
+        fd = client_socket.fileno()
+
+        # an earlier handler of the same select batch dropped the client, its read event is still in the batch
+        server.disconnect(client_socket, 'slow')
+        server.disconnect(client_socket, 'slow')
+        stale = selectors.SelectorKey(client_socket, fd, selectors.EVENT_READ | selectors.EVENT_WRITE, server.read)
+        with patch.object(server.selector, 'select', return_value=[(stale, selectors.EVENT_READ | selectors.EVENT_WRITE)]):
+            server.loop_iteration(0)
+        self.assertEqual(server.metrics.disconnects['slow'], 1)
+        print(f"disconnects: {dict(server.metrics.disconnects)}")
+
+        client.close()
+        server.close()
+        print()
+
+    def test_outbound_queue_partial_send(self):
+        print('Testing outbound queue partial send ...')
+        queue = OutboundQueue()
+        queue.append((b'Hello', b', World!'))
+
+        # the socket accepts 7 bytes, then would block
+        self.mock_client_socket.sendmsg.side_effect = [7, BlockingIOError]
+        queue.send(self.mock_client_socket)
+        self.assertEqual(len(queue), 6)
+        self.assertEqual(self.mock_client_socket.sendmsg.call_args[0][0], [b'Hello', b', World!'])
+        print(f"bytes left in queue: {len(queue)}")
+
+        # the rest is sent from where the first send stopped
+        self.mock_client_socket.sendmsg.side_effect = [6]
+        queue.send(self.mock_client_socket)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual([bytes(chunk) for chunk in self.mock_client_socket.sendmsg.call_args[0][0]], [b'World!'])
+        print(f"sendmsg called with: {self.mock_client_socket.sendmsg.call_args}")
+        print()
+
+    def test_slow_client_policy(self):
+        print('Testing slow client policy ...')
+        for policy, expected in (('disconnect', False), ('drop', True)):
+            server = ChatServer('127.0.0.1', 0, high_water_mark=16, slow_client_policy=policy)
+            client = socket.create_connection(('127.0.0.1', server.port))
+            client.send(encode_frame(b'slow'))
+            pump(server)
+            client_socket = next(iter(server.clients))
+
+            # an empty queue takes one frame bigger than the mark
+            self.assertEqual(server.send(client_socket, (b'x' * 32,)), True)
+
+            # a message that takes a waiting queue over the high-water mark is refused for this client
+            queue = server.queues[client_socket]
+            queue.append((b'y' * 8,))
+            result = server.send(client_socket, (b'x' * 32,))
+            self.assertEqual(result, expected)
+            self.assertEqual(len(queue), 8)
+            assert_true(result, expected)
+
+            client.close()
+            server.close()
+        print()
+
+    def test_token_bucket(self):
+        print('Testing token bucket ...')
+        bucket = TokenBucket(rate=10, burst=2, now=0)
+        for _ in range(2):
+            self.assertEqual(bucket.wait(1, now=0), 0)
+            bucket.take(1)
+
+        # empty, the next token comes after 1 / rate seconds
+        self.assertAlmostEqual(bucket.wait(1, now=0), 0.1)
+        self.assertEqual(bucket.wait(1, now=0.1), 0)
+
+        # an amount bigger than the bucket waits for a full bucket, then leaves a debt
+        self.assertAlmostEqual(bucket.wait(5, now=0.1), 0.1)
+        bucket.wait(5, now=0.2)
+        bucket.take(5)
+        self.assertAlmostEqual(bucket.wait(1, now=0.2), 0.4)
+        print(f"tokens: {bucket.tokens}")
+        print()
+
+    def test_chat_server_rate_limit(self):
+        print('Testing rate limit ...')
+        server = ChatServer('127.0.0.1', 0, timer_resolution=0.05, message_rate=10, message_burst=2, byte_rate=None)
+        sender = socket.create_connection(('127.0.0.1', server.port))
+        receiver = socket.create_connection(('127.0.0.1', server.port))
+        sender.send(encode_frame(b'sender'))
+        receiver.send(encode_frame(b'receiver'))
+        pump(server)
+
+        # a burst of 5 messages, only the first 2 fit in the bucket
+        sender.send(b''.join(encode_frame(f'{i}\n'.encode()) for i in range(5)))
+        server.loop_iteration(0.05)
+        client_socket = server.nicknames[b'sender']
+        self.assertEqual(client_socket in server.paused, True)
+        self.assertEqual(len(server.paused[client_socket][0]), 3)
+        self.assertEqual(client_socket in server.selector.get_map(), False)
+
+        # the rest arrives later, in order, nothing is dropped
+        receiver.settimeout(1)
+        decoder = FrameDecoder()
+        frames = []
+        deadline = time.monotonic() + 3
+        while len(frames) < 5 and time.monotonic() < deadline:
+            pump(server)
+            receiver.setblocking(False)
+            try:
+                frames += decoder.feed(receiver.recv(1024))
+            except BlockingIOError:
+                pass
+        self.assertEqual([payload for _, payload in frames], [f'sender: {i}\n'.encode() for i in range(5)])
+        print(f"receiver got: {frames}")
+
+        # the pauses are counted for the sender
+        snapshot = server.metrics_snapshot()
+        self.assertEqual(snapshot['throttled'] >= 1, True)
+        self.assertEqual(snapshot['throttled_seconds_largest'][0]['user'], 'sender')
+        print(f"throttled: {snapshot['throttled']}, {snapshot['throttled_seconds']:.2f} seconds")
+
+        sender.close()
+        receiver.close()
+        server.close()
+        print()
+
+    def test_chat_server_history_since(self):
+        print('Testing history since ...')
+        directory = tempfile.mkdtemp()
+        server = ChatServer('127.0.0.1', 0, log_dir=directory)
+        alice = socket.create_connection(('127.0.0.1', server.port))
+        alice.send(encode_frame(b'alice') + encode_frame(b'one\n') + encode_frame(b'two\n'))
+        pump(server)
+        server.close()
+
+        # a restarted server answers from the log on disk, for the room of the client
+        server = ChatServer('127.0.0.1', 0, log_dir=directory, log_fsync_interval=None)
+        self.assertEqual(server.chat_log.fsync_interval, None)
+        bob = socket.create_connection(('127.0.0.1', server.port))
+        bob.send(encode_frame(b'bob') + encode_frame(b'three\n') + encode_frame(b'/history since 1m'))
+        pump(server)
+        bob.settimeout(1)
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < 3:
+            frames += decoder.feed(bob.recv(1024))
+        self.assertEqual([payload for _, payload in frames], [b'alice: one\n', b'alice: two\n', b'bob: three\n'])
+        print(f"bob got: {frames}")
+
+        # a time in the future finds nothing, a bad time is answered with the usage
+        self.assertEqual(parse_since(b'2h', now=10000), 2800)
+        bob.send(encode_frame(b'/history since soon'))
+        pump(server)
+        self.assertEqual(decoder.feed(bob.recv(1024))[0][1].startswith(b'Usage: /history'), True)
+
+        # an answer cut short by bytes (two messages and their headers) tells the client where to ask again
+        with patch('server.HISTORY_QUERY_BYTES', 32):
+            bob.send(encode_frame(b'/history since 1m'))
+            pump(server)
+        frames = []
+        while len(frames) < 3:
+            frames += decoder.feed(bob.recv(1024))
+        self.assertEqual([payload for _, payload in frames[:2]], [b'alice: one\n', b'alice: two\n'])
+        self.assertEqual(frames[2][1].startswith(b'Stopped after 2 messages, ask again with /history since '), True)
+        print(f"bob got: {frames[2][1]}")
+
+        # a high-water mark smaller than one message still lets one into an empty queue, with the notice
+        server.high_water_mark = 16
+        server.slow_client_policy = 'drop'
+        bob.send(encode_frame(b'/history since 1m'))
+        pump(server)
+        frames = []
+        while len(frames) < 2:
+            frames += decoder.feed(bob.recv(1024))
+        self.assertEqual(frames[0][1], b'alice: one\n')
+        self.assertEqual(frames[1][1].startswith(b'Stopped after 1 messages'), True)
+
+        # an answer that does not fit next to what is waiting is replaced by a notice, it is not dropped silently
+        bob_socket = server.nicknames[b'bob']
+        queue = server.queues[bob_socket]
+        queue.append((b'y' * 8,))
+        server.history(bob_socket, [b'since', b'1m'])
+        waiting = b''.join(bytes(chunk) for chunk in queue.chunks)
+        self.assertEqual(waiting, b'y' * 8 + encode_frame(b'Too much is waiting to be sent, ask again later\n'))
+
+        alice.close()
+        bob.close()
+        server.close()
+        shutil.rmtree(directory)
+        print()
+
+    def test_chat_server_resume(self):
+        print('Testing resume with sequence numbers ...')
+        server = ChatServer('127.0.0.1', 0)
+        bob = socket.create_connection(('127.0.0.1', server.port))
+        bob.send(encode_frame(b'bob') + encode_frame(b'one\n') + encode_frame(b'two\n') + encode_frame(b'three\n'))
+        pump(server)
+
+        # alice saw up to message 1 before her connection dropped, she gets only 2 and 3
+        alice = socket.create_connection(('127.0.0.1', server.port))
+        alice.send(encode_hello(b'alice', resume={'room': 'lobby', 'seq': 1, 'epoch': server.epoch}))
+        pump(server)
+        alice.settimeout(1)
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < 3:
+            frames += decoder.feed(alice.recv(1024))
+        self.assertEqual(frames, [(FRAME_ROOM, ROOM.pack(1, server.epoch) + b'lobby'),
+                                  (FRAME_SEQUENCED, SEQUENCE.pack(2) + b'bob: two\n'),
+                                  (FRAME_SEQUENCED, SEQUENCE.pack(3) + b'bob: three\n')])
+        print(f"alice got: {frames}")
+
+        # new messages carry the next number, her own ones too
+        bob.send(encode_frame(b'four\n'))
+        pump(server)
+        alice.send(encode_frame(b'five\n'))
+        pump(server)
+        frames = []
+        while len(frames) < 2:
+            frames += decoder.feed(alice.recv(1024))
+        self.assertEqual([payload[:SEQUENCE.size] for _, payload in frames], [SEQUENCE.pack(4), SEQUENCE.pack(5)])
+
+        # a number the room never reached is from before a restart, the whole history is sent
+        carol = socket.create_connection(('127.0.0.1', server.port))
+        carol.send(encode_hello(b'carol', resume={'room': 'lobby', 'seq': 99, 'epoch': server.epoch}))
+        pump(server)
+        carol.settimeout(1)
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < 6:
+            frames += decoder.feed(carol.recv(4096))
+        self.assertEqual(frames[0], (FRAME_ROOM, ROOM.pack(0, server.epoch) + b'lobby'))
+        print(f"carol got {len(frames) - 1} messages")
+
+        # a number of another epoch (another worker) is not a number of this room either
+        erin = socket.create_connection(('127.0.0.1', server.port))
+        erin.send(encode_hello(b'erin', resume={'room': 'lobby', 'seq': 3, 'epoch': server.epoch + 1}))
+        pump(server)
+        erin.settimeout(1)
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < 6:
+            frames += decoder.feed(erin.recv(4096))
+        self.assertEqual(frames[0], (FRAME_ROOM, ROOM.pack(0, server.epoch) + b'lobby'))
+        erin.close()
+
+        # a number that is not a whole number >= 0 closes the connection, 1e400 is a float (infinity) in JSON
+        for seq in ('1e400', '-1', '1.5', 'true', '"3"'):
+            dave = socket.create_connection(('127.0.0.1', server.port))
+            dave.send(encode_frame(b'{"nickname": "dave", "resume": {"room": "lobby", "seq": %s}}' % seq.encode(), FRAME_HELLO))
+            pump(server)
+            dave.settimeout(1)
+            self.assertEqual(dave.recv(1024), b'')
+            dave.close()
+        self.assertNotIn(b'dave', server.nicknames)
+
+        for client in (alice, bob, carol):
+            client.close()
+        server.close()
+        print()
+
+    def test_chat_server_presence(self):
+        print('Testing coalesced presence ...')
+        server = ChatServer('127.0.0.1', 0, timer_resolution=0.05, presence_interval=0.05)
+        alice = socket.create_connection(('127.0.0.1', server.port))
+        alice.send(encode_hello(b'alice', presence=True))
+        pump(server)
+        alice.settimeout(1)
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(alice.recv(1024)), [(FRAME_PRESENCE, encode_presence([(PRESENCE_JOIN, b'alice')]))])
+
+        # two joins and typing in one tick are one frame, typing after a join adds nothing
+        bob = socket.create_connection(('127.0.0.1', server.port))
+        carol = socket.create_connection(('127.0.0.1', server.port))
+        bob.send(encode_frame(b'bob'))
+        carol.send(encode_frame(b'carol') + encode_frame(b'', FRAME_TYPING) * 3)
+        pump(server)
+        frames = decoder.feed(alice.recv(1024))
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(sorted(decode_presence(frames[0][1])), [(PRESENCE_JOIN, b'bob'), (PRESENCE_JOIN, b'carol')])
+
+        # many typing frames are one event, a join and a leave in the same tick cancel out
+        carol.send(encode_frame(b'', FRAME_TYPING) * 10)
+        pump(server, 1)
+        room = server.rooms[DEFAULT_ROOM]
+        server.presence(room, b'dave', PRESENCE_JOIN)
+        server.presence(room, b'dave', PRESENCE_LEAVE)
+        pump(server)
+        frames = decoder.feed(alice.recv(1024))
+        self.assertEqual(frames, [(FRAME_PRESENCE, encode_presence([(PRESENCE_TYPING, b'carol')]))])
+        print(f"alice got: {decode_presence(frames[0][1])}")
+
+        # a leave is sent to the others
+        bob.close()
+        pump(server)
+        self.assertEqual(decode_presence(decoder.feed(alice.recv(1024))[0][1]), [(PRESENCE_LEAVE, b'bob')])
+        self.assertEqual(server.metrics.presence_frames, 4)
+        print(f"presence events: {server.metrics.presence_events}, frames: {server.metrics.presence_frames}")
+
+        alice.close()
+        carol.close()
+        server.close()
+        print()
+
+    def test_chat_server_presence_between_workers(self):
+        print('Testing presence relay between workers ...')
+        first = ChatServer('127.0.0.1', 0, timer_resolution=0.05, presence_interval=0.05)
+        second = ChatServer('127.0.0.1', 0, timer_resolution=0.05, presence_interval=0.05)
+        left, right = socket.socketpair()
+        first.add_peer(left)
+        second.add_peer(right)
+
+        alice = socket.create_connection(('127.0.0.1', first.port))
+        alice.send(encode_hello(b'alice', presence=True))
+        pump(first)
+        alice.settimeout(1)
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(alice.recv(1024)), [(FRAME_PRESENCE, encode_presence([(PRESENCE_JOIN, b'alice')]))])
+
+        # bob joins on the other worker, the tick of the second worker reaches alice
+        bob = socket.create_connection(('127.0.0.1', second.port))
+        bob.send(encode_frame(b'bob'))
+        pump(second)
+        pump(first)
+        frames = decoder.feed(alice.recv(1024))
+        self.assertEqual(frames, [(FRAME_PRESENCE, encode_presence([(PRESENCE_JOIN, b'bob')]))])
+        print(f"alice got: {decode_presence(frames[0][1])}")
+
+        alice.close()
+        bob.close()
+        first.close()
+        second.close()
+        print()
+
+    def test_outbound_queue_attachments(self):
+        print('Testing outbound queue attachment scheduling ...')
+        queue = OutboundQueue()
+        queue.append((b'f1',), transfer=1)
+        queue.append((b'f2',), transfer=1)
+        queue.append((b'f3',), transfer=1)
+        queue.append((b'g1',), transfer=2)
+        queue.append((b'text',))
+
+        # one chunk per send, so the order is visible
+        sent = []
+        self.mock_client_socket.sendmsg.side_effect = lambda batch: sent.append(bytes(batch[0])) or len(batch[0])
+        with patch('server.IOV_MAX', 1):
+            queue.send(self.mock_client_socket)
+
+        # the message goes first, the transfers take turns
+        self.assertEqual(sent, [b'text', b'f1', b'g1', b'f2', b'f3'])
+        self.assertEqual(len(queue), 0)
+        print(f"send order: {sent}")
+        print()
+
+    def test_chat_server_attachment(self):
+        print('Testing attachment forwarding ...')
+        server = ChatServer('127.0.0.1', 0)
+        alice = socket.create_connection(('127.0.0.1', server.port))
+        bob = socket.create_connection(('127.0.0.1', server.port))
+        alice.send(encode_frame(b'alice'))
+        pump(server)
+        bob.send(encode_frame(b'bob'))
+        pump(server)
+        bob.settimeout(1)
+        decoder = FrameDecoder()
+
+        # the client's transfer id is replaced by the server's, the sender is added to the start
+        start = json.dumps({'name': 'a.bin', 'size': 10}).encode()
+        alice.send(encode_attachment(7, ATTACHMENT_START, start) + encode_attachment(7, ATTACHMENT_CHUNK, b'01234'))
+        pump(server)
+        frames = [decode_attachment(payload) for _, payload in decoder.feed(bob.recv(1024))]
+        transfer = frames[0][0]
+        self.assertEqual(json.loads(bytes(frames[0][2])), {'name': 'a.bin', 'size': 10, 'from': 'alice'})
+        self.assertEqual([(t, part, bytes(data)) for t, part, data in frames[1:]], [(transfer, ATTACHMENT_CHUNK, b'01234')])
+
+        # the sender leaves before the end, the transfer is aborted
+        alice.close()
+        pump(server)
+        frames = [decode_attachment(payload) for kind, payload in decoder.feed(bob.recv(1024)) if kind == FRAME_ATTACHMENT]
+        self.assertEqual([(t, part) for t, part, _ in frames], [(transfer, ATTACHMENT_ABORT)])
+        self.assertEqual(server.uploads, {next(iter(server.clients)): {}})
+        print(f"transfer {transfer} aborted")
+
+        bob.close()
+        server.close()
+        print()
+
+
+def local_address():
+    # an address of this host that is not loopback, None if it has none
+    # connecting a UDP socket sends nothing, it only picks the interface of the route
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(('192.0.2.1', 9))
+        address = probe.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        probe.close()
+    return None if address.startswith('127.') or address == '0.0.0.0' else address
+
+def pump(server, iterations=5):
+    # run a few iterations of the server loop so pending events are handled
+    for _ in range(iterations):
+        server.loop_iteration(0.05)
+
 
 if __name__ == "__main__":
     # uncomment this to test the communication between server and client on your local computer
     # start_server()
+    # use the selectors backend (epoll on Linux) for more than 1024 clients
+    # start_server('selectors')
+    # or the asyncio backend, compare both with benchmark.py
+    # start_server('asyncio')
+    # or one selectors worker per core, all on the same port
+    # start_server('selectors', workers=multiprocessing.cpu_count())
+    # or a cluster of servers, each one linked to the one before it, e.g. a second server on another host
+    # start_server('selectors', cluster_host='0.0.0.0', cluster_port=65433, cluster_peers=[('first-host', 65433)])
 
     # uncomment this before submitting to domjudge
     runner = unittest.TextTestRunner(stream=NullWriter())